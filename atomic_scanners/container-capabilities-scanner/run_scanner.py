@@ -5,9 +5,13 @@ from Atomic.backends._docker import DockerBackend
 
 
 def run_scanner(image):
-    run_object = run.Run()
-    run_object.image = image
-    return DockerBackend.check_args(run_object.get_label("RUN"))
+    # RUN label is given by scanner.py, inspect image only if absent
+    run_label = os.environ.get("IMAGE_RUN_LABEL")
+    if run_label is None:
+        run_object = run.Run()
+        run_object.image = image
+        run_label = run_object.get_label("RUN")
+    return DockerBackend.check_args(run_label)
 
 if __name__ == "__main__":
     run_scanner(os.environ.get("IMAGE_NAME"))
@@ -32,8 +32,20 @@ formatter = logging.Formatter(
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
-# image UUID
-UUID = run_object.get_input_id(IMAGE_NAME)
+
+def image_fact(name):
+    """
+    Returns image fact forwarded by scanning runner as env var, None if
+    absent. atomic leaves $VAR in custom_args as is if VAR is not set.
+    """
+    value = os.environ.get(name, "")
+    if not value or value.startswith("$"):
+        return None
+    return value
+
+
+# image UUID, inspect image only if it is not given
+UUID = image_fact("IMAGE_ID") or run_object.get_input_id(IMAGE_NAME)
 
 
 class RunLabelException(Exception):
@@ -50,7 +62,11 @@ def check_image_for_run_label(image):
     """
     If image under scan doesn't have a RUN label, raise RunLabelException
     """
-    run_label = run_object.get_label("RUN")
+    labels = image_fact("IMAGE_LABELS")
+    if labels:
+        run_label = json.loads(labels).get("RUN", "")
+    else:
+        run_label = run_object.get_label("RUN")
 
     if run_label == "":
         raise RunLabelException(
@@ -98,13 +114,17 @@ try:
 
     # run_object.check_args(run_label)
 
+    # pass the RUN label, scanner need not inspect image again
+    env = os.environ.copy()
+    env["IMAGE_RUN_LABEL"] = run_label
     out, err = subprocess.Popen(
         [
             "python",
             "run_scanner.py"
         ],
         stdout=subprocess.PIPE,
-        stdin=subprocess.PIPE
+        stdin=subprocess.PIPE,
+        env=env
     ).communicate()
 
     if out is not None:
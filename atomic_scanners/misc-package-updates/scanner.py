@@ -1,15 +1,30 @@
 #!/usr/bin/env python
 
 from datetime import datetime
-from time import sleep
 import docker
 import json
 import logging
 import os
+import requests
 import sys
+import threading
 
 OUTDIR = "/scanout"
 IMAGE_NAME = os.environ.get("IMAGE_NAME")
+# seconds package manager is given to check updates, before it is killed
+PACKAGE_MANAGER_TIMEOUT = 300
+
+# entrypoint and arguments to check updates, per package manager
+PACKAGE_MANAGERS = {
+    "pip": ("/usr/bin/pip", "list --outdated"),
+    "npm": ("/usr/bin/npm", "outdated -g"),
+    "gem": ("/usr/bin/gem", "outdated"),
+}
+# order of package managers in results
+PACKAGE_MANAGERS_ORDER = ["pip", "npm", "gem"]
+
+# marker line preceding output of each package manager in probe output
+PROBE_MARKER = "@@@ misc-package-updates "
 
 # set up logging
 logger = logging.getLogger("container-pipeline")
@@ -24,13 +39,29 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 # Client connecting to Docker socket
-client = docker.Client(base_url="unix:///var/run/docker.sock")
+# logs of package manager are streamed while it runs, client timeout must
+# allow for package manager being silent while it checks updates
+client = docker.Client(base_url="unix:///var/run/docker.sock",
+                       timeout=PACKAGE_MANAGER_TIMEOUT)
 
 # Argument passed to script. Decides package manager to check for.
 cli_arg = sys.argv[1]
 
-# image UUID
-UUID = client.inspect_image(IMAGE_NAME)["Id"].split(':')[-1]
+
+def image_fact(name):
+    """
+    Returns image fact forwarded by scanning runner as env var, None if
+    absent. atomic leaves $VAR in custom_args as is if VAR is not set.
+    """
+    value = os.environ.get(name, "")
+    if not value or value.startswith("$"):
+        return None
+    return value
+
+
+# image UUID, inspect image only if it is not given
+UUID = image_fact("IMAGE_ID") or \
+    client.inspect_image(IMAGE_NAME)["Id"].split(':')[-1]
 
 
 def binary_does_not_exist(response):
@@ -141,17 +172,39 @@ def template_json_data(scan_type):
         "UUID": UUID,
         "CVE Feed Last Updated": "NA",
         "Scanner": "Misc Package Updates",
-        "Scan Results": {"{} package updates".format(cli_arg): []},
+        "Scan Results": {"{} package updates".format(scan_type): []},
         "Summary": ""
     }
     return json_out
 
 
-def create_container(client, image, ep, cmd):
+def read_logs(client, container, chunks):
     """
-    Execute given cmd in container via client
+    Stream logs of given container into chunks, until container exits
     """
-    response = ""
+    try:
+        for chunk in client.logs(container=container, stream=True,
+                                 follow=True):
+            chunks.append(chunk)
+    except Exception as e:
+        logger.log(
+            level=logging.ERROR,
+            msg="Failed reading logs of container: {}".format(e)
+        )
+
+
+def create_container(client, image, ep, cmd,
+                     timeout=PACKAGE_MANAGER_TIMEOUT):
+    """
+    Execute given cmd in container via client, until container exits or is
+    killed after timeout seconds.
+
+    Returns tuple (output, exit code), exit code is None if cmd did not
+    finish.
+    """
+    container = None
+    chunks = []
+    exit_code = None
     try:
         # create the container
         container = client.create_container(
@@ -161,67 +214,169 @@ def create_container(client, image, ep, cmd):
         )
         # start the container
         client.start(container=container.get("Id"))
-        # pause for 10 seconds for package manager to collect data
-        sleep(10)
-        # get the logs from container
-        response = client.logs(container=container.get("Id"))
+        # capture output while package manager collects data
+        reader = threading.Thread(
+            target=read_logs, args=(client, container.get("Id"), chunks))
+        reader.daemon = True
+        reader.start()
+        try:
+            exit_code = client.wait(
+                container=container.get("Id"), timeout=timeout)
+        except requests.exceptions.RequestException:
+            logger.log(
+                level=logging.ERROR,
+                msg="{} did not finish in {} seconds".format(cmd, timeout)
+            )
+            client.kill(container=container.get("Id"))
+        # newer docker clients give exit code in status
+        if isinstance(exit_code, dict):
+            exit_code = exit_code.get("StatusCode")
+        # log stream ends once container exits
+        reader.join(timeout)
     except Exception as e:
         logger.log(
             level=logging.ERROR,
             msg="{} failed in scanner: {}".format(cmd, e)
         )
-    else:
-        return response
     finally:
-        client.remove_container(
-            container=container.get("Id"), force=True, v=True)
-
+        if container:
+            client.remove_container(
+                container=container.get("Id"), force=True, v=True)
+    return "".join(chunks), exit_code
 
-json_out = template_json_data(cli_arg)
-response = ""
-try:
-    # Check for pip updates
-    if cli_arg == "pip":
-        response = create_container(
-            client, IMAGE_NAME,
-            ep="/usr/bin/pip",
-            cmd="list --outdated")
 
-    # Check for rubygem updates
-    elif cli_arg == "gem":
-        response = create_container(
-            client, IMAGE_NAME,
-            ep="/usr/bin/gem",
-            cmd="outdated")
+def manager_results(manager, response, exit_code):
+    """
+    Returns tuple (results, successful, summary) of update check of given
+    package manager from its output and exit code
+    """
+    # shell gives exit code 127 for command not found
+    if not response or exit_code == 127 or binary_does_not_exist(response):
+        return ("Could not find {} executable in the image".format(manager),
+                False,
+                "No updates for packages installed via {}. ".format(manager))
+    return (format_response(manager, response),
+            True,
+            "Possible updates for packages installed via {}. ".format(
+                manager))
+
+
+def check_updates(manager):
+    """
+    Check updates of given package manager in a container of image
+    """
+    json_out = template_json_data(manager)
+    response = ""
+    exit_code = None
+    try:
+        entrypoint, args = PACKAGE_MANAGERS[manager]
+        response, exit_code = create_container(
+            client, IMAGE_NAME, ep=entrypoint, cmd=args)
+    except Exception as e:
+        logger.log(
+            level=logging.ERROR,
+            msg="Scanner failed: {}".format(e)
+        )
 
-    # Check for npm updates
-    elif cli_arg == "npm":
-        response = create_container(
-            client, IMAGE_NAME,
-            ep="/usr/bin/npm",
-            cmd="outdated -g")
-
-except Exception as e:
-    logger.log(
-        level=logging.ERROR,
-        msg="Scanner failed: {}".format(e)
-    )
-
-finally:
-    if not response or binary_does_not_exist(response):
-        json_out["Scan Results"] = \
-            "Could not find {} executable in the image".format(cli_arg)
-        json_out["Successful"] = False
-        json_out["Summary"] = "No updates for packages installed via {}. ".\
-            format(cli_arg)
-    else:
-        json_out["Scan Results"]["{} package updates".format(cli_arg)] = \
-            format_response(cli_arg, response)
+    json_out["Exit Code"] = exit_code
+    results, successful, summary = manager_results(
+        manager, response, exit_code)
+    if successful:
+        json_out["Scan Results"]["{} package updates".format(manager)] = \
+            results
         json_out["Finished Time"] = \
             datetime.now().strftime('%Y-%m-%d-%H-%M-%S-%f')
-        json_out["Successful"] = True
-        json_out["Summary"] = "Possible updates for packages installed via " \
-            "{}. ".format(cli_arg)
+    else:
+        json_out["Scan Results"] = results
+    json_out["Successful"] = successful
+    json_out["Summary"] = summary
+    return json_out
+
+
+def probe_script(managers):
+    """
+    Returns shell script checking updates of given package managers in
+    parallel, printing output of each after a marker line with exit code
+    """
+    lines = []
+    for manager in managers:
+        entrypoint, args = PACKAGE_MANAGERS[manager]
+        lines.append(
+            "({0} {1} > /tmp/{2}.out 2>&1; echo $? > /tmp/{2}.rc) &".format(
+                entrypoint, args, manager))
+    lines.append("wait")
+    lines.append(
+        'for m in {}; do echo "{}$m $(cat /tmp/$m.rc)"; '
+        'cat /tmp/$m.out; done'.format(" ".join(managers), PROBE_MARKER))
+    return "\n".join(lines)
+
+
+def split_probe_output(response):
+    """
+    Split probe output into {manager: (output, exit code)}
+    """
+    sections = {}
+    manager = None
+    for line in response.splitlines(True):
+        if line.startswith(PROBE_MARKER):
+            fields = line[len(PROBE_MARKER):].split()
+            manager = fields[0]
+            exit_code = int(fields[1]) \
+                if len(fields) > 1 and fields[1].isdigit() else None
+            sections[manager] = ([], exit_code)
+        elif manager:
+            sections[manager][0].append(line)
+    return dict((manager, ("".join(lines), exit_code))
+                for manager, (lines, exit_code) in sections.items())
+
+
+def probe_updates(managers):
+    """
+    Check updates of given package managers at once, in parallel in a
+    single container of image. Results of all package managers are given,
+    package managers not checked are reported as not found.
+    """
+    json_out = template_json_data("all")
+    json_out["Scan Results"] = {}
+    json_out["Exit Code"] = {}
+
+    sections = {}
+    if managers:
+        response, _ = create_container(
+            client, IMAGE_NAME, ep="/bin/sh",
+            cmd=["-c", probe_script(managers)])
+        sections = split_probe_output(response)
+        # image without shell, check package managers one by one
+        if not sections:
+            for manager in managers:
+                sections[manager] = create_container(
+                    client, IMAGE_NAME, ep=PACKAGE_MANAGERS[manager][0],
+                    cmd=PACKAGE_MANAGERS[manager][1])
+
+    for manager in PACKAGE_MANAGERS_ORDER:
+        response, exit_code = sections.get(manager, ("", None))
+        results, successful, summary = manager_results(
+            manager, response, exit_code)
+        json_out["Scan Results"]["{} package updates".format(manager)] = \
+            results
+        json_out["Exit Code"][manager] = exit_code
+        json_out["Summary"] += summary
+        json_out["Successful"] = json_out["Successful"] or successful
+
+    json_out["Finished Time"] = \
+        datetime.now().strftime('%Y-%m-%d-%H-%M-%S-%f')
+    return json_out
+
+
+if cli_arg == "all":
+    # package managers found in image by scanning runner, all if not given
+    managers = image_fact("PACKAGE_MANAGERS")
+    managers = managers.split() if managers is not None \
+        else PACKAGE_MANAGERS_ORDER
+    json_out = probe_updates(
+        [m for m in managers if m in PACKAGE_MANAGERS])
+else:
+    json_out = check_updates(cli_arg)
 
 
 output_dir = os.path.join(OUTDIR, UUID)
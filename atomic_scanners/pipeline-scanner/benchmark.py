@@ -0,0 +1,46 @@
+# Benchmark of yum check-update output parser
+#
+# Parses generated yum check-update outputs of growing size, time taken
+# should grow linearly with the number of updates.
+#
+# Usage: python benchmark.py [max updates]
+
+import sys
+import time
+
+from scanner import ScanImageRootfs
+
+
+def check_update_output(count):
+    """
+    Returns yum check-update output listing count updates, with wrapped
+    entries and an obsoleting section
+    """
+    lines = []
+    for i in range(count):
+        if i % 10 == 0:
+            # names longer than terminal width wrap the entry
+            lines.append("package-with-a-very-long-name-%d.x86_64" % i)
+            lines.append("                  1.%d-1.el7          updates" % i)
+        else:
+            lines.append("package-%d.noarch    1.0-1.el7    base" % i)
+    lines.append("Obsoleting Packages")
+    for i in range(0, count, 100):
+        lines.append("package-%d.x86_64    1.%d-1.el7    updates" % (i, i))
+        lines.append("    old-package-%d.x86_64    1.0-1.el7    @base" % i)
+    return "\n".join(lines) + "\n"
+
+
+def main(max_count):
+    count = 1000
+    while count <= max_count:
+        data = check_update_output(count)
+        start = time.time()
+        updates = ScanImageRootfs.parse_yum_check_update(data)
+        duration = time.time() - start
+        print "%8d updates parsed in %.3fs" % (len(updates), duration)
+        count *= 10
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -1,17 +1,41 @@
 #!/usr/bin/python
 
+import glob
 import json
 import logging
 import os
+import shutil
 import sys
 import subprocess
+import tempfile
 
 from datetime import datetime
 
+import update_index
+
 # variables based on the `atomic scan` defaults
 INDIR = "/scanin"
 OUTDIR = "/scanout"
 
+# repo metadata cache shared by scans, mounted read-only from scan host, and
+# repo configs to refresh the cache from instead of configs of scanner image,
+# e.g. of a local mirror
+YUM_CACHE = "/yum-cache"
+YUM_CACHE_REPOS = "/yum-repos"
+# number of refreshed caches kept, scans could be using the previous one
+YUM_CACHES_KEPT = 2
+
+# paths of image rootfs needed by yum to check updates, copied to a writable
+# installroot as image rootfs is mounted read-only
+YUM_INSTALLROOT_PATHS = [
+    "var/lib/rpm",
+    "etc/yum.conf",
+    "etc/yum.repos.d",
+    "etc/yum",
+    "etc/pki",
+    "etc/os-release",
+]
+
 # set up logging
 logger = logging.getLogger("container-pipeline")
 logger.setLevel(logging.DEBUG)
@@ -24,10 +48,48 @@ formatter = logging.Formatter(
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
-# atomic scan will mount container's image onto a rootfs and expose rootfs to
-# scanner under the /scanin directory
-dirs = [_dir for _dir in os.listdir(INDIR) if
-        os.path.isdir(os.path.join(INDIR, _dir))]
+
+def make_yum_cache():
+    """
+    Refresh the repo metadata cache shared by scans. Metadata is downloaded
+    to a new dir which then replaces the current one, so scans never see
+    partially downloaded metadata.
+    """
+    name = datetime.now().strftime('%Y%m%d%H%M%S')
+    cmd = ["yum", "-q", "makecache", "fast",
+           "--setopt=cachedir=%s/$basearch/$releasever" % os.path.join(
+               YUM_CACHE, name)]
+    reposdir = "/etc/yum.repos.d"
+    if os.path.isdir(YUM_CACHE_REPOS) and \
+            [f for f in os.listdir(YUM_CACHE_REPOS) if f.endswith(".repo")]:
+        reposdir = YUM_CACHE_REPOS
+        cmd.append("--setopt=reposdir=%s" % YUM_CACHE_REPOS)
+
+    logger.info("Refreshing repo metadata cache %s" % name)
+    if subprocess.call(cmd) != 0:
+        logger.error("Failed to refresh repo metadata cache.")
+        shutil.rmtree(os.path.join(YUM_CACHE, name), ignore_errors=True)
+        return False
+
+    # index repo metadata for calculating updates without yum
+    for cachedir in glob.glob(os.path.join(YUM_CACHE, name, "*", "*")):
+        try:
+            update_index.build_index(cachedir, reposdir)
+        except Exception as e:
+            logger.error("Failed to index repo metadata of %s. %s" % (
+                cachedir, e))
+
+    # switch current cache atomically
+    current = os.path.join(YUM_CACHE, "current")
+    if os.path.lexists(current + ".new"):
+        os.remove(current + ".new")
+    os.symlink(name, current + ".new")
+    os.rename(current + ".new", current)
+
+    caches = sorted(d for d in os.listdir(YUM_CACHE) if d.isdigit())
+    for old in caches[:-YUM_CACHES_KEPT]:
+        shutil.rmtree(os.path.join(YUM_CACHE, old), ignore_errors=True)
+    return True
 
 
 def template_json_data(scan_type, uuid, scanner):
@@ -55,6 +117,8 @@ class ScanImageRootfs(object):
         self.out_path = os.path.join(OUTDIR, path)
         self.image = path
         self.pretty_name = None
+        # variables of /etc/os-release of image, read by scan_release
+        self.os_release = {}
 
         # output file for the scan results
         op_file = "pipeline_scanner_results.json"
@@ -87,17 +151,108 @@ class ScanImageRootfs(object):
             if split_var[0] != "":
                 env_vars_dict[split_var[0]] = split_var[1][1:-1]
 
+        self.os_release = env_vars_dict
         self.json_out["Scan Results"]["OS Release"] = \
             env_vars_dict["PRETTY_NAME"]
 
+    def prepare_installroot(self):
+        """
+        Copy rpmdb and yum configs of image rootfs to a writable temporary
+        installroot for yum, returns path of installroot
+        """
+        installroot = tempfile.mkdtemp(prefix="installroot-")
+        for path in YUM_INSTALLROOT_PATHS:
+            src = os.path.join(self.in_path, path)
+            dest = os.path.join(installroot, path)
+            if not os.path.exists(src):
+                continue
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            if os.path.isdir(src):
+                shutil.copytree(src, dest, symlinks=True)
+            else:
+                shutil.copy2(src, dest)
+        return installroot
+
+    def link_yum_cache(self, installroot):
+        """
+        Link the shared repo metadata cache as yum cache dir of installroot,
+        returns False if there is no shared cache
+        """
+        current = os.path.join(YUM_CACHE, "current")
+        if not os.path.isdir(current):
+            return False
+        cachedir = os.path.join(installroot, "var/cache")
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        # pin the cache, it could be refreshed while yum runs
+        os.symlink(os.path.realpath(current), os.path.join(cachedir, "yum"))
+        return True
+
+    def check_update(self, shared_cache):
+        """
+        Run yum check-update against rpmdb of image, with repo metadata from
+        shared cache only, if shared_cache is set. Returns tuple of
+        (exit code, output, error), None if there is no shared cache.
+        """
+        installroot = self.prepare_installroot()
+        cmd = ['yum', '-q', 'check-update', '--installroot=%s' % installroot]
+        try:
+            if shared_cache:
+                if not self.link_yum_cache(installroot):
+                    return None
+                cmd.insert(1, '-C')
+            process = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            resp, err = process.communicate()
+        finally:
+            shutil.rmtree(installroot, ignore_errors=True)
+        return process.returncode, resp, err
+
+    def calculate_updates(self):
+        """
+        Calculate updates offline from index of the shared repo metadata
+        cache, returns None if updates can not be calculated offline
+        """
+        current = os.path.join(YUM_CACHE, "current")
+        if not os.path.isdir(current):
+            return None
+        # rpmdb is read from a copy, image rootfs is mounted read-only
+        installroot = self.prepare_installroot()
+        try:
+            # pin the cache, it could be refreshed while updates are
+            # calculated
+            return update_index.calculate_updates(
+                os.path.realpath(current), self.in_path, installroot,
+                self.os_release.get("VERSION_ID", ""))
+        except Exception as e:
+            logger.warning("Failed to calculate updates offline. %s" % e)
+            return None
+        finally:
+            shutil.rmtree(installroot, ignore_errors=True)
+
     def scan_yum_update(self):
+        updates = self.calculate_updates()
+        if updates is not None:
+            self.json_out["Successful"] = True
+            if updates:
+                self.json_out["Summary"] = \
+                    "RPM updates available for the image."
+            else:
+                self.json_out["Summary"] = "No RPM updates available."
+            self.json_out['Scan Results']['Package Updates'] = updates
+            return
+
         # check update by switching to image's rootfs
-        process = subprocess.Popen([
-            'yum', '-q', 'check-update', '--installroot=%s' % self.in_path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        resp, err = process.communicate()
+        result = self.check_update(shared_cache=True)
+        # exit code is 100 if updates are available, 0 if not. Shared cache
+        # could miss metadata of repos configured in image, download it then
+        if result is None or result[0] not in (0, 100):
+            result = self.check_update(shared_cache=False)
+        _, resp, err = result
 
         # initialize the response as list
         updates = []
@@ -124,17 +279,67 @@ class ScanImageRootfs(object):
 
         self.json_out['Scan Results']['Package Updates'] = updates
 
-    def parse_yum_check_update(self, data):
-        resp = []
-
-        # `data` will be str. Create a list
-        ldata = data.split()
-
-        for i in ldata:
-            if ldata.index(i) % 3 == 0:
-                resp.append(i)
+    @staticmethod
+    def parse_yum_check_update(data):
+        """
+        Parse output of yum check-update into update records of name, arch,
+        available version and repo, in a single pass over lines.
 
-        return resp
+        Entries longer than terminal width are wrapped after the package
+        name. Packages under "Obsoleting Packages" are followed by indented
+        entries of packages they obsolete, recorded as obsoletes of update.
+        """
+        updates = []
+        # update records by name.arch, to add obsoletes to
+        by_package = {}
+        obsoleting = False
+        # fields of entry wrapped over lines, and if entry is indented
+        fields = []
+        indented = False
+        # last update entry, obsoleted packages follow entry of update
+        update = None
+
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            if line.startswith("Obsoleting Packages"):
+                obsoleting = True
+                fields = []
+                continue
+
+            if not fields:
+                indented = line[0].isspace()
+            fields.extend(line.split())
+            if len(fields) < 3:
+                continue
+            if len(fields) > 3:
+                # not an update entry, e.g. security notices
+                fields = []
+                continue
+
+            package, version, repo = fields
+            fields = []
+            name, _, arch = package.rpartition(".")
+
+            # indented entries of obsoleting section are obsoleted packages
+            if obsoleting and indented:
+                if update is not None:
+                    update.setdefault("obsoletes", []).append(
+                        "%s %s" % (package, version))
+                continue
+
+            update = by_package.get(package)
+            if update is None:
+                update = {
+                    "name": name,
+                    "arch": arch,
+                    "available": version,
+                    "repo": repo,
+                }
+                by_package[package] = update
+                updates.append(update)
+
+        return updates
 
     def write_json_data(self):
         # make directory to write to
@@ -150,32 +355,46 @@ class ScanImageRootfs(object):
         return self.json_out["Scan Results"]["OS Release"]
 
 
-for d in dirs:
-    # First the image scan
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "makecache":
+        sys.exit(0 if make_yum_cache() else 1)
+
+    # atomic scan will mount container's image onto a rootfs and expose
+    # rootfs to scanner under the /scanin directory
+    dirs = [_dir for _dir in os.listdir(INDIR) if
+            os.path.isdir(os.path.join(INDIR, _dir))]
+
+    for d in dirs:
+        # First the image scan
+
+        # Initiate image scan object
+        image_scan = ScanImageRootfs(d)
+
+        # Check the release of image we're scanning
+        image_scan.scan_release()
 
-    # Initiate image scan object
-    image_scan = ScanImageRootfs(d)
+        # Check for yum updates
+        image_scan.scan_yum_update()
 
-    # Check the release of image we're scanning
-    image_scan.scan_release()
+        # Write scan results to json file
+        image_scan.write_json_data()
 
-    # Check for yum updates
-    image_scan.scan_yum_update()
+        # Before we move to container scan
 
-    # Write scan results to json file
-    image_scan.write_json_data()
+        # Check if the image is based on CentOS
+        # os_release = image_scan.return_os_release()
 
-    # Before we move to container scan
+        # if "CentOS Linux" not in os_release:
+        #     print "Sorry, we can't help you scan non CentOS images at " \
+        #         "this point"
+        #     sys.exit(1)
 
-    # Check if the image is based on CentOS
-    # os_release = image_scan.return_os_release()
+        # container_scan = ScanImageContainer(d)
 
-    # if "CentOS Linux" not in os_release:
-    #     print "Sorry, we can't help you scan non CentOS images at this point"
-    #     sys.exit(1)
+        # container_scan.create_and_run_container()
+        # container_scan.check_yum_update()
+        # container_scan.write_json_data()
 
-    # container_scan = ScanImageContainer(d)
 
-    # container_scan.create_and_run_container()
-    # container_scan.check_yum_update()
-    # container_scan.write_json_data()
+if __name__ == "__main__":
+    main()
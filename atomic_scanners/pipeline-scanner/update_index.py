@@ -0,0 +1,299 @@
+# Offline package update calculator
+#
+# Repo metadata in the shared yum cache is indexed once per refresh, into
+# the latest version of every package name and arch per repo. Repos are
+# indexed by their source, basearch and baseurl, mirrorlist or metalink, as
+# repos of images could share repo IDs with different sources. Updates of an
+# image are then calculated by comparing its installed packages against the
+# index in process, without running yum.
+
+import bz2
+import ConfigParser
+import fnmatch
+import glob
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+
+try:
+    import rpm
+except ImportError:
+    rpm = None
+
+# name of the index file, kept next to repo dirs of a yum cache dir
+INDEX_FILE = "update-index.json"
+
+# options of repo config naming source of repo, by preference
+REPO_SOURCE_OPTIONS = ("baseurl", "mirrorlist", "metalink")
+
+
+def evr_string(epoch, version, release):
+    """
+    Returns epoch:version-release string, epoch is left out if zero
+    """
+    evr = "%s-%s" % (version, release)
+    if epoch and str(epoch) != "0":
+        evr = "%s:%s" % (epoch, evr)
+    return evr
+
+
+def parse_evr(evr):
+    """
+    Returns (epoch, version, release) tuple of evr string
+    """
+    epoch, _, vr = evr.rpartition(":")
+    version, _, release = vr.rpartition("-")
+    return (epoch or "0", version, release)
+
+
+def newer(evr, other):
+    """
+    Returns True if evr string is newer than other evr string
+    """
+    return rpm.labelCompare(parse_evr(evr), parse_evr(other)) > 0
+
+
+def primary_db(repo_dir):
+    """
+    Returns path of primary sqlite db of repo cache dir and whether it is a
+    temporary decompressed copy, path is None if there is none
+    """
+    path = os.path.join(repo_dir, "gen", "primary_db.sqlite")
+    if os.path.isfile(path):
+        return path, False
+    for path in glob.glob(os.path.join(repo_dir, "*primary.sqlite.bz2")):
+        fd, tmp_path = tempfile.mkstemp(suffix=".sqlite")
+        with os.fdopen(fd, "wb") as fout:
+            fin = bz2.BZ2File(path)
+            shutil.copyfileobj(fin, fout)
+            fin.close()
+        return tmp_path, True
+    return None, False
+
+
+def index_repo(repo_dir):
+    """
+    Returns latest versions of packages in repo, {"name arch": evr}
+    """
+    path, temporary = primary_db(repo_dir)
+    if not path:
+        return None
+    latest = {}
+    try:
+        conn = sqlite3.connect(path)
+        rows = conn.execute(
+            "SELECT name, arch, epoch, version, release FROM packages")
+        for name, arch, epoch, version, release in rows:
+            key = "%s %s" % (name, arch)
+            evr = evr_string(epoch, version, release)
+            if key not in latest or newer(evr, latest[key]):
+                latest[key] = evr
+        conn.close()
+    finally:
+        if temporary:
+            os.remove(path)
+    return latest
+
+
+def yum_vars(varsdir, basearch, releasever):
+    """
+    Returns variables of yum configs, from files of given yum vars dir
+    """
+    variables = {"basearch": basearch, "arch": basearch,
+                 "releasever": releasever}
+    for path in glob.glob(os.path.join(varsdir, "*")):
+        try:
+            with open(path) as fin:
+                variables[os.path.basename(path)] = fin.readline().strip()
+        except IOError:
+            continue
+    return variables
+
+
+def repo_source(config, repo, variables):
+    """
+    Returns source of repo in given repo config, "basearch url" of its first
+    baseurl, or its mirrorlist or metalink, with yum variables expanded.
+    None if repo has no source.
+    """
+    for option in REPO_SOURCE_OPTIONS:
+        if not config.has_option(repo, option):
+            continue
+        urls = config.get(repo, option).replace(",", " ").split()
+        if not urls:
+            continue
+        url = re.sub(
+            r"\$(\w+)|\$\{(\w+)\}",
+            lambda m: variables.get(m.group(1) or m.group(2), m.group(0)),
+            urls[0])
+        return "%s %s" % (variables["basearch"], url.rstrip("/"))
+    return None
+
+
+def repo_configs(reposdir):
+    """
+    Returns config of repo files in given repos dir
+    """
+    config = ConfigParser.RawConfigParser()
+    config.read(glob.glob(os.path.join(reposdir, "*.repo")))
+    return config
+
+
+def build_index(cachedir, reposdir, varsdir="/etc/yum/vars"):
+    """
+    Index repos cached in yum cache dir, of a basearch and releasever, as
+    configured in given repos dir. Index is written to INDEX_FILE in
+    cachedir, {repo source: latest versions of packages}.
+    """
+    releasever = os.path.basename(cachedir.rstrip("/"))
+    basearch = os.path.basename(os.path.dirname(cachedir.rstrip("/")))
+    variables = yum_vars(varsdir, basearch, releasever)
+    config = repo_configs(reposdir)
+
+    index = {}
+    for repo in os.listdir(cachedir):
+        repo_dir = os.path.join(cachedir, repo)
+        if not os.path.isfile(os.path.join(repo_dir, "repomd.xml")):
+            continue
+        if not config.has_section(repo):
+            continue
+        source = repo_source(config, repo, variables)
+        latest = index_repo(repo_dir)
+        if source and latest is not None:
+            index[source] = latest
+    with open(os.path.join(cachedir, INDEX_FILE), "w") as fout:
+        json.dump(index, fout)
+    return index
+
+
+def load_index(cache_root):
+    """
+    Returns index of all yum cache dirs under given root of yum cache
+    """
+    index = {}
+    for path in glob.glob(os.path.join(cache_root, "*", "*", INDEX_FILE)):
+        with open(path) as fin:
+            index.update(json.load(fin))
+    return index
+
+
+def enabled_repos(rootfs, basearch, releasever):
+    """
+    Returns repos enabled in yum configs of image rootfs,
+    {repo id: (repo source, exclude patterns)}, with global excludes of
+    yum.conf
+    """
+    def excludes(config, section):
+        if not config.has_option(section, "exclude"):
+            return []
+        return config.get(section, "exclude").replace(",", " ").split()
+
+    yum_conf = ConfigParser.RawConfigParser()
+    yum_conf.read(os.path.join(rootfs, "etc/yum.conf"))
+    global_excludes = excludes(yum_conf, "main") \
+        if yum_conf.has_section("main") else []
+
+    variables = yum_vars(
+        os.path.join(rootfs, "etc/yum/vars"), basearch, releasever)
+    config = repo_configs(os.path.join(rootfs, "etc/yum.repos.d"))
+    repos = {}
+    for repo in config.sections():
+        if config.has_option(repo, "enabled") and \
+                config.get(repo, "enabled").strip() in ("0", "false", "no"):
+            continue
+        repos[repo] = (repo_source(config, repo, variables),
+                       global_excludes + excludes(config, repo))
+    return repos
+
+
+def basearch_of(packages):
+    """
+    Returns basearch of image, of the most common arch of its installed
+    (name, arch, evr) packages, None if all are noarch
+    """
+    counts = {}
+    for _, arch, _ in packages:
+        if arch != "noarch":
+            counts[arch] = counts.get(arch, 0) + 1
+    if not counts:
+        return None
+    arch = max(sorted(counts), key=counts.get)
+    if re.match(r"^i\d86$", arch):
+        return "i386"
+    if arch.startswith("armv7"):
+        return "armhfp"
+    return arch
+
+
+def installed_packages(root):
+    """
+    Returns (name, arch, evr) of packages installed in rpmdb under root
+    """
+    ts = rpm.TransactionSet(root)
+    ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES | rpm._RPMVSF_NODIGESTS)
+    packages = []
+    for header in ts.dbMatch():
+        # gpg-pubkey entries are not packages
+        if header[rpm.RPMTAG_ARCH] is None:
+            continue
+        packages.append((
+            header[rpm.RPMTAG_NAME],
+            header[rpm.RPMTAG_ARCH],
+            evr_string(header[rpm.RPMTAG_EPOCH] or 0,
+                       header[rpm.RPMTAG_VERSION],
+                       header[rpm.RPMTAG_RELEASE])))
+    ts.closeDB()
+    return packages
+
+
+def calculate_updates(cache_root, rootfs, rpmdb_root, releasever):
+    """
+    Calculate available updates of image from index of yum cache dirs under
+    given root of yum cache. rootfs is image rootfs to read yum configs from
+    and rpmdb_root a root with rpmdb of image. Repos of image are matched by
+    source, expanded with basearch of image and given releasever. Returns
+    list of update records, None if updates can not be calculated offline,
+    as not every enabled repo is indexed.
+    """
+    if rpm is None:
+        return None
+    try:
+        index = load_index(cache_root)
+    except (IOError, ValueError):
+        return None
+
+    packages = installed_packages(rpmdb_root)
+    basearch = basearch_of(packages)
+    if not basearch:
+        return None
+    try:
+        repos = enabled_repos(rootfs, basearch, releasever)
+    except ConfigParser.Error:
+        return None
+    if not repos or [repo for repo, (source, _) in repos.items()
+                     if source not in index]:
+        return None
+
+    updates = []
+    for name, arch, evr in packages:
+        key = "%s %s" % (name, arch)
+        available, available_repo = evr, None
+        for repo, (source, exclude) in repos.items():
+            candidate = index[source].get(key)
+            if not candidate or not newer(candidate, available):
+                continue
+            if [p for p in exclude if fnmatch.fnmatch(name, p)]:
+                continue
+            available, available_repo = candidate, repo
+        if available_repo:
+            updates.append({
+                "name": name,
+                "arch": arch,
+                "current": evr,
+                "available": available,
+                "repo": available_repo,
+            })
+    return sorted(updates, key=lambda update: update["name"])
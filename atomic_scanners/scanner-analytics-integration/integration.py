@@ -9,6 +9,13 @@ import os
 import requests
 import subprocess
 import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    from urllib3.util.retry import Retry
 
 
 OUTDIR = "/scanout"
@@ -18,9 +25,52 @@ TOKEN = open("osio_token.txt").read().strip()
 
 HEADERS = {
     "content-type": "application/json",
-    "Authorization": "Bearer {}".format(TOKEN)
+    "Authorization": "Bearer {}".format(TOKEN),
+    "Accept-Encoding": "gzip, deflate",
 }
 
+# seconds to wait for connecting to and for response of analytics server
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+# retries on connection errors and server errors, waiting
+# BACKOFF_FACTOR * 2 ^ (retry - 1) seconds between retries
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 2
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+# connections kept alive to analytics server
+POOL_SIZE = 4
+
+# bulk register mode registers unique (git-url, git-sha) pairs of a batch,
+# in chunks of BULK_CHUNK_SIZE pairs registered by BULK_WORKERS threads
+BULK_CHUNK_SIZE = 50
+BULK_WORKERS = POOL_SIZE
+# input and output files of bulk register mode, in given batch dir
+BULK_PAIRS_FILE = "pairs.json"
+BULK_RESULTS_FILE = "results.json"
+
+
+def make_session():
+    """
+    Returns HTTP session keeping connections to server alive across API
+    calls, retrying failed calls with backoff
+    """
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        method_whitelist=frozenset(["GET", "POST"]))
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE,
+        max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(HEADERS)
+    return session
+
+
+SESSION = make_session()
+
 
 def configure_logging(name="integration-scanner"):
     """
@@ -77,13 +127,40 @@ def run_command(cmd, shell=True):
         return subprocess.check_output(cmd.split(), shell=False)
 
 
-def post_request(endpoint, api, data):
+def timed_request(method, url, calls=None, **kwargs):
+    """
+    Make a request using the shared session, with timeouts. Latency of the
+    call, including retries, is appended to calls list, if given.
+
+    :return: response
+    :raises: requests.exceptions.RequestException
+    """
+    start = time.time()
+    call = {"method": method, "url": url, "status_code": 0}
+    try:
+        r = SESSION.request(
+            method, url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
+        call["status_code"] = r.status_code
+        return r
+    except requests.exceptions.RequestException as e:
+        call["error"] = str(e)
+        call["connection_error"] = isinstance(
+            e, requests.exceptions.ConnectionError)
+        raise
+    finally:
+        call["latency"] = round(time.time() - start, 3)
+        if calls is not None:
+            calls.append(call)
+
+
+def post_request(endpoint, api, data, calls=None):
     """
     Make a post call to analytics server with given data
 
     :param endpoint: API server end point
     :param api: API to make POST call against
     :param data: JSON data needed for POST call to api endpoint
+    :param calls: List to record latency of the call in
 
     :return: Tuple (status, error_if_any, status_code)
              where status = True/False
@@ -93,10 +170,7 @@ def post_request(endpoint, api, data):
     url = urljoin(endpoint, api)
     # TODO: check if we need API key in data
     try:
-        r = requests.post(
-            url,
-            json.dumps(data),
-            headers=HEADERS)
+        r = timed_request("POST", url, calls, data=json.dumps(data))
     except requests.exceptions.RequestException as e:
         error = ("Could not send POST request to URL {0}, "
                  "with data: {1}.").format(url, str(data))
@@ -110,13 +184,14 @@ def post_request(endpoint, api, data):
                 r.status_code, url), r.status_code
 
 
-def get_request(endpoint, api, data):
+def get_request(endpoint, api, data, calls=None):
     """
     Make a get call to analytics server
 
     :param endpoint: API server end point
     :param api: API to make GET call against
     :param data: JSON data needed for GET call
+    :param calls: List to record latency of the call in
 
     :return: Tuple (status, error_if_any, status_code)
              where status = True/False
@@ -126,10 +201,7 @@ def get_request(endpoint, api, data):
     url = urljoin(endpoint, api)
     # TODO: check if we need API key in data
     try:
-        r = requests.get(
-            url,
-            params=data,
-            headers=HEADERS)
+        r = timed_request("GET", url, calls, params=data)
 
     except requests.exceptions.RequestException as e:
         error = "Failed to process URL: {} with params {}".format(
@@ -168,6 +240,8 @@ class AnalyticsIntegration(object):
         self.git_sha = None
         self.errors = []
         self.failure = True
+        # API calls made, with their latency
+        self.api_calls = []
         # the needed data to be logged in scanner output
         self.data = {}
         # the templated data this scanner will export
@@ -252,7 +326,8 @@ class AnalyticsIntegration(object):
 
         status, resp, s_code = post_request(endpoint=self.server,
                                             api=self.api,
-                                            data=request_data)
+                                            data=request_data,
+                                            calls=self.api_calls)
         if not status:
             self.failure = True
             self.record_fatal_error(resp)
@@ -270,7 +345,8 @@ class AnalyticsIntegration(object):
 
         status, resp, s_code = get_request(endpoint=self.server,
                                            api=self.api,
-                                           data=request_data)
+                                           data=request_data,
+                                           calls=self.api_calls)
         if not status:
             self.failure = True
             self.record_fatal_error(resp)
@@ -291,6 +367,7 @@ class AnalyticsIntegration(object):
         self.json_out["api"] = self.api
         self.json_out["api_data"] = self.data
         self.json_out["api_status_code"] = status_code or 0
+        self.json_out["api_calls"] = self.api_calls
         return False, self.json_out
 
     def return_on_success(self, resp, status_code):
@@ -312,6 +389,7 @@ class AnalyticsIntegration(object):
         self.json_out["api"] = self.api
         self.json_out["api_data"] = self.data
         self.json_out["api_status_code"] = status_code
+        self.json_out["api_calls"] = self.api_calls
         return True, self.json_out
 
 
@@ -362,8 +440,151 @@ class Scanner(object):
             json.dump(output, f, indent=4, separators=(",", ": "))
 
 
+def unique_pairs(pairs):
+    """
+    Returns given (git-url, git-sha) pairs without duplicates and incomplete
+    pairs, in given order. Pairs are normalized by registry of scan host.
+    """
+    seen = set()
+    unique = []
+    for pair in pairs:
+        pair = tuple(pair)
+        if not all(pair) or pair in seen:
+            continue
+        seen.add(pair)
+        unique.append(pair)
+    return unique
+
+
+def register_pair(endpoint, pair):
+    """
+    Register a (git-url, git-sha) pair at analytics server, returns record
+    of registration in the format of register scan output
+    """
+    api = "/api/v1/register"
+    data = {"git-url": pair[0], "git-sha": pair[1]}
+    calls = []
+    try:
+        status, resp, s_code = post_request(endpoint, api, data, calls)
+    except ValueError as e:
+        status, resp, s_code = False, "Invalid response. {}".format(e), 0
+
+    record = {
+        "Scan Type": "register",
+        "Successful": status,
+        "api": api,
+        "api_data": data,
+        "api_status_code": s_code or 0,
+        "api_calls": calls,
+    }
+    if status:
+        record["Scan Results"] = resp
+        record["Summary"] = resp.get(
+            "summary", "Check detailed report for more info.")
+    else:
+        record["Summary"] = "{} API failed. Error: {}".format(api, [resp])
+    return record
+
+
+def unreachable(record):
+    """
+    Returns True if server could not be connected to for registration of
+    given record, False if it failed otherwise, e.g. with server errors
+    """
+    calls = record.get("api_calls") or []
+    return bool(calls) and all(
+        call.get("connection_error") for call in calls)
+
+
+def bulk_register(endpoint, pairs, chunk_size=BULK_CHUNK_SIZE,
+                  workers=BULK_WORKERS):
+    """
+    Register unique pairs of given (git-url, git-sha) pairs at analytics
+    server, in chunks registered concurrently. Registration stops if server
+    could not be connected to for any pair of a chunk.
+
+    :return: List of registration records of pairs attempted
+    """
+    pairs = unique_pairs(pairs)
+    logger = logging.getLogger("integration-scanner")
+    pool = ThreadPool(workers)
+    records = []
+    try:
+        for start in range(0, len(pairs), chunk_size):
+            chunk = pairs[start:start + chunk_size]
+            chunk_records = pool.map(
+                lambda pair: register_pair(endpoint, pair), chunk)
+            records.extend(chunk_records)
+            logger.info("Registered {} of {} pairs".format(
+                len(records), len(pairs)))
+            if not [record for record in chunk_records
+                    if not unreachable(record)]:
+                logger.critical(
+                    "Server {} is unreachable, skipping {} pairs".format(
+                        endpoint, len(pairs) - len(records)))
+                break
+    finally:
+        pool.close()
+        pool.join()
+    return records
+
+
+class BulkRegister(object):
+    """
+    Registers (git-url, git-sha) pairs of a batch of images at analytics
+    server, instead of a register scan per image
+    """
+
+    def __init__(self, batch_dir):
+        self.scanner = "scanner-analytics-integration"
+        # dir having BULK_PAIRS_FILE, BULK_RESULTS_FILE is written to it
+        self.batch_dir = batch_dir
+
+    def run(self):
+        """
+        Register pairs of batch, returns tuple (status, json_out)
+        """
+        json_out = {
+            "Start Time": datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f"),
+            "Successful": False,
+            "Scan Type": "bulk-register",
+            "Scanner": self.scanner,
+            "Scan Results": [],
+        }
+        try:
+            server = get_env_var("SERVER")
+            with open(os.path.join(self.batch_dir, BULK_PAIRS_FILE)) as fin:
+                pairs = json.load(fin)
+        except (ValueError, IOError) as e:
+            json_out["Summary"] = "Bulk register failed. Error: {}".format(e)
+            return self.export_results(json_out)
+
+        records = bulk_register(server, pairs)
+        registered = len([r for r in records if r["Successful"]])
+        json_out["Successful"] = registered == len(records)
+        json_out["Scan Results"] = records
+        json_out["Summary"] = \
+            "Registered {} of {} unique pairs, of {} pairs".format(
+                registered, len(unique_pairs(pairs)), len(pairs))
+        return self.export_results(json_out)
+
+    def export_results(self, json_out):
+        """
+        Write result of bulk register to BULK_RESULTS_FILE in batch dir
+        """
+        json_out["Finished Time"] = \
+            datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")
+        print (json_out["Summary"])
+        with open(os.path.join(self.batch_dir, BULK_RESULTS_FILE), "w") as f:
+            json.dump(json_out, f, indent=4, separators=(",", ": "))
+        return json_out["Successful"], json_out
+
+
 if __name__ == "__main__":
     configure_logging()
     command = sys.argv[1]
-    scanner = Scanner(scan_type=command)
-    scanner.run()
+    if command == "bulk-register":
+        BulkRegister(sys.argv[2]).run()
+    else:
+        scanner = Scanner(scan_type=command)
+        scanner.run()
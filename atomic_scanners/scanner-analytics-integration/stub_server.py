@@ -0,0 +1,161 @@
+#!/usr/bin/env python2
+# Local stand-in for analytics server
+#
+# Serves the register and report APIs used by the scanner, with configurable
+# latency and failure rate, so registration can be load tested offline.
+# Counts of requests are served as JSON at /stats.
+#
+# Usage: python stub_server.py [--port 8080] [--latency 0.2]
+#                              [--error-rate 0.05]
+
+import argparse
+import json
+import random
+import threading
+import time
+import urlparse
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class Stats(object):
+    """
+    Requests served by stub server, shared by request threads
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.errors = 0
+        # registered (git-url, git-sha) pairs => times registered
+        self.registered = {}
+
+    def count(self, api, error=False):
+        with self.lock:
+            self.requests[api] = self.requests.get(api, 0) + 1
+            if error:
+                self.errors += 1
+
+    def register(self, pair):
+        with self.lock:
+            self.registered[pair] = self.registered.get(pair, 0) + 1
+
+    def to_json(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "registered_pairs": len(self.registered),
+                "duplicate_registrations": sum(
+                    count - 1 for count in self.registered.values()),
+            }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Handles register, report and stats requests
+    """
+    # keep connections alive, as the analytics server does
+    protocol_version = "HTTP/1.1"
+
+    def respond(self, status_code, data):
+        body = json.dumps(data)
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def simulate(self, api):
+        """
+        Wait for configured latency, returns True if request should fail
+        """
+        time.sleep(self.server.latency)
+        failed = random.random() < self.server.error_rate
+        self.server.stats.count(api, failed)
+        if failed:
+            self.respond(503, {"error": "Service unavailable"})
+        return failed
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        length = int(self.headers.getheader("Content-Length") or 0)
+        body = self.rfile.read(length)
+        if url.path != "/api/v1/register":
+            self.respond(404, {"error": "Not found"})
+            return
+        if self.simulate(url.path):
+            return
+        try:
+            data = json.loads(body)
+            pair = (data["git-url"], data["git-sha"])
+        except (ValueError, KeyError, TypeError):
+            self.respond(400, {"error": "git-url and git-sha are required"})
+            return
+        self.server.stats.register(pair)
+        self.respond(200, {
+            "git-url": pair[0],
+            "git-sha": pair[1],
+            "summary": "Registered for analysis.",
+        })
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == "/stats":
+            self.respond(200, self.server.stats.to_json())
+            return
+        if url.path != "/api/v1/report":
+            self.respond(404, {"error": "Not found"})
+            return
+        if self.simulate(url.path):
+            return
+        params = urlparse.parse_qs(url.query)
+        pair = (params.get("git-url", [""])[0],
+                params.get("git-sha", [""])[0])
+        if pair not in self.server.stats.registered:
+            self.respond(404, {"summary": "No report found."})
+            return
+        self.respond(200, {
+            "git-url": pair[0],
+            "git-sha": pair[1],
+            "dependencies": [],
+            "summary": "No dependencies with CVEs found.",
+        })
+
+    def log_message(self, format, *args):
+        # request logs would slow down load tests
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency, error_rate):
+        HTTPServer.__init__(self, address, StubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.stats = Stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for analytics server")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="seconds taken per request")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of requests failing with 503")
+    args = parser.parse_args()
+
+    server = StubServer(("127.0.0.1", args.port), args.latency,
+                        args.error_rate)
+    print "Serving stub analytics server on port {}".format(args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print json.dumps(server.stats.to_json(), indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# Benchmark of rpm verify engines
+#
+# Verifies an image rootfs with the rpm command and with the parallel in
+# process engine, reports time taken by each and differences in results.
+#
+# Usage: python benchmark.py <rootfs> [runs]
+
+import sys
+import time
+
+from rpm_verify import RPMVerify
+
+
+def findings(scanner, engine):
+    """
+    Returns time taken and findings of rpm verify test using given engine
+    """
+    start = time.time()
+    out = scanner.verify(engine=engine)
+    duration = time.time() - start
+    return duration, set(
+        (item["issue"], item["filename"], item["rpm"]["RPM"])
+        for item in scanner.process_cmd_output_data(out))
+
+
+def main(rootfs, runs=1):
+    scanner = RPMVerify("benchmark")
+    scanner.in_path = rootfs
+
+    for engine in ("rpm", "parallel"):
+        durations = []
+        for _ in range(runs):
+            duration, result = findings(scanner, engine)
+            durations.append(duration)
+        print "%-10s best %.2fs of %d runs, %d findings" % (
+            engine, min(durations), runs, len(result))
+        if engine == "rpm":
+            expected = result
+        elif result != expected:
+            for item in sorted(expected - result):
+                print "  missing  %s %s (%s)" % item
+            for item in sorted(result - expected):
+                print "  extra    %s %s (%s)" % item
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "Usage: python benchmark.py <rootfs> [runs]"
+        sys.exit(1)
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 1)
@@ -1,12 +1,16 @@
 # Main scanner execution python module
 
 import json
+import logging
 import os
 import re
+import sys
 
 from datetime import datetime
 from subprocess import Popen, PIPE
 
+import verify_engine
+
 # Filter the paths you know the resulting image or base image itself
 # has issue about and need to be filtered
 # out since this is a known issue and it is in progress to get fixed.
@@ -36,10 +40,25 @@ FILTER_DIRS = [
     "/var", "/run", "/media", "/mnt", "/tmp", "/proc", "/sys", "/boot"
 ]
 
+# number of packages or files queried per rpm call
+RPM_QUERY_BATCH = 500
+
 # variables based on the `atomic scan` defaults
 INDIR = "/scanin"
 OUTDIR = "/scanout"
 
+# set up logging
+logger = logging.getLogger("scanner-rpm-verify")
+logger.setLevel(logging.DEBUG)
+
+ch = logging.StreamHandler(sys.stdout)
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
 
 class RPMVerify(object):
     """
@@ -66,6 +85,9 @@ class RPMVerify(object):
             self.scanner
         )
 
+        # metadata of installed packages queried in this run
+        self.rpms_meta = {}
+
     def template_json_data(self, scan_type, uuid, scanner):
         current_time = datetime.now().strftime('%Y-%m-%d-%H-%M-%S-%f')
         json_out = {
@@ -80,12 +102,48 @@ class RPMVerify(object):
         }
         return json_out
 
+    def get_packages(self):
+        """
+        Packages listed in RPM_VERIFY_PACKAGES environment variable, to
+        verify only them, None to verify all installed packages
+        """
+        packages = os.environ.get("RPM_VERIFY_PACKAGES", "")
+        # atomic passes variable name as is, if it is not set on host
+        if packages and not packages.startswith("$"):
+            return packages.split()
+        return None
+
     def get_command(self):
         """
         Command to run the rpm verify test
         """
+        packages = self.get_packages()
+        if packages:
+            return ["/bin/rpm", "--root=%s" % self.in_path, "-V"] + packages
         return ["/bin/rpm", "--root=%s" % self.in_path, "-Va"]
 
+    def verify(self, engine=None):
+        """
+        Run the rpm verify test and return its output. Files are verified
+        in process by parallel workers, if rpm python bindings are
+        available, else by the rpm command.
+        """
+        engine = engine or os.environ.get("RPM_VERIFY_ENGINE", "parallel")
+        if engine == "parallel" and verify_engine.rpm is not None:
+            packages = self.get_packages()
+            try:
+                return verify_engine.verify(
+                    self.in_path,
+                    packages=set(packages) if packages else None,
+                    skip_dirs=tuple(FILTER_DIRS))
+            except Exception as e:
+                # rpm database could not be read by the bindings
+                logger.exception(
+                    "Failed to verify files in process, falling back to "
+                    "rpm -V. {}".format(e))
+        out, _ = self.run_command(self.get_command())
+        return out
+
     def run_command(self, cmd):
         """
         Run command for rpm verify test
@@ -109,6 +167,60 @@ class RPMVerify(object):
                 "BUILDHOST": out[3]
                 }
 
+    def get_meta_of_rpms(self, rpms):
+        """
+        Get metadata of given installed packages, querying all packages not
+        queried before in one rpm call. Returns {rpm: metadata}
+        """
+        qf = "%{NVRA}|%{SIGPGP:pgpsig}|%{VENDOR}|%{PACKAGER}|%{BUILDHOST}\n"
+        new_rpms = sorted(set(
+            rpm for rpm in rpms if rpm and rpm not in self.rpms_meta))
+        for i in range(0, len(new_rpms), RPM_QUERY_BATCH):
+            cmd = ["/bin/rpm", "--root=%s" % self.in_path, "-q", "--qf", qf]
+            out, _ = self.run_command(cmd + new_rpms[i:i + RPM_QUERY_BATCH])
+            for line in out.split("\n"):
+                out = line.split("|")
+                if len(out) != 5:
+                    continue
+                self.rpms_meta[out[0]] = {"RPM": out[0],
+                                          "SIGNATURE": out[1],
+                                          "VENDOR": out[2],
+                                          "PACKAGER": out[3],
+                                          "BUILDHOST": out[4]
+                                          }
+
+        # rpms not named as queried, fall back to querying them one by one
+        for rpm in rpms:
+            if rpm not in self.rpms_meta:
+                self.rpms_meta[rpm] = self.get_meta_of_rpm(rpm)
+        return dict((rpm, self.rpms_meta[rpm]) for rpm in rpms)
+
+    def source_rpms_of_files(self, filepaths):
+        """
+        Find source RPMs of given filepaths, querying them together in one
+        rpm -qf call per batch. Returns {filepath: rpm}
+        """
+        filepaths = sorted(set(filepaths))
+        # rpm -qf gives no owner of missing files
+        rpms = dict((filepath, "") for filepath in filepaths
+                    if not os.path.lexists(self.in_path + filepath))
+        queried = [filepath for filepath in filepaths if filepath not in rpms]
+        for i in range(0, len(queried), RPM_QUERY_BATCH):
+            batch = queried[i:i + RPM_QUERY_BATCH]
+            cmd = ["/bin/rpm", "--root=%s" % self.in_path, "-qf",
+                   "--qf", "%{NVRA}\n"]
+            out, _ = self.run_command(cmd + batch)
+            lines = out.split("\n")[:-1]
+            if len(lines) != len(batch):
+                # file owned by several packages, lines do not match files
+                for filepath in batch:
+                    rpms[filepath] = self.source_rpm_of_file(filepath)
+                continue
+            for filepath, line in zip(batch, lines):
+                # "file ... is not owned by any package"
+                rpms[filepath] = "" if " " in line else line
+        return rpms
+
     def source_rpm_of_file(self, filepath):
         """
         Find source RPM of given filepath
@@ -142,7 +254,7 @@ class RPMVerify(object):
         Process the command output data
         """
         lines = data.split("\n")[:-1]
-        result = []
+        matches = []
         for line in lines:
             line = line.strip()
             if line.startswith("error:"):
@@ -172,22 +284,27 @@ class RPMVerify(object):
             if self.filter_paths_with_known_issues(filepath):
                 continue
 
-            rpm = self.source_rpm_of_file(filepath)
+            matches.append((match, filepath))
+
+        # owners and their metadata are looked up in batch
+        rpms = self.source_rpms_of_files(
+            filepath for _, filepath in matches)
+        meta = self.get_meta_of_rpms(set(rpms.values()))
 
+        result = []
+        for match, filepath in matches:
             result.append({
                 "issue": match.groups()[0],
                 "config": match.groups()[1] == 'c',
                 "filename": match.groups()[2],
-                "rpm": self.get_meta_of_rpm(rpm)})
+                "rpm": meta[rpms[filepath]]})
         return result
 
     def run(self):
         """
         Run the RPM verify test
         """
-        cmd = self.get_command()
-        out, error = self.run_command(cmd)
-        result = []
+        out = self.verify()
         result = self.process_cmd_output_data(out)
         # TODO: since this script is running inside container while we have the
         # logging on host, we should find a better way to log this message back
@@ -0,0 +1,417 @@
+# In process rpm verification engine
+#
+# Reads the rpm database of an image rootfs and verifies files of installed
+# packages in a pool of worker processes. The output is in the format of
+# `rpm -V`, so it can be processed the same way as output of rpm command.
+
+import ctypes
+import hashlib
+import os
+import re
+import stat
+import struct
+
+from multiprocessing import Pool, cpu_count
+
+try:
+    import rpm
+except ImportError:
+    rpm = None
+
+# file attributes, as in rpmfiles.h
+RPMFILE_CONFIG = 1 << 0
+RPMFILE_DOC = 1 << 1
+RPMFILE_MISSINGOK = 1 << 3
+RPMFILE_GHOST = 1 << 6
+RPMFILE_LICENSE = 1 << 7
+RPMFILE_README = 1 << 8
+
+# file states not verified by rpm: not installed, net shared, wrong color
+SKIPPED_FILE_STATES = (2, 3, 4)
+
+# verify flags, as in rpmvf.h
+RPMVERIFY_FILEDIGEST = 1 << 0
+RPMVERIFY_FILESIZE = 1 << 1
+RPMVERIFY_LINKTO = 1 << 2
+RPMVERIFY_USER = 1 << 3
+RPMVERIFY_GROUP = 1 << 4
+RPMVERIFY_MTIME = 1 << 5
+RPMVERIFY_MODE = 1 << 6
+RPMVERIFY_RDEV = 1 << 7
+RPMVERIFY_CAPS = 1 << 8
+RPMVERIFY_ALL = 0xffffffff
+
+# capability names, by capability number, as in linux/capability.h
+CAP_NAMES = [
+    "chown", "dac_override", "dac_read_search", "fowner", "fsetid", "kill",
+    "setgid", "setuid", "setpcap", "linux_immutable", "net_bind_service",
+    "net_broadcast", "net_admin", "net_raw", "ipc_lock", "ipc_owner",
+    "sys_module", "sys_rawio", "sys_chroot", "sys_ptrace", "sys_pacct",
+    "sys_admin", "sys_boot", "sys_nice", "sys_resource", "sys_time",
+    "sys_tty_config", "mknod", "lease", "audit_write", "audit_control",
+    "setfcap", "mac_override", "mac_admin", "syslog", "wake_alarm",
+    "block_suspend", "audit_read", "perfmon", "bpf", "checkpoint_restore",
+]
+
+# file capabilities xattr, as in linux/capability.h
+XATTR_CAPS = "security.capability"
+VFS_CAP_REVISION_MASK = 0xff000000
+VFS_CAP_FLAGS_EFFECTIVE = 0x000001
+# number of 32 bit words per capability set, per xattr revision
+VFS_CAP_U32 = {0x01000000: 1, 0x02000000: 2, 0x03000000: 2}
+
+try:
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.getxattr.restype = ctypes.c_ssize_t
+except (OSError, AttributeError):
+    libc = None
+
+# file digest algorithms, as in rpmpgp.h
+DIGEST_ALGOS = {
+    1: "md5",
+    2: "sha1",
+    8: "sha256",
+    9: "sha384",
+    10: "sha512",
+    11: "sha224",
+}
+
+# results of verification of one file
+RESULT_FAILED = 1
+RESULT_UNKNOWN = 2
+
+# rootfs and its user and group names, set in worker processes
+ROOTFS = None
+USERS = {}
+GROUPS = {}
+
+
+def read_names(path):
+    """
+    Read id to name mapping from passwd or group file at given path
+    """
+    names = {}
+    try:
+        with open(path) as fin:
+            for line in fin:
+                fields = line.strip().split(":")
+                if len(fields) > 2 and fields[2].isdigit():
+                    names.setdefault(int(fields[2]), fields[0])
+    except IOError:
+        pass
+    return names
+
+
+def init_worker(rootfs):
+    """
+    Initialize worker process for verifying files under given rootfs
+    """
+    global ROOTFS, USERS, GROUPS
+    ROOTFS = rootfs
+    # names are looked up in image, not on host running the scanner
+    USERS = read_names(os.path.join(rootfs, "etc/passwd"))
+    GROUPS = read_names(os.path.join(rootfs, "etc/group"))
+
+
+def file_digest(path, algo):
+    """
+    Returns hex digest of file at given path, None if it can not be read
+    """
+    try:
+        digest = hashlib.new(algo)
+        with open(path, "rb") as fin:
+            while True:
+                chunk = fin.read(1024 * 1024)
+                if not chunk:
+                    break
+                digest.update(chunk)
+    except (IOError, ValueError):
+        return None
+    return digest.hexdigest()
+
+
+def caps_of_text(text):
+    """
+    Returns (effective, inheritable, permitted) capability sets of file
+    capabilities in text form, as stored in rpm header. Text which can not
+    be parsed gives empty sets, as with rpm.
+    """
+    sets = {"e": 0, "i": 0, "p": 0}
+    try:
+        for clause in (text or "").split():
+            match = re.match(r"^([^=+-]*)((?:[=+-][eip]*)+)$", clause)
+            if not match:
+                raise ValueError(clause)
+            names, ops = match.groups()
+            mask = 0
+            if names.lower() in ("", "all"):
+                mask = (1 << len(CAP_NAMES)) - 1
+            else:
+                for name in names.lower().split(","):
+                    if name.isdigit():
+                        mask |= 1 << int(name)
+                    else:
+                        mask |= 1 << CAP_NAMES.index(
+                            name[4:] if name.startswith("cap_") else name)
+            for op, flags in re.findall(r"([=+-])([eip]*)", ops):
+                if op == "=":
+                    for flag in sets:
+                        sets[flag] &= ~mask
+                for flag in flags:
+                    if op == "-":
+                        sets[flag] &= ~mask
+                    else:
+                        sets[flag] |= mask
+    except ValueError:
+        return 0, 0, 0
+    return sets["e"], sets["i"], sets["p"]
+
+
+def file_caps(path):
+    """
+    Returns (effective, inheritable, permitted) capability sets of file at
+    given path, read from its xattr. File without capabilities, or whose
+    xattr can not be read, gives empty sets, as with rpm. None if xattrs
+    can not be read at all.
+    """
+    if libc is None:
+        return None
+    buf = ctypes.create_string_buffer(256)
+    size = libc.getxattr(path, XATTR_CAPS, buf, len(buf))
+    data = buf.raw[:max(size, 0)]
+    if len(data) < 4:
+        return 0, 0, 0
+    magic = struct.unpack("<I", data[:4])[0]
+    count = VFS_CAP_U32.get(magic & VFS_CAP_REVISION_MASK)
+    if not count or len(data) < 4 + 8 * count:
+        return 0, 0, 0
+    words = struct.unpack("<%dI" % (2 * count), data[4:4 + 8 * count])
+    permitted = inheritable = 0
+    for i in range(count):
+        permitted |= words[2 * i] << (32 * i)
+        inheritable |= words[2 * i + 1] << (32 * i)
+    effective = 0
+    if magic & VFS_CAP_FLAGS_EFFECTIVE:
+        effective = permitted | inheritable
+    return effective, inheritable, permitted
+
+
+def verify_file(record):
+    """
+    Verify a file against its rpm database record.
+    Returns dict of failed checks, verify flag => RESULT_*, None if missing
+    """
+    (filename, mode, size, digest, algo, mtime, user, group, linkto, rdev,
+     fflags, vflags, caps) = record
+
+    path = os.path.join(ROOTFS, filename.lstrip("/"))
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+
+    if stat.S_ISDIR(st.st_mode) or stat.S_ISFIFO(st.st_mode) or \
+            stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode) or \
+            not stat.S_ISREG(st.st_mode) and not stat.S_ISLNK(st.st_mode):
+        vflags &= ~(RPMVERIFY_FILEDIGEST | RPMVERIFY_FILESIZE |
+                    RPMVERIFY_MTIME | RPMVERIFY_LINKTO | RPMVERIFY_CAPS)
+    elif stat.S_ISLNK(st.st_mode):
+        vflags &= ~(RPMVERIFY_FILEDIGEST | RPMVERIFY_FILESIZE |
+                    RPMVERIFY_MTIME | RPMVERIFY_MODE | RPMVERIFY_CAPS)
+    else:
+        vflags &= ~RPMVERIFY_LINKTO
+
+    # content of ghost files is not shipped by package
+    if fflags & RPMFILE_GHOST:
+        vflags &= ~(RPMVERIFY_FILEDIGEST | RPMVERIFY_FILESIZE |
+                    RPMVERIFY_MTIME | RPMVERIFY_LINKTO)
+
+    result = {}
+    if vflags & RPMVERIFY_FILEDIGEST and digest:
+        actual = file_digest(path, DIGEST_ALGOS.get(algo, "md5"))
+        if actual is None:
+            result[RPMVERIFY_FILEDIGEST] = RESULT_UNKNOWN
+        elif actual != digest:
+            result[RPMVERIFY_FILEDIGEST] = RESULT_FAILED
+
+    if vflags & RPMVERIFY_LINKTO:
+        try:
+            if os.readlink(path) != linkto:
+                result[RPMVERIFY_LINKTO] = RESULT_FAILED
+        except OSError:
+            result[RPMVERIFY_LINKTO] = RESULT_UNKNOWN
+
+    if vflags & RPMVERIFY_FILESIZE and st.st_size != size:
+        result[RPMVERIFY_FILESIZE] = RESULT_FAILED
+
+    if vflags & RPMVERIFY_MODE:
+        expected, actual = mode, st.st_mode
+        # comparing type of ghost files is meaningless, permissions are not
+        if fflags & RPMFILE_GHOST:
+            expected &= ~0xf000
+            actual &= ~0xf000
+        if expected != actual:
+            result[RPMVERIFY_MODE] = RESULT_FAILED
+
+    if vflags & RPMVERIFY_RDEV:
+        if stat.S_ISCHR(mode) != stat.S_ISCHR(st.st_mode) or \
+                stat.S_ISBLK(mode) != stat.S_ISBLK(st.st_mode):
+            result[RPMVERIFY_RDEV] = RESULT_FAILED
+        elif (stat.S_ISCHR(mode) or stat.S_ISBLK(mode)) and \
+                st.st_rdev != rdev:
+            result[RPMVERIFY_RDEV] = RESULT_FAILED
+
+    if vflags & RPMVERIFY_MTIME and int(st.st_mtime) != mtime:
+        result[RPMVERIFY_MTIME] = RESULT_FAILED
+
+    if vflags & RPMVERIFY_CAPS:
+        actual = file_caps(path)
+        if actual is None:
+            result[RPMVERIFY_CAPS] = RESULT_UNKNOWN
+        elif actual != caps_of_text(caps):
+            result[RPMVERIFY_CAPS] = RESULT_FAILED
+
+    if vflags & RPMVERIFY_USER and USERS.get(st.st_uid) != user:
+        result[RPMVERIFY_USER] = RESULT_FAILED
+
+    if vflags & RPMVERIFY_GROUP and GROUPS.get(st.st_gid) != group:
+        result[RPMVERIFY_GROUP] = RESULT_FAILED
+
+    return result
+
+
+def attribute_char(fflags):
+    """
+    Returns file attribute marker of rpm -V output
+    """
+    for flag, char in ((RPMFILE_CONFIG, "c"), (RPMFILE_DOC, "d"),
+                       (RPMFILE_GHOST, "g"), (RPMFILE_LICENSE, "l"),
+                       (RPMFILE_README, "r")):
+        if fflags & flag:
+            return char
+    return " "
+
+
+def verify_package(records):
+    """
+    Verify files of a package, returns lines of rpm -V output for files
+    failing verification
+    """
+    lines = []
+    for record in records:
+        filename, fflags = record[0], record[10]
+        result = verify_file(record)
+        if result is None:
+            if not fflags & (RPMFILE_MISSINGOK | RPMFILE_GHOST):
+                lines.append("missing   %s %s" % (
+                    attribute_char(fflags), filename))
+            continue
+        if not result:
+            continue
+        checks = ""
+        for flag, char in ((RPMVERIFY_FILESIZE, "S"),
+                           (RPMVERIFY_MODE, "M"),
+                           (RPMVERIFY_FILEDIGEST, "5"),
+                           (RPMVERIFY_RDEV, "D"),
+                           (RPMVERIFY_LINKTO, "L"),
+                           (RPMVERIFY_USER, "U"),
+                           (RPMVERIFY_GROUP, "G"),
+                           (RPMVERIFY_MTIME, "T"),
+                           (RPMVERIFY_CAPS, "P")):
+            outcome = result.get(flag)
+            if outcome == RESULT_FAILED:
+                checks += char
+            elif outcome == RESULT_UNKNOWN:
+                checks += "?"
+            else:
+                checks += "."
+        lines.append("%s  %s %s" % (checks, attribute_char(fflags), filename))
+    return lines
+
+
+def header_values(header, tag, count, default=None):
+    """
+    Returns list of count values of given array tag of rpm header
+    """
+    values = header[tag]
+    if values is None or isinstance(values, (int, long, str)):
+        values = [values] * count if values is not None else []
+    values = list(values)
+    return values + [default] * (count - len(values))
+
+
+def package_records(header, skip_dirs=()):
+    """
+    Returns file records of given rpm header, to verify files with.
+    Files under skip_dirs are not verified.
+    """
+    filenames = header[rpm.RPMTAG_FILENAMES] or []
+    count = len(filenames)
+    states = header_values(header, rpm.RPMTAG_FILESTATES, count, 0)
+    columns = zip(
+        filenames,
+        header_values(header, rpm.RPMTAG_FILEMODES, count, 0),
+        header_values(header, rpm.RPMTAG_FILESIZES, count, 0),
+        header_values(header, rpm.RPMTAG_FILEDIGESTS, count, ""),
+        [header[rpm.RPMTAG_FILEDIGESTALGO] or 1] * count,
+        header_values(header, rpm.RPMTAG_FILEMTIMES, count, 0),
+        header_values(header, rpm.RPMTAG_FILEUSERNAME, count, "root"),
+        header_values(header, rpm.RPMTAG_FILEGROUPNAME, count, "root"),
+        header_values(header, rpm.RPMTAG_FILELINKTOS, count, ""),
+        header_values(header, rpm.RPMTAG_FILERDEVS, count, 0),
+        header_values(header, rpm.RPMTAG_FILEFLAGS, count, 0),
+        header_values(header, rpm.RPMTAG_FILEVERIFYFLAGS, count,
+                      RPMVERIFY_ALL),
+        header_values(header, rpm.RPMTAG_FILECAPS, count, ""),
+    )
+    records = []
+    for state, record in zip(states, columns):
+        if isinstance(state, str):
+            state = ord(state)
+        if state in SKIPPED_FILE_STATES:
+            continue
+        if record[0].startswith(skip_dirs):
+            continue
+        # rpm stores modes as signed 16 bit values
+        records.append((record[0], record[1] & 0xffff) + record[2:])
+    return records
+
+
+def installed_packages(rootfs, packages=None, skip_dirs=()):
+    """
+    Returns list of (package, file records) of packages installed in rootfs,
+    only of given packages, if given
+    """
+    ts = rpm.TransactionSet(rootfs)
+    # headers are read as is, without checking their signatures
+    ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES | rpm._RPMVSF_NODIGESTS)
+    result = []
+    for header in ts.dbMatch():
+        package = header.sprintf("%{NVRA}")
+        if packages is not None and package not in packages:
+            continue
+        result.append((package, package_records(header, skip_dirs)))
+    ts.closeDB()
+    return result
+
+
+def verify(rootfs, packages=None, skip_dirs=(), workers=None):
+    """
+    Verify files of packages installed in given rootfs, in a pool of worker
+    processes. Returns output in the format of `rpm -V`.
+    """
+    headers = installed_packages(rootfs, packages, skip_dirs)
+    pool = Pool(processes=workers or cpu_count(), initializer=init_worker,
+                initargs=(rootfs,))
+    try:
+        # packages are handed out few at a time, so large packages do not
+        # hold back a worker with a long queue of others
+        results = pool.map(
+            verify_package, [records for _, records in headers], chunksize=4)
+    finally:
+        pool.close()
+        pool.join()
+    lines = []
+    for package_lines in results:
+        lines.extend(package_lines)
+    return "".join(line + "\n" for line in lines)
@@ -0,0 +1,214 @@
+"""
+This module registers (git-url, git-sha) pairs of a batch of images at
+analytics server in bulk, and keeps a registry of pairs registered, so scans
+of images need not register them again.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from scanning.lib import settings
+from scanning.lib.cache import ResultCache
+from scanning.lib.docker_pool import DockerClientPool, DockerPoolTimeout
+
+# batch dir is mounted here in analytics integration scanner container
+BULK_MOUNT = "/bulk"
+# input and output files of scanner bulk register mode, in batch dir
+BULK_PAIRS_FILE = "pairs.json"
+BULK_RESULTS_FILE = "results.json"
+
+
+def normalize_pair(giturl, gitsha):
+    """
+    Returns (git-url, git-sha) pair as registered and recorded, without
+    surrounding whitespace
+    """
+    return (giturl or "").strip(), (gitsha or "").strip()
+
+
+class AnalyticsRegistry(object):
+    """
+    Registrations of (git-url, git-sha) pairs at an analytics server.
+
+    Registration records are kept in a cache shared by weekly scan and scan
+    workers, valid for settings.ANALYTICS_REGISTRATION_TTL seconds.
+    """
+
+    def __init__(self, server, logger=None, docker_pool=None):
+        self.server = server
+        self.logger = logger or logging.getLogger("console")
+        self.docker_pool = docker_pool
+        self.cache = ResultCache(
+            settings.ANALYTICS_REGISTRY_DIR,
+            settings.ANALYTICS_REGISTRY_MAX_BYTES, self.logger)
+
+    def key(self, giturl, gitsha):
+        """
+        Returns registry key of given pair
+        """
+        return self.cache.key(
+            "register", self.server, *normalize_pair(giturl, gitsha))
+
+    def lookup(self, giturl, gitsha):
+        """
+        Returns last registration record of given pair, successful or not,
+        None if registration of pair is not recorded
+        """
+        return self.cache.get(
+            self.key(giturl, gitsha), settings.ANALYTICS_REGISTRATION_TTL)
+
+    def registered(self, giturl, gitsha):
+        """
+        Returns registration record of given pair, None if not registered
+        """
+        record = self.lookup(giturl, gitsha)
+        if record and record.get("Successful"):
+            return record
+        return None
+
+    def record(self, giturl, gitsha, record):
+        """
+        Record registration of given pair, with time of recording
+        """
+        record = dict(record, recorded=time.time())
+        self.cache.put(self.key(giturl, gitsha), record)
+        return record
+
+    def failed_record(self, giturl, gitsha):
+        """
+        Returns record of pair which could not be registered in bulk
+        """
+        return {
+            "Scan Type": "register",
+            "Successful": False,
+            "api_data": {"git-url": giturl, "git-sha": gitsha},
+            "Summary": "Could not be registered in bulk.",
+        }
+
+    def pending(self, pairs):
+        """
+        Returns unique normalized pairs of given (git-url, git-sha) pairs,
+        which are not registered
+        """
+        seen = set()
+        pending = []
+        for pair in pairs:
+            pair = normalize_pair(*pair)
+            if not all(pair) or pair in seen:
+                continue
+            seen.add(pair)
+            if not self.registered(*pair):
+                pending.append(pair)
+        return pending
+
+    def run_scanner(self, batch_dir):
+        """
+        Run analytics integration scanner in bulk register mode for pairs in
+        batch dir, returns exit code of scanner, None on failure
+        """
+        docker_pool = self.docker_pool or DockerClientPool(
+            size=1, logger=self.logger)
+        try:
+            return self.run_container(docker_pool, batch_dir)
+        except DockerPoolTimeout as e:
+            self.logger.critical(
+                "Failed running bulk registration. {}".format(e))
+            return None
+
+    def run_container(self, docker_pool, batch_dir):
+        """
+        Run analytics integration scanner container for pairs in batch dir
+        with a client of given docker pool, returns exit code of scanner
+        """
+        with docker_pool.client() as conn:
+            container = conn.create_container(
+                image=settings.ANALYTICS_SCANNER_IMAGE,
+                command=["python", "integration.py", "bulk-register",
+                         BULK_MOUNT],
+                environment={"SERVER": self.server},
+                volumes=[BULK_MOUNT],
+                host_config=conn.create_host_config(binds={
+                    batch_dir: {"bind": BULK_MOUNT, "mode": "rw,Z"}}))
+            try:
+                conn.start(container)
+                return conn.wait(
+                    container, timeout=settings.ANALYTICS_BULK_TIMEOUT)
+            except Exception as e:
+                self.logger.critical(
+                    "Failed running bulk registration. {}".format(e))
+                return None
+            finally:
+                conn.remove_container(container, force=True)
+
+    def register_batch(self, batch):
+        """
+        Register given batch of pairs in one run of analytics integration
+        scanner, returns {pair: registration record} of pairs attempted
+        """
+        batch_dir = tempfile.mkdtemp(prefix="analytics-bulk-")
+        try:
+            with open(os.path.join(batch_dir, BULK_PAIRS_FILE), "w") as fout:
+                json.dump(batch, fout)
+            exit_code = self.run_scanner(batch_dir)
+            try:
+                with open(os.path.join(batch_dir, BULK_RESULTS_FILE)) as fin:
+                    output = json.load(fin)
+            except (IOError, ValueError) as e:
+                self.logger.critical(
+                    "No bulk registration results, scanner exited with {}. "
+                    "{}".format(exit_code, e))
+                return {}
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+
+        self.logger.info(output.get("Summary", ""))
+        records = {}
+        for record in output.get("Scan Results", []):
+            data = record.get("api_data", {})
+            records[(data.get("git-url"), data.get("git-sha"))] = record
+        return records
+
+    def register(self, pairs):
+        """
+        Register pairs not registered yet, of given (git-url, git-sha) pairs,
+        in batches of settings.ANALYTICS_BULK_BATCH_SIZE pairs, each in one
+        run of analytics integration scanner. Registration of every pair is
+        recorded as it completes, failed or not. Registration stops if no
+        pair of a batch could be registered.
+
+        :return: Tuple (registered, failed) counts of pairs
+        """
+        pending = self.pending(pairs)
+        self.logger.info(
+            "Registering {} unique pairs at analytics server {}".format(
+                len(pending), self.server))
+
+        registered = failed = 0
+        size = settings.ANALYTICS_BULK_BATCH_SIZE
+        try:
+            for start in range(0, len(pending), size):
+                batch = pending[start:start + size]
+                records = self.register_batch(batch)
+                batch_registered = 0
+                for giturl, gitsha in batch:
+                    record = records.get((giturl, gitsha)) or \
+                        self.failed_record(giturl, gitsha)
+                    self.record(giturl, gitsha, record)
+                    if record.get("Successful"):
+                        batch_registered += 1
+                registered += batch_registered
+                failed += len(batch) - batch_registered
+                if not batch_registered:
+                    break
+        finally:
+            # pairs not attempted are recorded failed, so scans waiting for
+            # their registration do not wait any longer
+            for giturl, gitsha in pending[registered + failed:]:
+                self.record(
+                    giturl, gitsha, self.failed_record(giturl, gitsha))
+                failed += 1
+        return registered, failed
@@ -0,0 +1,122 @@
+"""
+This module has a persistent, size bounded, on disk cache of JSON data.
+Used to keep scanners results across jobs.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+
+class ResultCache(object):
+    """
+    JSON data cache kept as one file per entry in given directory.
+
+    Entries expire after a TTL given at lookup and least recently used entries
+    are evicted once size of cache grows beyond max_bytes. Multiple worker
+    processes can share the cache directory.
+    """
+
+    def __init__(self, path, max_bytes, logger=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.logger = logger or logging.getLogger("console")
+
+    def key(self, *parts):
+        """
+        Returns cache key for given parts, e.g. image digest, scanner name
+        """
+        return hashlib.sha256(
+            "\0".join(str(part) for part in parts)).hexdigest()
+
+    def entry_path(self, key):
+        """
+        Returns path of file holding entry of given key
+        """
+        return os.path.join(self.path, "{}.json".format(key))
+
+    def get(self, key, ttl):
+        """
+        Returns cached data for key, None if absent or older than ttl seconds
+        """
+        entry_path = self.entry_path(key)
+        try:
+            with open(entry_path) as fin:
+                entry = json.load(fin)
+        except (IOError, ValueError):
+            return None
+
+        if time.time() - entry.get("created", 0) > ttl:
+            self.remove(entry_path)
+            return None
+
+        # access time is tracked on mtime, for least recently used eviction
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+        return entry.get("data")
+
+    def put(self, key, data):
+        """
+        Cache data for key and evict entries if cache is full
+        """
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                self.logger.warning(
+                    "Failed to create cache dir {}. {}".format(self.path, e))
+                return False
+
+        # write to temp file and rename, readers never see partial entry
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            with os.fdopen(fd, "w") as fout:
+                json.dump({"created": time.time(), "data": data}, fout)
+            os.rename(tmp_path, self.entry_path(key))
+        except (IOError, OSError) as e:
+            self.logger.warning("Failed to write cache entry. {}".format(e))
+            return False
+
+        self.evict()
+        return True
+
+    def remove(self, entry_path):
+        """
+        Remove entry at given path, it could be removed by other process
+        """
+        try:
+            os.remove(entry_path)
+        except OSError:
+            pass
+
+    def evict(self):
+        """
+        Remove least recently used entries until cache fits max_bytes
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith(".json"):
+                continue
+            entry_path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+            total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        for _, size, entry_path in sorted(entries):
+            self.remove(entry_path)
+            total -= size
+            if total <= self.max_bytes:
+                break
+        self.logger.debug("Evicted entries from cache {}".format(self.path))
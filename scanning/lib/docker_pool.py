@@ -0,0 +1,226 @@
+"""
+This module has a pool of long lived docker clients, shared by scanning
+runner and workers across jobs, and docker helper utilities.
+"""
+
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from Queue import Empty, Queue
+
+import docker
+
+
+class DockerPoolTimeout(Exception):
+    """Raised when no docker client of pool is free in given time"""
+    pass
+
+
+class PullWatchdog(threading.Thread):
+    """
+    Aborts a streamed image pull if no layer makes progress in stall_timeout
+    seconds. Connection of the pull to docker daemon is shut down, so a read
+    of progress events blocked on a silent daemon returns, and the daemon
+    cancels the pull of the disconnected client.
+    """
+
+    def __init__(self, stall_timeout):
+        super(PullWatchdog, self).__init__(name="pull-watchdog")
+        self.daemon = True
+        self.stall_timeout = stall_timeout
+        # streamed response of pull request, once daemon responded
+        self.response = None
+        self.last_progress = time.time()
+        self.stalled = False
+        self._stopped = threading.Event()
+
+    def progress(self):
+        """Pull made progress"""
+        self.last_progress = time.time()
+
+    def capture(self, response, *args, **kwargs):
+        """Response hook of docker client, keeps response of pull request"""
+        self.response = response
+        return response
+
+    def run(self):
+        while not self._stopped.wait(1):
+            if time.time() - self.last_progress > self.stall_timeout:
+                self.stalled = True
+                self.abort()
+                return
+
+    def abort(self):
+        """Shut down connection of pull request, if daemon responded"""
+        response = self.response
+        if response is None:
+            return
+        try:
+            # socket of the response, as docker client reads it
+            response.raw._fp.fp._sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, socket.error):
+            pass
+        response.close()
+
+    def stop(self):
+        """Stop watching the pull"""
+        self._stopped.set()
+        self.join()
+
+
+def stream_pull(conn, image, stall_timeout, logger=None):
+    """
+    Pull image using given docker client, following the progress events.
+
+    Pull is aborted if no layer makes progress in stall_timeout seconds, any
+    event of a layer, e.g. downloading or extracting, counts as progress.
+    The stall is checked by a watchdog thread, so a silent daemon is
+    caught too.
+
+    :return: Tuple (status, metrics)
+             where status = True/False
+                   metrics = dict of bytes, duration, bytes_per_sec,
+                             layers, layers_downloaded, error
+    """
+    logger = logger or logging.getLogger("console")
+    started = time.time()
+    # layer id => bytes downloaded
+    downloaded = {}
+    layers = set()
+    error = None
+    stream = None
+    watchdog = PullWatchdog(stall_timeout)
+    watchdog.start()
+    conn.hooks["response"].append(watchdog.capture)
+    try:
+        stream = conn.pull(repository=image, stream=True, decode=True)
+        for event in stream:
+            if "error" in event:
+                error = event["error"]
+                break
+
+            layer = event.get("id")
+            status = event.get("status", "")
+            if not layer:
+                continue
+            watchdog.progress()
+            if "progressDetail" in event:
+                layers.add(layer)
+            if status == "Downloading":
+                current = event["progressDetail"].get("current", 0)
+                downloaded[layer] = max(current, downloaded.get(layer, 0))
+    except Exception as e:
+        error = str(e)
+    finally:
+        conn.hooks["response"].remove(watchdog.capture)
+        watchdog.stop()
+        if stream is not None:
+            stream.close()
+    if watchdog.stalled:
+        error = "No progress pulling {} in {} seconds".format(
+            image, stall_timeout)
+
+    duration = time.time() - started
+    total = sum(downloaded.values())
+    metrics = {
+        "bytes": total,
+        "duration": round(duration, 2),
+        "bytes_per_sec": int(total / duration) if duration else 0,
+        "layers": len(layers),
+        "layers_downloaded": len(downloaded),
+        "error": error,
+    }
+    if error:
+        logger.warning("Failed pulling image {}. {}".format(image, error))
+        return False, metrics
+    logger.info("Pulled image {}: {}".format(image, metrics))
+    return True, metrics
+
+
+class DockerClientPool(object):
+    """
+    Pool of docker clients connected to the daemon.
+
+    Clients keep their HTTP connection to the daemon socket alive across
+    calls. A client is health checked before it is handed out, if not checked
+    recently, and reconnected with backoff while the daemon is unavailable.
+    Users wait up to acquire_timeout seconds for a free client.
+    """
+
+    def __init__(self, base_url="unix:///var/run/docker.sock", size=2,
+                 health_check_interval=60, max_backoff=60,
+                 acquire_timeout=600, logger=None):
+        self.base_url = base_url
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+        self.max_backoff = max_backoff
+        self.logger = logger or logging.getLogger("console")
+        # idle clients as (client, last health check timestamp)
+        self._idle = Queue()
+        for _ in range(size):
+            self._idle.put((None, 0))
+
+    def connect(self):
+        """
+        Returns a connected and healthy docker client, waits with exponential
+        backoff until docker daemon is reachable
+        """
+        backoff = 1
+        while True:
+            try:
+                client = docker.Client(base_url=self.base_url)
+                client.ping()
+            except Exception as e:
+                self.logger.warning(
+                    "Failed to connect to docker daemon, retrying in {} "
+                    "seconds. {}".format(backoff, e))
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            else:
+                return client
+
+    def healthy(self, client, checked):
+        """
+        Returns True if client is healthy, checking daemon if not checked
+        in last health_check_interval seconds
+        """
+        if client is None:
+            return False
+        if time.time() - checked < self.health_check_interval:
+            return True
+        try:
+            client.ping()
+        except Exception as e:
+            self.logger.warning("Docker client failed health check. {}".format(
+                e))
+            return False
+        return True
+
+    @contextmanager
+    def client(self):
+        """
+        Context manager giving a docker client of pool, client is returned
+        to the pool on exit. Blocks if all clients are in use, raises
+        DockerPoolTimeout if none is free in acquire_timeout seconds.
+        """
+        try:
+            client, checked = self._idle.get(timeout=self.acquire_timeout)
+        except Empty:
+            raise DockerPoolTimeout(
+                "No docker client free in {} seconds".format(
+                    self.acquire_timeout))
+        if not self.healthy(client, checked):
+            client = self.connect()
+            checked = time.time()
+        elif time.time() - checked >= self.health_check_interval:
+            checked = time.time()
+        try:
+            yield client
+        except Exception:
+            # health check client before it is used next time
+            checked = 0
+            raise
+        finally:
+            self._idle.put((client, checked))
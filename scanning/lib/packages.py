@@ -0,0 +1,305 @@
+"""
+This module reads packages installed via pip, npm and gem from manifests in
+image rootfs, and finds their updates in a locally mirrored package index,
+without running a container of image. The index is kept up to date by
+scripts/package_index.py.
+"""
+
+import fcntl
+import glob
+import json
+import logging
+import os
+import re
+import threading
+
+# index file per package manager, in package index dir. An index file is a
+# JSON object of package name => latest version, null for packages unknown
+# to the package registry. Names of installed packages missing in an index
+# are appended to the index file path + WANTED_SUFFIX, for indexer to add.
+INDEX_FILES = {
+    "pip": "pypi.json",
+    "npm": "npm.json",
+    "gem": "rubygems.json",
+}
+WANTED_SUFFIX = ".wanted"
+
+# dirs of image rootfs holding installed package manifests, as globs
+SITE_PACKAGES_DIRS = [
+    "usr/lib/python*/site-packages",
+    "usr/lib64/python*/site-packages",
+    "usr/local/lib/python*/site-packages",
+    "usr/local/lib64/python*/site-packages",
+]
+NODE_MODULES_DIRS = [
+    "usr/lib/node_modules",
+    "usr/local/lib/node_modules",
+]
+GEM_SPECIFICATIONS_DIRS = [
+    "usr/share/gems/specifications",
+    "usr/local/share/gems/specifications",
+    "usr/lib/ruby/gems/*/specifications",
+    "usr/local/lib/ruby/gems/*/specifications",
+]
+
+
+def normalize_name(manager, name):
+    """
+    Returns package name as compared in index, pip names are case
+    insensitive and treat runs of -_. alike
+    """
+    if manager == "pip":
+        return re.sub(r"[-_.]+", "-", name).lower()
+    return name
+
+
+# order of release phases named in version suffixes, relative to the release
+# itself, e.g. 1.0.dev1 < 1.0a1 < 1.0rc1 < 1.0 < 1.0.post1. Suffixes not
+# named here are pre-releases, as in npm and gem.
+RELEASE_PHASES = {
+    "dev": -4,
+    "a": -3, "alpha": -3,
+    "b": -2, "beta": -2,
+    "c": -1, "rc": -1, "pre": -1, "preview": -1,
+    "post": 1, "rev": 1, "r": 1, "p": 1, "pl": 1,
+}
+RELEASE = 0
+PRE_RELEASE = -1
+POST_RELEASE = 1
+# bare number suffix of npm and gem, e.g. 1.0.0-1, sorts before named
+# pre-releases, as numeric identifiers do in semver
+NUMBERED_PRE_RELEASE = -5
+
+
+def version_key(version, manager=None):
+    """
+    Returns sort key of version string of given package manager.
+
+    Release numbers are compared numerically, ignoring trailing zeros. Each
+    word of a suffix starts a phase ordered by RELEASE_PHASES, numbers
+    following it order versions within the phase. A bare number suffix, as
+    in 1.0-1, is a post release of pip and a pre-release of npm. Build
+    metadata after "+" is ignored. Approximates versioning schemes of pip,
+    npm and gem.
+    """
+    version = version.strip().split("+")[0]
+    match = re.match(r"^v?([0-9]+(?:\.[0-9]+)*)(.*)$", version)
+    if not match:
+        return ((), ((PRE_RELEASE, version),))
+    release = [int(part) for part in match.group(1).split(".")]
+    while release and release[-1] == 0:
+        release.pop()
+
+    suffix = match.group(2)
+    phases = []
+    for token in re.findall(r"[0-9]+|[a-zA-Z]+", suffix):
+        if token.isdigit():
+            if not phases:
+                phases.append([POST_RELEASE if manager == "pip"
+                               else NUMBERED_PRE_RELEASE])
+            phases[-1].append(int(token))
+        else:
+            phases.append([RELEASE_PHASES.get(token.lower(), PRE_RELEASE)])
+    # the release itself ends every key, so a phase below it sorts first
+    phases.append([RELEASE])
+    return (tuple(release), tuple(tuple(phase) for phase in phases))
+
+
+def newer(version, other, manager=None):
+    """
+    Returns True if version string is newer than other version string
+    """
+    return version_key(version, manager) > version_key(other, manager)
+
+
+def read_headers(path):
+    """
+    Read Name and Version headers of python package metadata file
+    """
+    headers = {}
+    try:
+        with open(path) as fin:
+            for line in fin:
+                if not line.strip():
+                    break
+                key, _, value = line.partition(":")
+                if key in ("Name", "Version"):
+                    headers[key] = value.strip()
+    except IOError:
+        pass
+    return headers
+
+
+def pip_packages(rootfs):
+    """
+    Returns {name: version} of python packages installed in rootfs
+    """
+    packages = {}
+    for pattern in SITE_PACKAGES_DIRS:
+        for site_packages in glob.glob(os.path.join(rootfs, pattern)):
+            for entry in os.listdir(site_packages):
+                path = os.path.join(site_packages, entry)
+                if entry.endswith(".dist-info"):
+                    headers = read_headers(os.path.join(path, "METADATA"))
+                elif entry.endswith(".egg-info"):
+                    # egg-info is either a dir or the metadata file itself
+                    if os.path.isdir(path):
+                        path = os.path.join(path, "PKG-INFO")
+                    headers = read_headers(path)
+                else:
+                    continue
+                if "Name" in headers and "Version" in headers:
+                    packages[headers["Name"]] = headers["Version"]
+    return packages
+
+
+def npm_packages(rootfs):
+    """
+    Returns {name: version} of node packages installed globally in rootfs
+    """
+    packages = {}
+    for pattern in NODE_MODULES_DIRS:
+        for node_modules in glob.glob(os.path.join(rootfs, pattern)):
+            manifests = glob.glob(
+                os.path.join(node_modules, "*", "package.json")) + \
+                glob.glob(os.path.join(node_modules, "@*", "*",
+                                       "package.json"))
+            for manifest in manifests:
+                try:
+                    with open(manifest) as fin:
+                        data = json.load(fin)
+                except (IOError, ValueError):
+                    continue
+                if data.get("name") and data.get("version"):
+                    packages[data["name"]] = data["version"]
+    return packages
+
+
+def gem_packages(rootfs):
+    """
+    Returns {name: version} of gems installed in rootfs, the latest
+    version if several are installed
+    """
+    packages = {}
+    for pattern in GEM_SPECIFICATIONS_DIRS:
+        for specifications in glob.glob(os.path.join(rootfs, pattern)):
+            for entry in os.listdir(specifications):
+                if not entry.endswith(".gemspec"):
+                    continue
+                # name-version[-platform].gemspec, names can contain dashes
+                parts = entry[:-len(".gemspec")].split("-")
+                for i in range(1, len(parts)):
+                    if parts[i][:1].isdigit():
+                        name, version = "-".join(parts[:i]), parts[i]
+                        break
+                else:
+                    continue
+                if name not in packages or \
+                        newer(version, packages[name], "gem"):
+                    packages[name] = version
+    return packages
+
+
+INSTALLED_PACKAGES = {
+    "pip": pip_packages,
+    "npm": npm_packages,
+    "gem": gem_packages,
+}
+
+
+def installed_packages(manager, rootfs):
+    """
+    Returns {name: version} of packages installed in rootfs via given
+    package manager
+    """
+    return INSTALLED_PACKAGES[manager](rootfs)
+
+
+class PackageIndex(object):
+    """
+    Locally mirrored index of latest package versions, per package manager.
+
+    Index files are loaded once and kept in memory while they are not
+    modified, so scans in a worker process share them.
+    """
+
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logger or logging.getLogger("console")
+        # package manager => (mtime, {name: latest version})
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def index_path(self, manager):
+        """
+        Returns path of index file of given package manager
+        """
+        return os.path.join(self.path, INDEX_FILES[manager])
+
+    def wanted_path(self, manager):
+        """
+        Returns path of file listing packages wanted in index of given
+        package manager
+        """
+        return self.index_path(manager) + WANTED_SUFFIX
+
+    def want(self, manager, names):
+        """
+        Record given package names for indexer to add to index of given
+        package manager
+        """
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(self.wanted_path(manager), "a") as fout:
+                fcntl.flock(fout, fcntl.LOCK_EX)
+                fout.write("".join(name + "\n" for name in sorted(names)))
+        except (IOError, OSError) as e:
+            self.logger.warning(
+                "Failed to record packages wanted in {} index. {}".format(
+                    manager, e))
+
+    def index(self, manager):
+        """
+        Returns index of given package manager, None if it can not be read
+        """
+        path = self.index_path(manager)
+        with self._lock:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                return None
+            cached = self._indexes.get(manager)
+            if cached and cached[0] == mtime:
+                return cached[1]
+            try:
+                with open(path) as fin:
+                    data = json.load(fin)
+            except (IOError, ValueError) as e:
+                self.logger.warning(
+                    "Failed to load package index {}. {}".format(path, e))
+                return None
+            index = dict((normalize_name(manager, name), version)
+                         for name, version in data.items())
+            self._indexes[manager] = (mtime, index)
+            return index
+
+    def outdated(self, manager, packages):
+        """
+        Returns sorted names of given installed packages, {name: version},
+        of given package manager, having newer versions in index. None if
+        index misses any of the packages, the missing ones are recorded for
+        indexer to add.
+        """
+        index = self.index(manager) or {}
+        missing = [normalize_name(manager, name) for name in packages
+                   if normalize_name(manager, name) not in index]
+        if missing:
+            self.want(manager, missing)
+            return None
+        outdated = []
+        for name, version in packages.items():
+            latest = index[normalize_name(manager, name)]
+            if latest and newer(latest, version, manager):
+                outdated.append(name)
+        return sorted(outdated)
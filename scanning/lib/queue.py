@@ -1,6 +1,13 @@
+import fcntl
+import json
 import logging
+import math
+import os
+import tempfile
+import threading
 import time
 
+from scanning.lib import settings
 from scanning.vendors import beanstalkc
 
 
@@ -17,11 +24,13 @@ def retry(delay=30):
     def _retry(func):
         def wrapper(*args, **kwargs):
             error_logged = False
+            obj = args[0]
             while True:
                 try:
-                    return func(*args, **kwargs)
+                    # connection is shared with the heartbeat thread
+                    with obj._lock:
+                        return func(*args, **kwargs)
                 except beanstalkc.SocketError:
-                    obj = args[0]
                     if not error_logged:
                         obj.logger.warning(
                             'Lost connection to beanstalkd at {}:{}'
@@ -32,7 +41,6 @@ def retry(delay=30):
                     if func != obj._initialize:
                         obj._initialize()
                 except beanstalkc.DeadlineSoon as e:
-                    obj = args[0]
                     obj.logger.warning(e)
                     time.sleep(delay)
                 except QueueEmptyException as e:
@@ -41,7 +49,6 @@ def retry(delay=30):
                 except AttributeError as ae:
                     # this is to log issues where methods
                     # on object self._conn reports attribute error
-                    obj = args[0]
                     obj.logger.warning(str(ae))
                     time.sleep(delay)
                     # the attribute error is not valid for _initialize method
@@ -52,6 +59,59 @@ def retry(delay=30):
     return _retry
 
 
+def _read_durations():
+    """Read measured job durations per tube"""
+    try:
+        with open(settings.JOB_DURATIONS_FILE) as fin:
+            return json.load(fin)
+    except (IOError, ValueError):
+        return {}
+
+
+def record_job_duration(tube, duration):
+    """
+    Record time (seconds) taken to process a job of given tube.
+
+    Keeps an exponential moving average per tube, which is used to set TTR of
+    jobs put on the tube later, see ttr_for. Worker processes share the
+    durations file, it is updated under a lock and replaced atomically, so
+    readers never see a partial file.
+    """
+    dirname = os.path.dirname(settings.JOB_DURATIONS_FILE)
+    try:
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(settings.JOB_DURATIONS_FILE + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            durations = _read_durations()
+            average = durations.get(tube)
+            if average is None:
+                durations[tube] = duration
+            else:
+                durations[tube] = 0.8 * average + 0.2 * duration
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+            with os.fdopen(fd, "w") as fout:
+                json.dump(durations, fout)
+            os.rename(tmp_path, settings.JOB_DURATIONS_FILE)
+    except (IOError, OSError):
+        logging.getLogger('console').warning(
+            'Failed to record job duration for tube {}'.format(tube))
+
+
+def ttr_for(tube):
+    """
+    Returns TTR (seconds) for jobs put on given tube.
+
+    TTR is settings.TTR_FACTOR times the measured job duration for the tube,
+    but never lower than the configured TTR in settings.TUBE_TTR.
+    """
+    ttr = settings.TUBE_TTR.get(tube, beanstalkc.DEFAULT_TTR)
+    measured = _read_durations().get(tube)
+    if measured:
+        ttr = max(ttr, int(measured * settings.TTR_FACTOR))
+    return ttr
+
+
 class JobQueue:
     """Abstraction layer around job queue"""
     def __init__(self, host, port, sub, pub=None, logger=None):
@@ -61,24 +121,53 @@ class JobQueue:
         self.pub = pub or self.sub
         self.logger = logger or logging.getLogger('console')
         self._conn = None
+        self._lock = threading.RLock()
         self._initialize()
 
     @retry()
-    def get(self):
-        """Get job from subscribed tube"""
-        if self._conn.stats_tube(self.sub)['current-jobs-ready'] > 0:
-            return self._conn.reserve()
-        raise QueueEmptyException('No job in queue')
+    def get(self, timeout=None):
+        """
+        Get job from subscribed tube
+
+        Blocks on beanstalkd reserve and returns as soon as a job is ready.
+        If timeout (seconds) is given, waits at most that long and returns
+        None if no job arrived in the window.
+        """
+        return self._conn.reserve(timeout=timeout)
 
     @retry()
-    def put(self, data, tube=None):
-        """Put job to tube"""
+    def put(self, data, tube=None, delay=0, ttr=None):
+        """
+        Put job to tube
+
+        A non zero delay (seconds) makes beanstalkd hold the job and make it
+        ready only once the delay has passed. TTR defaults to the one measured
+        for the tube, see ttr_for.
+        """
         if tube:
             self._conn.use(tube)
-        self.logger.debug('Put data to tube {}: {}'.format(tube, data))
-        self._conn.put(data)
+        ttr = ttr or ttr_for(tube or self.pub)
+        self.logger.debug(
+            'Put data to tube {} with delay {} and ttr {}: {}'.format(
+                tube, delay, ttr, data))
+        # delays are rounded up, a job must not be ready before it is due
+        self._conn.put(data, delay=int(math.ceil(delay)), ttr=int(ttr))
         self._conn.use(self.sub)
 
+    @retry()
+    def release(self, job, delay=0):
+        """Release reserved job back to its tube, ready after delay seconds"""
+        job.release(delay=int(math.ceil(delay)))
+
+    def touch(self, job):
+        """
+        Touch reserved job, asking beanstalkd for another TTR to work on it.
+
+        Not retried on outage, the reservation is lost with the connection.
+        """
+        with self._lock:
+            job.touch()
+
     @retry()
     def delete(self, job):
         """Delete job from queue"""
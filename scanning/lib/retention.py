@@ -0,0 +1,283 @@
+"""
+This module has image retention manager for scan hosts. Scanned images are
+kept around, so layers shared with next images need not be pulled again,
+and garbage collected in least recently used order when docker storage
+fills up.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# units of sizes reported by docker daemon, e.g. "1.5 GB"
+SIZE_UNITS = {
+    "B": 1,
+    "kB": 1000,
+    "KB": 1000,
+    "MB": 1000 ** 2,
+    "GB": 1000 ** 3,
+    "TB": 1000 ** 4,
+    "PB": 1000 ** 5,
+}
+
+
+def parse_size(size):
+    """
+    Returns bytes of size as reported by docker daemon, None if not parsable
+    """
+    try:
+        number, unit = size.split()
+        return float(number) * SIZE_UNITS[unit]
+    except (AttributeError, ValueError, KeyError):
+        return None
+
+
+class ImageRetention(object):
+    """
+    Least recently used retention of scanned images, bounded by disk usage
+    watermarks of docker storage.
+
+    Images in use are recorded with pid of the using process in a state file
+    shared by worker processes of the host, images in use by a live process
+    are never removed.
+    """
+
+    def __init__(self, docker_pool, state_file, docker_root_dir,
+                 high_watermark, low_watermark, logger=None):
+        self.docker_pool = docker_pool
+        self.state_file = state_file
+        self.docker_root_dir = docker_root_dir
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.logger = logger or logging.getLogger("console")
+
+    @contextmanager
+    def state(self):
+        """
+        Context manager giving retention state, {image: {last_used, pids}},
+        locked for other processes. Changes to state are saved on exit.
+        """
+        dirname = os.path.dirname(self.state_file)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(self.state_file + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.state_file) as fin:
+                    state = json.load(fin)
+            except (IOError, ValueError):
+                state = {}
+            yield state
+            with open(self.state_file, "w") as fout:
+                json.dump(state, fout)
+
+    def acquire(self, image):
+        """
+        Mark image in use by this process, waits while image is being removed
+        by garbage collection
+        """
+        while True:
+            with self.state() as state:
+                entry = state.setdefault(image, {"last_used": 0, "pids": []})
+                if not self.removing(entry):
+                    entry.pop("removing", None)
+                    entry["last_used"] = time.time()
+                    entry["pids"].append(os.getpid())
+                    return
+            time.sleep(1)
+
+    def release(self, image):
+        """
+        Mark image no more in use by this process
+        """
+        with self.state() as state:
+            entry = state.setdefault(image, {"last_used": 0, "pids": []})
+            entry["last_used"] = time.time()
+            if os.getpid() in entry["pids"]:
+                entry["pids"].remove(os.getpid())
+
+    def alive(self, pid):
+        """
+        Returns True if process of given pid is alive
+        """
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def removing(self, entry):
+        """
+        Returns True if image is being removed by a live process
+        """
+        pid = entry.get("removing")
+        return bool(pid) and self.alive(pid)
+
+    def in_use(self, entry):
+        """
+        Returns True if any process using image is alive
+        """
+        for pid in entry["pids"]:
+            if self.alive(pid):
+                return True
+        return False
+
+    def disk_usage(self):
+        """
+        Returns used fraction of docker storage. Images of devicemapper
+        storage driver live in a thin pool, not in the filesystem of docker
+        root dir, usage of its data space is reported by docker daemon.
+        """
+        usage = self.thin_pool_usage()
+        if usage is not None:
+            return usage
+        stat = os.statvfs(self.docker_root_dir)
+        return 1 - float(stat.f_bavail) / stat.f_blocks
+
+    def thin_pool_usage(self):
+        """
+        Returns used fraction of data space of devicemapper thin pool, None
+        if docker uses another storage driver or usage is not known
+        """
+        try:
+            with self.docker_pool.client() as conn:
+                info = conn.info()
+        except Exception as e:
+            self.logger.debug(
+                "Failed to get docker storage info. {}".format(e))
+            return None
+        if info.get("Driver") != "devicemapper":
+            return None
+        status = dict(info.get("DriverStatus") or [])
+        total = parse_size(status.get("Data Space Total"))
+        # available space is bound by backing filesystem of loop devices as
+        # well, used space is not
+        available = parse_size(status.get("Data Space Available"))
+        if not total or available is None:
+            return None
+        return 1 - available / total
+
+    @contextmanager
+    def collecting(self):
+        """
+        Context manager giving True if this process is the one collecting
+        images, False if other process is collecting
+        """
+        with open(self.state_file + ".gc.lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                yield False
+                return
+            yield True
+
+    def claim_victim(self, skipped):
+        """
+        Returns least recently used image not in use, marked as being removed
+        by this process, None if there is none. Images in skipped are not
+        considered.
+        """
+        with self.state() as state:
+            lru = sorted(state.items(), key=lambda item: item[1]["last_used"])
+            for image, entry in lru:
+                if image in skipped or self.in_use(entry) or \
+                        self.removing(entry):
+                    continue
+                entry["removing"] = os.getpid()
+                return image
+        return None
+
+    def remove(self, image):
+        """
+        Remove image, returns True if it is gone
+        """
+        self.logger.info(
+            "Removing least recently used image {}".format(image))
+        try:
+            with self.docker_pool.client() as conn:
+                conn.remove_image(image=image)
+        except Exception as e:
+            self.logger.warning(
+                "Failed to remove image {}. {}".format(image, e))
+            # image could be removed by other means
+            return "No such image" in str(e)
+        return True
+
+    def collect(self):
+        """
+        Remove dangling images and volumes, and if disk usage is above high
+        watermark, remove least recently used images not in use until it is
+        below low watermark.
+
+        State is locked only while a victim is picked and its removal is
+        recorded, not while images are removed, so workers acquiring and
+        releasing images are not held up by collection.
+        """
+        self.prune_dangling()
+
+        if self.disk_usage() < self.high_watermark:
+            return
+
+        with self.collecting() as collecting:
+            if not collecting:
+                return
+            skipped = set()
+            while self.disk_usage() >= self.low_watermark:
+                image = self.claim_victim(skipped)
+                if image is None:
+                    break
+                skipped.add(image)
+                removed = self.remove(image)
+                with self.state() as state:
+                    entry = state.get(image)
+                    if entry is not None:
+                        entry.pop("removing", None)
+                        # forget image only if it is gone
+                        if removed:
+                            del state[image]
+            # layers freed by removed images are dangling now
+            self.prune_dangling()
+
+    def prune_dangling(self):
+        """
+        Remove dangling images and volumes
+        """
+        try:
+            with self.docker_pool.client() as conn:
+                for image_id in conn.images(
+                        quiet=True, filters={"dangling": True}):
+                    conn.remove_image(image=image_id)
+        except Exception as e:
+            self.logger.debug("Failed to clean unused images. {}".format(e))
+
+        try:
+            with self.docker_pool.client() as conn:
+                volumes = conn.volumes(
+                    filters={"dangling": True}).get("Volumes") or []
+                for volume in volumes:
+                    conn.remove_volume(volume["Name"])
+        except Exception as e:
+            self.logger.debug("Failed to clean unused volumes. {}".format(e))
+
+    def start_collector(self, interval):
+        """
+        Start a background thread collecting images every interval seconds
+        """
+        def collector():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.collect()
+                except Exception as e:
+                    self.logger.warning(
+                        "Image garbage collection failed. {}".format(e),
+                        exc_info=True)
+
+        thread = threading.Thread(target=collector, name="image-gc")
+        thread.daemon = True
+        thread.start()
+        return thread
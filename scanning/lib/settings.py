@@ -3,10 +3,103 @@ from config import *
 
 BEANSTALKD_HOST = "127.0.0.1"
 BEANSTALKD_PORT = 11300
+# long-poll window (seconds) for workers waiting on a job, workers wake up
+# as soon as a job arrives and loop again if the window elapses
+BEANSTALKD_RESERVE_TIMEOUT = 60
 DOCKER_HOST = "127.0.0.1"
 DOCKER_PORT = "4243"
 
+# TTR (seconds) of jobs put on given tubes, beanstalkd releases a reserved job
+# again if not deleted or touched in TTR. This is the lower bound, TTR grows to
+# TTR_FACTOR times the measured job duration of the tube
+TUBE_TTR = {
+    "start_scan": 1800,
+    "notify": 300,
+}
+TTR_FACTOR = 2
+# measured job durations per tube
+JOB_DURATIONS_FILE = "/var/lib/scanning/job_durations.json"
+# interval (seconds) at which workers touch the job under process
+HEARTBEAT_INTERVAL = 30
+
+# backoff policy per failure class for jobs scheduled for retry, delays are
+# in seconds, delay = min(max_delay, base_delay * 2 ** attempt) with jitter.
+# Scan jobs are retried only for failure classes listed here.
+RETRY_POLICY = {
+    "default": {"base_delay": 60, "max_delay": 3600, "max_retries": 3},
+    "pull": {"base_delay": 300, "max_delay": 6 * 3600, "max_retries": 5},
+}
+
 SCANNERS_STATUS_FILE = "scanners_status.json"
+# number of scanners run in parallel on an image, 1 runs them one by one
+SCANNERS_CONCURRENCY = 3
+# seconds given to a scanner to finish when run in parallel, commands of a
+# scanner timed out are killed
+SCANNER_TIMEOUT = 1800
+# image pull is aborted if it makes no progress for the given seconds
+PULL_STALL_TIMEOUT = 300
+# number of jobs scan worker reserves ahead of the job under scan, their
+# images are pulled in background while current image is scanned
+PREFETCH_JOBS = 1
+# prefetching stops if prefetched images take more than budget bytes, or if
+# free space of docker storage drops below the given bytes
+PREFETCH_DISK_BUDGET = 10 * 1024 ** 3
+PREFETCH_MIN_FREE_BYTES = 20 * 1024 ** 3
+DOCKER_ROOT_DIR = "/var/lib/docker"
+# scanned images are kept for their layers to be reused by next images, and
+# removed in least recently used order once docker storage usage crosses high
+# watermark, till it drops below low watermark. Usage is of the thin pool
+# with devicemapper storage driver, else of filesystem of DOCKER_ROOT_DIR.
+IMAGE_RETENTION_FILE = "/var/lib/scanning/image_retention.json"
+IMAGE_DISK_HIGH_WATERMARK = 0.8
+IMAGE_DISK_LOW_WATERMARK = 0.6
+# seconds between image garbage collection runs of scan worker
+IMAGE_GC_INTERVAL = 600
+# atomic scanners configuration files
+ATOMIC_SCANNERS_CONF_DIR = "/etc/atomic.d"
+
+# scanners results cache, keyed on image digest, scanner and scanner image
+RESULT_CACHE_DIR = "/var/lib/scanning/result_cache"
+RESULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# seconds a cached result is valid per scanner, scanners not listed here are
+# not cached. Results of update checking scanners depend on remote package
+# repositories as well and should be kept for a short time only.
+RESULT_CACHE_TTL = {
+    "rpm-verify": 30 * 24 * 3600,
+    "container-capabilities-scanner": 30 * 24 * 3600,
+    "pipeline-scanner": 24 * 3600,
+    "misc-package-updates": 24 * 3600,
+}
+
+# rpm verify findings per installed package, cached per image layer chain.
+# Packages whose files are not changed on top of a cached chain of an image
+# reuse its findings, changes of layers are read from tar-split metadata in
+# docker layer store, kept with any storage driver.
+LAYER_CACHE_DIR = "/var/lib/scanning/layer_cache"
+LAYER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+LAYER_CACHE_TTL = 30 * 24 * 3600
+# image is verified fully if more packages changed on top of base layers
+RPM_VERIFY_MAX_DELTA_PACKAGES = 1000
+
+# locally mirrored index of latest pip, npm and gem package versions, as
+# pypi.json, npm.json and rubygems.json, refreshed by scripts/package_index.py
+# run by package-index-refresh.timer. Updates of package managers whose index
+# has every installed package are found from manifests in image rootfs,
+# without a container.
+PACKAGE_INDEX_DIR = "/var/lib/scanning/package_index"
+
+# (git-url, git-sha) pairs of weekly scan images are registered at analytics
+# server in bulk, by running this scanner image in bulk register mode. Scans
+# of images whose pair is registered since ANALYTICS_REGISTRATION_TTL
+# seconds skip the register scan.
+ANALYTICS_SCANNER_IMAGE = "scanner-analytics-integration:rhel7"
+ANALYTICS_BULK_TIMEOUT = 3600
+# pairs registered per run of scanner image, registrations are recorded per
+# batch, so scans of images queued first find them early
+ANALYTICS_BULK_BATCH_SIZE = 200
+ANALYTICS_REGISTRY_DIR = "/var/lib/scanning/analytics_registry"
+ANALYTICS_REGISTRY_MAX_BYTES = 64 * 1024 * 1024
+ANALYTICS_REGISTRATION_TTL = 2 * 24 * 3600
 
 LOG_LEVEL = "DEBUG"
 LOG_PATH = "/tmp/scanning.log"
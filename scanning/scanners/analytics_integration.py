@@ -9,10 +9,12 @@ class AnalyticsIntegration(Scanner):
     Scanner to invoke scanning job at Analytics server.
     """
 
-    def __init__(self):
+    def __init__(self, facts=None):
         """
         Initialize the invoker class.
         """
+        # facts of image under test, resolved by runner
+        self.facts = facts
         self.scanner = "analytics-integration"
         self.result_file = "analytics_scanner_results.json"
 
@@ -24,6 +26,7 @@ class AnalyticsIntegration(Scanner):
             image=image,
             scanner=self.scanner,
             result_file=self.result_file,
+            facts=self.facts,
         )
 
         # this scanner needs following two env vars for atomic scan command
@@ -33,6 +36,7 @@ class AnalyticsIntegration(Scanner):
             "GITURL": giturl,
             "GITSHA": gitsha}
 
+        # scanner only calls analytics server, it needs no image rootfs
         data = self.scan(
             process_output=False, env_vars=env_vars, scan_type=scan_type)
 
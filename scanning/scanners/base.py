@@ -6,15 +6,230 @@ Per scanner, a subsclass can be written and use Scanner class as
 base class.
 """
 
+import hashlib
 import json
 import logging
 import os
 import shutil
+import signal
 import subprocess
+import threading
 
 from Atomic import Atomic, mount
 
-from scanning.lib.log import load_logger
+from scanning.lib import settings
+
+
+class ScanContext(object):
+    """
+    Execution context of one atomic scan invocation.
+
+    Holds environment and timeout the scanner subprocess is run with, and
+    the result dir it exported, so concurrent scans in threads of
+    one process do not share state via os.environ.
+    """
+
+    def __init__(self, env=None, timeout=None):
+        # extra environment variables for the scanner, on top of os.environ
+        self.env = env or {}
+        # seconds after which scanner subprocess is killed, None to wait
+        self.timeout = timeout
+        # result dir exported by atomic scan
+        self.res_dir = None
+        # set if scanner subprocess was killed on timeout
+        self.timed_out = False
+
+    def environ(self):
+        """
+        Returns environment for the scanner subprocess
+        """
+        env = os.environ.copy()
+        env.update(self.env)
+        return env
+
+
+class ImageFacts(object):
+    """
+    Facts of image under test, resolved once per job from docker inspect
+    output and shared with scanners, so they need not inspect image again.
+    """
+
+    def __init__(self, inspect_data):
+        # image ID without the digest algorithm prefix, as used by atomic
+        self.id = inspect_data["Id"].split(":")[-1]
+        repo_digests = inspect_data.get("RepoDigests") or []
+        self.digest = repo_digests[0].split("@")[-1] if repo_digests else None
+        self.labels = (inspect_data.get("Config") or {}).get("Labels") or {}
+        self.size = inspect_data.get("Size", 0)
+        self.layers = (inspect_data.get("RootFS") or {}).get("Layers", [])
+        self.os = inspect_data.get("Os")
+        self.architecture = inspect_data.get("Architecture")
+        graph_driver = inspect_data.get("GraphDriver") or {}
+        self.graph_driver = graph_driver.get("Name")
+
+    def chain_ids(self):
+        """
+        Returns chain IDs of image layers, bottom most first. Chain ID of a
+        layer identifies the layer along with all the layers below it, images
+        built from the same base image share chain IDs of base layers.
+        """
+        chain_ids = []
+        for diff_id in self.layers:
+            if chain_ids:
+                diff_id = "sha256:" + hashlib.sha256(
+                    "{} {}".format(chain_ids[-1], diff_id)).hexdigest()
+            chain_ids.append(diff_id)
+        return chain_ids
+
+    def environ(self):
+        """
+        Returns facts as environment variables for scanner containers
+        """
+        return {
+            "IMAGE_ID": self.id,
+            "IMAGE_DIGEST": self.digest or "",
+            "IMAGE_LABELS": json.dumps(self.labels),
+        }
+
+
+class RootfsMount(object):
+    """
+    Reference counted read-only mount of image rootfs.
+
+    Image is mounted once by the first user and the same mount path is
+    shared with every scanner of the job, as --rootfs for atomic scan.
+    Mount is removed when the last user releases it. Mounts are per process,
+    worker processes share the host mount namespace and could scan the same
+    image under different names at once.
+    """
+
+    # image_id => RootfsMount, mounts in use by this process
+    _mounts = {}
+    _lock = threading.Lock()
+
+    def __init__(self, image_id, logger):
+        self.image_id = image_id
+        self.logger = logger
+        self.path = self.mountpath(image_id)
+        self.users = 0
+        # initialize the atomic mount object
+        self.mount_obj = mount.Mount()
+        self.mount_obj.image = image_id
+        self.mount_obj.options = ["ro"]
+        self.mount_obj.mountpoint = self.path
+
+    @staticmethod
+    def mountpath(image_id):
+        """
+        Returns mount path for given image, unique to this process
+        """
+        return os.path.join("/", "{}-{}".format(image_id, os.getpid()))
+
+    @classmethod
+    def acquire(cls, image_id, logger):
+        """
+        Returns mount of given image, mounting it if not mounted yet.
+        Returns None if image failed to mount.
+        """
+        with cls._lock:
+            rootfs = cls._mounts.get(image_id)
+            if not rootfs:
+                rootfs = cls(image_id, logger)
+                if not rootfs.mount():
+                    return None
+                cls._mounts[image_id] = rootfs
+            rootfs.users += 1
+            return rootfs
+
+    def release(self):
+        """
+        Release the mount, image is unmounted after its last user
+        """
+        with self._lock:
+            self.users -= 1
+            if self.users > 0:
+                return True
+            del self._mounts[self.image_id]
+            unmounted = self.unmount()
+            self.clean_mountpath()
+            return unmounted
+
+    def remove_dirs(self):
+        """
+        Remove mount path dir
+        """
+        try:
+            shutil.rmtree(self.path)
+        except OSError as e:
+            self.logger.warning("Failed to remove dir={}. {}".format(
+                self.path, e))
+            return False
+        else:
+            return True
+
+    def unmount(self):
+        """
+        Umount mounted image
+        """
+        try:
+            self.mount_obj.unmount()
+        except Exception as e:
+            self.logger.warning("Failed to unmount={}. {}".format(
+                self.path, e))
+            return False
+        else:
+            self.logger.debug("Unmounted path={}".format(self.path))
+            return True
+
+    def clean_mountpath(self):
+        """
+        Remove existing mount point if exists
+        """
+        # mount path is ready to mount
+        if not os.path.isdir(self.path):
+            return True
+
+        # first try to remove the dir
+        if self.remove_dirs():
+            return True
+
+        self.logger.warning("Mount path={} exists.".format(self.path))
+        self.logger.debug("Unmounting path={}".format(self.path))
+        if not self.unmount():
+            self.logger.critical(
+                "Mount path={} already exist and in use.".format(self.path))
+            return False
+        # now we have unmounted, try removing dirs
+        return self.remove_dirs()
+
+    def mount(self):
+        """
+        Mount image at mount path
+        """
+        # clean up the mount point
+        if not self.clean_mountpath():
+            self.logger.critical(
+                "Mount path={} is not ready for mount.".format(self.path))
+            return False
+
+        # create mount point directory
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            self.logger.critical(
+                "Failed to create dir for mount path={}. {}".format(
+                    self.path, e))
+            return False
+
+        # now using mount object, mount the image
+        try:
+            self.mount_obj.mount()
+        except Exception as e:
+            self.logger.critical(
+                "Failed to mount at path={}. {}".format(self.path, str(e)))
+            return False
+        self.logger.debug("Mounted image at path={}".format(self.path))
+        return True
 
 
 class Scanner(object):
@@ -23,45 +238,115 @@ class Scanner(object):
     Other classes can use as super class for common functions.
     """
 
-    def __init__(self, image, scanner, result_file):
+    # set once scanner is aborted, it runs no more commands
+    aborted = False
+    _processes_lock = threading.Lock()
+
+    def __init__(self, image, scanner, result_file, facts=None):
         # container/image under test
         self.image = image
         # scanner name / as installed /not full URL
         self.scanner = scanner
         # name of the output result file by scanner
         self.result_file = result_file
+        # facts of image under test, if resolved by runner
+        self.facts = facts
         # image_id
-        self.image_id = Atomic().get_input_id(self.image)
-        # set logger or set console
-        load_logger()
+        if facts:
+            self.image_id = facts.id
+        else:
+            self.image_id = Atomic().get_input_id(self.image)
+        # logging is configured by the worker, reconfiguring it here is not
+        # safe while other scanners log from threads
         self.logger = logging.getLogger("scan-worker")
         # Flag to indicate if image is mounted on local filesystem
         self.is_mounted = False
         # image mount path
-        self.image_mountpath = os.path.join("/", self.image_id)
-        # initialize the atomic mount object
-        self.mount_obj = mount.Mount()
-        # provide image id to mount object
-        self.mount_obj.image = self.image_id
-        # provide mount option read/write
-        self.mount_obj.options = ["rw"]
-        # provide mount point
-        self.mount_obj.mountpoint = self.image_mountpath
-        # set default for res_dir, this is a dir which is created
-        # by atomic, default result location
-        self.res_dir = None
-
-    def run_cmd(self, cmd):
+        self.image_mountpath = RootfsMount.mountpath(self.image_id)
+        # shared mount of image rootfs, while mounted
+        self.rootfs = None
+        # result dirs created by atomic scan invocations, default result
+        # location, removed on cleanup
+        self.res_dirs = []
+        # set if any atomic scan invocation failed to give results
+        self.scan_failed = False
+        # commands running for the scanner, killed if scanner is aborted
+        self.processes = set()
+
+    def run_cmd(self, cmd, context=None):
         """
         Runs a shell command and returns output & error (if any)
 
         :param cmd: Command to run
         :type cmd: tuple or list
+        :param context: Environment and timeout to run with
+        :type context: ScanContext
 
         :return: Command output and error
         """
-        return subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE).communicate()
+        context = context or ScanContext()
+        with self._processes_lock:
+            if self.aborted:
+                return "", "Scanner {} is aborted.".format(self.scanner)
+            # scanners run commands from several threads, fds of their
+            # pipes must not leak into other commands, holding their output
+            # open. Command runs in its own process group, to be killed
+            # along with its children.
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE,
+                                       env=context.environ(),
+                                       close_fds=True,
+                                       preexec_fn=os.setsid)
+            self.processes.add(process)
+        try:
+            return self.communicate(cmd, process, context)
+        finally:
+            with self._processes_lock:
+                self.processes.discard(process)
+
+    def communicate(self, cmd, process, context):
+        """
+        Returns output and error of given command process, killing it after
+        timeout of given context
+        """
+        if not context.timeout:
+            return process.communicate()
+
+        def kill():
+            context.timed_out = True
+            self.kill(process)
+
+        timer = threading.Timer(context.timeout, kill)
+        timer.start()
+        try:
+            out, error = process.communicate()
+        finally:
+            timer.cancel()
+        if context.timed_out:
+            self.logger.critical("Killed {} after {} seconds.".format(
+                cmd, context.timeout))
+            return "", "Timed out after {} seconds.".format(context.timeout)
+        return out, error
+
+    def abort(self):
+        """
+        Kill running commands of the scanner, and run no more. Called from
+        another thread once the scanner is not waited for anymore.
+        """
+        with self._processes_lock:
+            self.aborted = True
+            processes = list(getattr(self, "processes", ()))
+        for process in processes:
+            self.kill(process)
+
+    def kill(self, process):
+        """
+        Kill given command process along with its children
+        """
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
 
     def make_dirs(self, path):
         """
@@ -93,92 +378,30 @@ class Scanner(object):
         else:
             return True
 
-    def unmount_image(self):
-        """
-        Umount mounted image
-        """
-        try:
-            self.mount_obj.unmount()
-        except Exception as e:
-            self.logger.warning("Failed to unmount={}. {}".format(
-                self.image_mountpath, e))
-            return False
-        else:
-            self.logger.debug("Unmounted path={}".format(self.image_mountpath))
-            return True
-
-    def clean_mountpath(self):
-        """
-        Remove existing mount point if exists
-        """
-        # first check if mount point exists
-        if os.path.isdir(self.image_mountpath):
-            # first try to remove the dir
-            if self.remove_dirs(self.image_mountpath):
-                # removed mount_path dir if it existed
-                return True
-            else:
-                self.logger.warning("Mount path={} exists.".format(
-                    self.image_mountpath))
-                self.logger.debug(
-                    "Unmounting path={}".format(self.image_mountpath))
-                if not self.unmount_image():
-                    self.logger.critical(
-                        "Mount path={} already exist and in use.".format(
-                            self.image_mountpath))
-                    # failed to unmount, return False
-                    return False
-                else:
-                    # now we have unmounted, try removing dirs
-                    if self.remove_dirs(self.image_mountpath):
-                        return True
-                    else:
-                        # even after unmount, it couldnt remove dirs
-                        return False
-        else:
-            # mount path is ready to mount
-            return True
-
     def mount_image(self):
         """
-        Mount image under test
+        Mount image under test read-only, the mount is shared with other
+        scanners of the job
         """
         # if image is already mounted return
         if self.is_mounted:
             return True
 
-        # clean up the mount point
-        if not self.clean_mountpath():
-            self.logger.critical(
-                "Mount path={} is not ready for mount.".format(
-                    self.image_mountpath))
-            return False
+        self.rootfs = RootfsMount.acquire(self.image_id, self.logger)
+        self.is_mounted = self.rootfs is not None
+        return self.is_mounted
 
-        # create mount point directory
-        if not self.make_dirs(self.image_mountpath):
-            # couldnt create dir
-            self.logger.critical(
-                "Failed to create dir for mount path={}".format(
-                    self.image_mountpath))
-            return False
-
-        # now using mount object, mount the image
-        try:
-            self.mount_obj.mount()
-        except Exception as e:
-            self.logger.critical(
-                "Failed to mount at path={}. {}".format(
-                    self.image_mountpath, str(e)))
-            # set the mount flag
-            self.is_mounted = False
-            return False
-        else:
-            # set the mount flag
-            self.is_mounted = True
-            self.logger.debug(
-                "Mounted image at path={}".format(self.image_mountpath))
+    def unmount_image(self):
+        """
+        Release mount of image, it is unmounted once no scanner uses it
+        """
+        if not self.is_mounted:
             return True
 
+        self.is_mounted = False
+        rootfs, self.rootfs = self.rootfs, None
+        return rootfs.release()
+
     def read_json(self, file_path):
         """
         read the json file
@@ -195,7 +418,7 @@ class Scanner(object):
         else:
             return data
 
-    def parse_result_path(self, stdout, rootfs=False):
+    def parse_result_path(self, stdout, rootfs=False, context=None):
         """
         Parse the path to result dir and find report inside it
         from given stdout
@@ -205,18 +428,21 @@ class Scanner(object):
             return None
         # last line of stdout has path of result dir
         # log the result dir, as we can remove this as part of cleanup
-        self.res_dir = lines[-1].split('.')[0]
+        res_dir = lines[-1].split('.')[0]
+        self.res_dirs.append(res_dir)
+        if context:
+            context.res_dir = res_dir
 
         # if its output of scanner which needs mount
         if rootfs:
             res_file = os.path.join(
-                self.res_dir,
+                res_dir,
                 "_{}".format(self.image_mountpath.split("/")[1]),
                 self.result_file)
         # or if its a scan without mount
         else:
             res_file = os.path.join(
-                self.res_dir,
+                res_dir,
                 self.image_id,
                 self.result_file)
         return res_file
@@ -240,9 +466,12 @@ class Scanner(object):
 
     def scan(self, scan_type=None,
              rootfs=None, verbose=False, process_output=True,
-             env_vars=None):
+             env_vars=None, context=None):
         """
         Runs atomic scan for given scan_type
+
+        env_vars are passed to atomic scan via a new ScanContext, unless
+        context to run the scan with is given.
         """
         cmd = ["atomic", "scan", "--scanner={}".format(self.scanner)]
 
@@ -257,18 +486,20 @@ class Scanner(object):
 
         cmd.append(self.image)
 
-        # add any environment variables before atomic scan command
-        if env_vars:
-            for key, value in env_vars.iteritems():
-                os.environ[key] = value
+        # environment variables are given to atomic scan command only,
+        # along with image facts forwarded to scanner containers
+        if not context:
+            env = self.facts.environ() if self.facts else {}
+            env.update(env_vars or {})
+            context = ScanContext(env=env, timeout=settings.SCANNER_TIMEOUT)
 
         # Running the atomic scan command after processing params
         self.logger.debug("Running atomic scan: {}".format(str(cmd)))
-        out, error = self.run_cmd(cmd)
+        out, error = self.run_cmd(cmd, context)
 
         result = None
         if out != "":
-            res_file = self.parse_result_path(out, rootfs)
+            res_file = self.parse_result_path(out, rootfs, context)
             # if scanner did not export the results
             if not res_file:
                 msg = "No scan results found for {}".format(self.scanner)
@@ -302,6 +533,9 @@ class Scanner(object):
                       "status": False,
                       "logs": {}}
 
+        if not result["status"]:
+            self.scan_failed = True
+
         if process_output:
             return self.process_output(result)
         return result
@@ -310,28 +544,26 @@ class Scanner(object):
         """
         Remove the default location of results by atomic scan
         """
-        if not self.res_dir:
-            return
-
-        if os.path.isdir(self.res_dir):
+        for res_dir in self.res_dirs:
+            if not os.path.isdir(res_dir):
+                continue
             try:
-                shutil.rmtree(self.res_dir)
+                shutil.rmtree(res_dir)
             except OSError as e:
                 self.logger.debug(
-                    "Failed to remove dir {}. {}".format(self.res_dir, str(e)))
+                    "Failed to remove dir {}. {}".format(res_dir, str(e)))
             else:
                 self.logger.debug(
                     "Removed redundant atomic scan results {}".format(
-                        self.res_dir))
+                        res_dir))
+        self.res_dirs = []
 
     def cleanup(self, unmount=False):
         """
         Clean up utilities
          - Removes redundant atomic scan results at `atomic` default location
-         - Unmounts if image rootfs is mounted and removes the mount path dir
+         - Releases mount of image rootfs, if mounted
         """
         self.remove_result_dir()
         if unmount:
             self.unmount_image()
-            self.clean_mountpath()
-            self.remove_dirs(self.image_mountpath)
@@ -5,16 +5,16 @@ This class is for checking container capabilities.
 It reuses the scanner class for the methods.
 """
 
-import os
-
 from scanning.scanners.base import Scanner
 
 
 class ContainerCapabilities(Scanner):
     """Container Capabilities scan."""
 
-    def __init__(self):
+    def __init__(self, facts=None):
         """Scanner name and types."""
+        # facts of image under test, resolved by runner
+        self.facts = facts
         self.scanner = "container-capabilities-scanner"
         self.result_file = "container_capabilities_scanner_results.json"
 
@@ -25,10 +25,10 @@ class ContainerCapabilities(Scanner):
         super(ContainerCapabilities, self).__init__(
             image=image,
             scanner=self.scanner,
-            result_file=self.result_file)
-
-        os.environ["IMAGE_NAME"] = self.image
+            result_file=self.result_file,
+            facts=self.facts)
 
-        data = self.scan()
+        # this scanner needs following env var for atomic scan command
+        data = self.scan(env_vars={"IMAGE_NAME": self.image})
 
         return data
@@ -1,18 +1,35 @@
 #!/usr/bin/python
 """This class is for checking updates from different other packagers."""
 
+import os
+
+from scanning.lib import settings
+from scanning.lib.packages import PackageIndex, installed_packages
 from scanning.scanners.base import Scanner
 
+# paths of package manager executables in image rootfs, as checked by scanner
+PACKAGE_MANAGERS = [
+    ("pip", "usr/bin/pip"),
+    ("npm", "usr/bin/npm"),
+    ("gem", "usr/bin/gem"),
+]
+
 
 class MiscPackageUpdates(Scanner):
     """Checks updates for packages other than RPM."""
 
-    def __init__(self):
+    # locally mirrored package index, loaded once per process
+    package_index = PackageIndex(settings.PACKAGE_INDEX_DIR)
+
+    def __init__(self, facts=None):
         """
         Initialize scanner invoker with basic configs
         """
+        # facts of image under test, resolved by runner
+        self.facts = facts
         self.scanner = "misc-package-updates"
-        self.scan_types = ["pip-updates", "npm-updates", "gem-updates"]
+        # checks pip, npm and gem updates at once
+        self.scan_type = "all-updates"
         self.result_file = "misc_package_updates_scanner_results.json"
 
     def run(self, image):
@@ -20,32 +37,119 @@ class MiscPackageUpdates(Scanner):
         super(MiscPackageUpdates, self).__init__(
             image=image,
             scanner=self.scanner,
-            result_file=self.result_file)
+            result_file=self.result_file,
+            facts=self.facts)
+
+        # package managers present in image, checked at once by scanner in
+        # a single container of image
+        self.mount_image()
+        managers = self.package_managers() if self.is_mounted else None
+
+        # updates found from manifests in rootfs, for package managers
+        # whose local package index has every installed package, need no
+        # container
+        offline = self.offline_updates(managers or [])
+        remaining = None if managers is None else [
+            manager for manager in managers if manager not in offline]
 
         # initializing a blank list that will contain results from all the
         # scan types of this scanner
         logs = []
 
-        # this scanner needs following env var for atomic scan command
-        env_vars = {"IMAGE_NAME": self.image}
+        if remaining == []:
+            self.logger.info(
+                "Checked updates of {} without container.".format(self.image))
+            logs.append(self.offline_logs(managers, offline))
+        else:
+            # this scanner needs following env var for atomic scan command
+            env_vars = {"IMAGE_NAME": self.image}
+            if remaining is not None:
+                env_vars["PACKAGE_MANAGERS"] = " ".join(remaining)
 
-        for st in self.scan_types:
             # scan_results gets {"status": True/False,
             #                    "logs": {},
             #                    "msg": msg}
             scan_results = self.scan(
-                scan_type=st, process_output=False, env_vars=env_vars)
+                scan_type=self.scan_type, process_output=False,
+                env_vars=env_vars)
 
-            if not scan_results.get("status", False):
-                continue
-
-            logs.append(scan_results["logs"])
+            if scan_results.get("status", False):
+                scan_logs = scan_results["logs"]
+                if offline and isinstance(
+                        scan_logs.get("Scan Results"), dict):
+                    for manager, outdated in offline.items():
+                        scan_logs["Scan Results"][
+                            "{} package updates".format(manager)] = outdated
+                    scan_logs["Summary"] = self.summary(
+                        scan_logs["Scan Results"])
+                logs.append(scan_logs)
 
-        # invoke base class's cleanup utility
-        self.cleanup()
+        # invoke base class's cleanup utility, also unmount
+        self.cleanup(unmount=True)
 
         return self.process_output(logs)
 
+    def package_managers(self):
+        """
+        Returns package managers found in mounted rootfs of image
+        """
+        return [manager for manager, path in PACKAGE_MANAGERS
+                if os.path.lexists(os.path.join(self.image_mountpath, path))]
+
+    def offline_updates(self, managers):
+        """
+        Returns {package manager: outdated packages} found from manifests in
+        mounted rootfs, for given package managers whose package index has
+        every installed package
+        """
+        offline = {}
+        for manager in managers:
+            try:
+                packages = installed_packages(manager, self.image_mountpath)
+            except (IOError, OSError) as e:
+                self.logger.warning(
+                    "Failed to read {} packages of {}. {}".format(
+                        manager, self.image, e))
+                continue
+            outdated = self.package_index.outdated(manager, packages)
+            if outdated is not None:
+                offline[manager] = outdated
+        return offline
+
+    def summary(self, results):
+        """
+        Returns summary of results of package managers, as given by scanner
+        """
+        summary = ""
+        for manager, _ in PACKAGE_MANAGERS:
+            if isinstance(results.get(
+                    "{} package updates".format(manager)), list):
+                summary += "Possible updates for packages installed via " \
+                    "{}. ".format(manager)
+            else:
+                summary += "No updates for packages installed via " \
+                    "{}. ".format(manager)
+        return summary
+
+    def offline_logs(self, managers, offline):
+        """
+        Returns scanner results of given package managers found in image
+        and their updates found offline
+        """
+        results = {}
+        for manager, _ in PACKAGE_MANAGERS:
+            results["{} package updates".format(manager)] = offline.get(
+                manager,
+                "Could not find {} executable in the image".format(manager))
+        return {
+            "Successful": bool(managers),
+            "Scan Type": self.scan_type,
+            "UUID": self.image_id,
+            "Scanner": "Misc Package Updates",
+            "Scan Results": results,
+            "Summary": self.summary(results),
+        }
+
     def process_output(self, logs):
         """
         Genaralising output.
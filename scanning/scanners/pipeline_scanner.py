@@ -7,7 +7,9 @@ from scanning.scanners.base import Scanner
 class PipelineScanner(Scanner):
     """pipeline-scanner atomic scanner handler."""
 
-    def __init__(self):
+    def __init__(self, facts=None):
+        # facts of image under test, resolved by runner
+        self.facts = facts
         self.scanner = "pipeline-scanner"
         self.result_file = "pipeline_scanner_results.json"
 
@@ -18,9 +20,10 @@ class PipelineScanner(Scanner):
         super(PipelineScanner, self).__init__(
             image=image,
             scanner=self.scanner,
-            result_file=self.result_file)
+            result_file=self.result_file,
+            facts=self.facts)
         self.mount_image()
-        data = self.scan(rootfs=True, process_output=False)
+        data = self.scan(rootfs=self.is_mounted, process_output=False)
 
         # invoke base class's cleanup utility, also unmount
         self.cleanup(unmount=True)
@@ -51,7 +54,7 @@ class PipelineScanner(Scanner):
         if logs.get("Scan Results", {}).get("Package Updates", []):
             msg = "RPM updates available for the image.\n Updates:\n"
             for update in logs.get("Scan Results").get("Package Updates"):
-                msg = msg + update + "\n"
+                msg = msg + self.format_update(update) + "\n"
             data["msg"] = msg
             # We are not counting RPM updates as alerts for now
             data["alert"] = False
@@ -60,3 +63,16 @@ class PipelineScanner(Scanner):
 
         data["logs"] = logs
         return data
+
+    def format_update(self, update):
+        """
+        Format update record of scanner for message, records could be
+        package names only
+        """
+        if not isinstance(update, dict):
+            return update
+        line = "{}.{}".format(update["name"], update["arch"])
+        if update.get("current"):
+            line += " {}".format(update["current"])
+        line += " -> {} ({})".format(update["available"], update["repo"])
+        return line
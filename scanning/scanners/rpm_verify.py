@@ -1,21 +1,53 @@
 #!/usr/bin/python
 """RPM Verify Scan Class."""
 
-from scanning.scanners.base import Scanner
+import base64
+import gzip
+import json
+import os
+import zlib
+
+from scanning.lib import settings
+from scanning.lib.cache import ResultCache
+from scanning.scanners.base import ScanContext, Scanner
+
+# findings under these dirs are filtered by the scanner, changes to them
+# need not be verified
+EXPECTED_MODIFIED_DIRS = (
+    "/var", "/run", "/media", "/mnt", "/tmp", "/proc", "/sys", "/boot"
+)
+
+NO_ISSUES = "No issues. Libraries and Binaries are intact."
+
+# entries of tar-split metadata of a layer naming a file of layer tar
+TAR_SPLIT_FILE = 1
+# files of layer tar marking removed paths and dirs hiding lower content
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
 
 
 class ScannerRPMVerify(Scanner):
     """scanner-rpm-verify atomic scanner handler."""
 
-    def __init__(self):
+    def __init__(self, facts=None):
         """Scanner verify initialization."""
+        # facts of image under test, resolved by runner
+        self.facts = facts
         self.scanner = "rpm-verify"
         self.result_file = "rpm_verify_scanner_results.json"
+        # findings per installed package, per layer chain ID
+        self.layer_cache = ResultCache(
+            settings.LAYER_CACHE_DIR, settings.LAYER_CACHE_MAX_BYTES)
 
     def run(self, image):
         """
         Run the scanner-rpm-verify atomic scanner.
 
+        Findings of packages are cached per layer chain of image. Packages
+        of an image whose files are not changed in layers above a cached
+        chain of it reuse findings of the chain, only the other packages
+        are verified, and results are composed.
+
         Returns: Tuple stating the status of the execution and
         actual data(True/False, json_data)
 
@@ -23,10 +55,267 @@ class ScannerRPMVerify(Scanner):
         super(ScannerRPMVerify, self).__init__(
             image=image,
             scanner=self.scanner,
-            result_file=self.result_file)
-        data = self.scan()
+            result_file=self.result_file,
+            facts=self.facts)
+        # scan the shared rootfs mount of image, if it could be mounted
+        self.mount_image()
+
+        packages = self.package_files() \
+            if self.is_mounted and self.facts else None
+        top = self.top_changed_layers(packages) if packages else None
+        reused = self.cached_findings(top) if top else {}
+        delta = set(packages or ()) - set(reused)
 
-        # invoke base class's cleanup utility
-        self.cleanup()
+        if not reused or len(delta) > settings.RPM_VERIFY_MAX_DELTA_PACKAGES:
+            data = self.scan(rootfs=self.is_mounted)
+        elif not delta:
+            self.logger.info(
+                "No packages changed on top of cached layers of {}, "
+                "reusing rpm verify findings".format(image))
+            data = self.compose(None, reused, delta)
+        else:
+            self.logger.info(
+                "Verifying {} packages changed on top of cached layers of "
+                "{}".format(len(delta), image))
+            data = self.scan(
+                rootfs=self.is_mounted,
+                env_vars={"RPM_VERIFY_PACKAGES": " ".join(sorted(delta))})
+            if not self.scan_failed:
+                data = self.compose(data, reused, delta)
+
+        if packages and not self.scan_failed:
+            self.cache_layers(data, packages, top)
+
+        # invoke base class's cleanup utility, also unmount
+        self.cleanup(unmount=True)
 
         return data
+
+    def package_files(self):
+        """
+        Returns files of packages installed in mounted image,
+        {package: list of filepaths}, None if query failed
+        """
+        cmd = ["rpm", "--root={}".format(self.image_mountpath), "-qa",
+               "--qf", "[%{FILENAMES}\t%{NVRA}\n]"]
+        out, error = self.run_cmd(
+            cmd, ScanContext(timeout=settings.SCANNER_TIMEOUT))
+        if not out:
+            self.logger.warning(
+                "Failed to query packages of {}. {}".format(
+                    self.image, error))
+            return None
+
+        packages = {}
+        for line in out.splitlines():
+            filepath, _, package = line.rpartition("\t")
+            if filepath:
+                packages.setdefault(package, []).append(filepath)
+        return packages
+
+    def layer_changes(self, chain_id):
+        """
+        Returns tuple (paths, removed) of paths added or modified in layer of
+        given chain ID, and of paths removed or hiding lower content, along
+        with paths under them. Changes are read from tar-split metadata of
+        the layer in docker layer store, kept with any storage driver. None
+        if it could not be read.
+        """
+        if not self.facts.graph_driver:
+            return None
+        path = os.path.join(
+            settings.DOCKER_ROOT_DIR, "image", self.facts.graph_driver,
+            "layerdb", "sha256", chain_id.split(":")[-1],
+            "tar-split.json.gz")
+        paths = set()
+        removed = set()
+        try:
+            with gzip.open(path) as fin:
+                for line in fin:
+                    entry = json.loads(line)
+                    if entry.get("type") != TAR_SPLIT_FILE:
+                        continue
+                    name = entry.get("name")
+                    if name is None and entry.get("name_raw"):
+                        name = base64.b64decode(entry["name_raw"])
+                    if not name:
+                        continue
+                    dirname, basename = os.path.split(
+                        os.path.normpath("/" + name))
+                    if basename == OPAQUE_WHITEOUT:
+                        removed.add(dirname)
+                    elif basename.startswith(WHITEOUT_PREFIX):
+                        removed.add(os.path.join(
+                            dirname, basename[len(WHITEOUT_PREFIX):]))
+                    else:
+                        paths.add(os.path.join(dirname, basename))
+        except (IOError, EOFError, ValueError, zlib.error) as e:
+            self.logger.warning(
+                "Failed to read changes of layer {}. {}".format(chain_id, e))
+            return None
+        return paths, removed
+
+    def symlinked_dirs(self):
+        """
+        Returns {dir: target dir} of top level dirs of mounted image which
+        are symlinks, e.g. /bin to /usr/bin
+        """
+        dirs = {}
+        for name in os.listdir(self.image_mountpath):
+            path = os.path.join(self.image_mountpath, name)
+            if os.path.islink(path):
+                dirs["/" + name] = os.path.normpath(
+                    os.path.join("/", os.readlink(path)))
+        return dirs
+
+    def top_changed_layers(self, packages):
+        """
+        Returns {package: index of top most layer changing any of its files},
+        -1 if no layer changes them, for given {package: filepaths}. None if
+        changes of layers could not be read.
+        """
+        # path => index of top most layer changing or removing it
+        changed = {}
+        removed = {}
+        for index, chain_id in enumerate(self.facts.chain_ids()):
+            changes = self.layer_changes(chain_id)
+            if changes is None:
+                return None
+            for path in changes[0]:
+                changed[path] = index
+            for path in changes[1]:
+                removed[path] = index
+
+        symlinked = self.symlinked_dirs()
+        top = {}
+        for package, filepaths in packages.items():
+            top[package] = -1
+            for filepath in filepaths:
+                # findings under these dirs are filtered by the scanner
+                if filepath.startswith(EXPECTED_MODIFIED_DIRS):
+                    continue
+                # layers name files by path under symlinked dirs resolved
+                head, sep, rest = filepath[1:].partition("/")
+                if sep and "/" + head in symlinked:
+                    filepath = symlinked["/" + head] + "/" + rest
+                index = changed.get(filepath, -1)
+                parent = filepath
+                while True:
+                    index = max(index, removed.get(parent, -1))
+                    if parent == "/":
+                        break
+                    parent = os.path.dirname(parent)
+                top[package] = max(top[package], index)
+        return top
+
+    def cache_key(self, chain_id):
+        """
+        Returns layer cache key of findings of packages of given chain ID
+        """
+        return self.layer_cache.key("rpm-verify", chain_id)
+
+    def cached_findings(self, top):
+        """
+        Returns {package: findings} of packages of image reusable from
+        cached layer chains of image. A package is reusable from a chain if
+        its files are not changed in layers above the chain, as given by
+        top, {package: index of top most layer changing its files}.
+        """
+        reused = {}
+        chain_ids = self.facts.chain_ids()
+        for index in reversed(range(len(chain_ids))):
+            entry = self.layer_cache.get(
+                self.cache_key(chain_ids[index]), settings.LAYER_CACHE_TTL)
+            if not entry:
+                continue
+            for package, findings in entry["packages"].items():
+                if package not in reused and package in top and \
+                        top[package] <= index:
+                    reused[package] = findings
+        return reused
+
+    def findings(self, data):
+        """
+        Returns findings of given scanner output
+        """
+        results = data.get("logs", {}).get("Scan Results", {}).get(
+            "rpmVa_issues", [])
+        return [finding for finding in results if isinstance(finding, dict)]
+
+    def compose(self, data, reused, delta):
+        """
+        Compose reused findings of packages with findings of verified delta
+        packages, returns scanner output in the format of a full scan
+        """
+        findings = []
+        for package in sorted(reused):
+            findings.extend(reused[package])
+
+        if data:
+            logs = data["logs"]
+            findings.extend(self.findings(data))
+        else:
+            logs = {
+                "Successful": "true",
+                "Scan Type": "RPM Verify scan for finding tampered files.",
+                "UUID": self.image_id,
+                "CVE Feed Last Updated": "NA",
+                "Scanner": "scanner-rpm-verify",
+            }
+
+        # file of several packages is reported once, for its first owner
+        seen = set()
+        unique = []
+        for finding in findings:
+            key = (finding.get("filename"), finding.get("issue"))
+            if key not in seen:
+                seen.add(key)
+                unique.append(finding)
+
+        if unique:
+            logs["Summary"] = "RPM verify scanner reported issues with " \
+                "some libraries/binaries."
+        else:
+            unique = [NO_ISSUES]
+            logs["Summary"] = "Libraries and binaries in the image are " \
+                "intact."
+        logs["Scan Results"] = {"rpmVa_issues": unique}
+        logs["Layer Cache"] = {
+            "packages_reused": len(reused),
+            "packages_verified": len(delta),
+        }
+        return self.process_output({"logs": logs})
+
+    def cache_layers(self, data, packages, top):
+        """
+        Cache findings of packages of image per layer chain of image. A
+        package is cached under every chain above which its files are not
+        changed, under chain of top most layer only if changes of layers
+        are not known.
+        """
+        chain_ids = self.facts.chain_ids()
+        if not chain_ids:
+            return
+        if top is None:
+            top = dict.fromkeys(packages, len(chain_ids) - 1)
+
+        findings = dict((package, []) for package in packages)
+        for finding in self.findings(data):
+            package = finding.get("rpm", {}).get("RPM")
+            # findings of unknown packages could not be composed later
+            if package not in findings:
+                return
+            findings[package].append(finding)
+
+        for index, chain_id in enumerate(chain_ids):
+            cached = dict(
+                (package, findings[package]) for package in packages
+                if top[package] <= index)
+            if not cached:
+                continue
+            key = self.cache_key(chain_id)
+            entry = self.layer_cache.get(key, settings.LAYER_CACHE_TTL)
+            if entry:
+                entry["packages"].update(cached)
+                cached = entry["packages"]
+            self.layer_cache.put(key, {"packages": cached})
@@ -8,13 +8,20 @@ This module invokes all registered scanners and orchestrates the processing.
 import json
 import logging
 import os
-import sys
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
-import docker
+import yaml
 from scanning.lib import settings
-from scanning.lib.log import load_logger
+from scanning.lib.analytics import AnalyticsRegistry
+from scanning.lib.cache import ResultCache
+from scanning.lib.command import run_cmd
+from scanning.lib.docker_pool import DockerClientPool, DockerPoolTimeout, \
+    stream_pull
 from scanning.scanners.analytics_integration import AnalyticsIntegration
-from scanning.scanners.base import Scanner
+from scanning.scanners.base import ImageFacts, RootfsMount, Scanner
 from scanning.scanners.container_capabilities import ContainerCapabilities
 from scanning.scanners.misc_package_updates import MiscPackageUpdates
 from scanning.scanners.pipeline_scanner import PipelineScanner
@@ -29,16 +36,24 @@ class ScannerRunner(Scanner):
     multiple scanner handlers
     """
 
-    def __init__(self, job):
-        """Initialize runner."""
-        # initializing logger
-        load_logger()
+    def __init__(self, job, docker_pool=None, retention=None,
+                 image_held=False):
+        """
+        Initialize runner.
+
+        docker_pool is the pool of docker clients owned by the worker, a new
+        one is created if not given. retention is the image retention manager
+        of the worker, scanned image is kept for it to collect. Without it,
+        image is removed after scan. image_held is set if image under test
+        is held from collection already, runner releases the hold.
+        """
+        # logging is configured by the worker
         self.logger = logging.getLogger('scan-worker')
-        self.docker_conn = self.docker_client()
-        if not self.docker_conn:
-            self.logger.fatal("Not able to connect to docker daemon.")
-            sys.exit(1)
+        self.docker_pool = docker_pool or DockerClientPool(logger=self.logger)
+        self.retention = retention
         self.job = job
+        # image under test is held from retention garbage collection
+        self.image_held = image_held
 
         # register all scanners
         self.scanners = [
@@ -49,43 +64,221 @@ class ScannerRunner(Scanner):
             ContainerCapabilities
         ]
 
-    def docker_client(self, base_url="unix:///var/run/docker.sock"):
-        """
-        returns Docker client object on success else False on failure
-        """
-        try:
-            conn = docker.Client(base_url=base_url)
-        except Exception as e:
-            self.logger.fatal(
-                "Failed to connect to Docker daemon. {}".format(e),
-                exc_info=True)
-            return False
-        else:
-            return conn
+        # scanners results of unchanged images are served from cache
+        self.result_cache = ResultCache(
+            settings.RESULT_CACHE_DIR, settings.RESULT_CACHE_MAX_BYTES,
+            self.logger)
+        self.cache_stats = {"hits": 0, "misses": 0}
+        # scanner class => cached result for image under test
+        self.cached_results = {}
+        # digest of image under test at registry
+        self.image_digest = None
+        # scanner name => image ID of the scanner
+        self.scanner_image_ids = {}
+        # image is pulled only if any scanner needs to run on it
+        self.image_pulled = False
+        # bytes, layers and rate of image pull
+        self.pull_metrics = {}
+        # facts of image under test, resolved once after pull
+        self.facts = None
+        # job holds a reference to image rootfs mount while scanners run,
+        # so it is mounted once and shared by scanners of the job
+        self.job_rootfs = None
+        # scanner class => time scanner started running on image
+        self.scanners_started = {}
+        # scanner class => scanner object running on image
+        self.scanner_objs = {}
+        # scanners whose results are not waited for anymore, timed out
+        self.scanners_abandoned = set()
+        self.scanners_lock = threading.Lock()
+        # why scan of the job failed, e.g. "pull", None if it did not fail.
+        # Failures listed in settings.RETRY_POLICY are retried.
+        self.failure = None
 
     def remove_image(self, image):
         """
         Remove the image under test using docker client
         """
         self.logger.info("Removing image {}".format(image))
-        self.docker_conn.remove_image(image=self.image, force=True)
+        try:
+            with self.docker_pool.client() as conn:
+                conn.remove_image(image=image, force=True)
+        except DockerPoolTimeout as e:
+            self.logger.warning(
+                "Failed to remove image {}. {}".format(image, e))
 
     def pull_image(self, image):
         """
-        Pull image under test on scanner host machine
+        Pull image under test on scanner host machine, pull progress is
+        recorded in self.pull_metrics
         """
         self.logger.info("Pulling image {}".format(image))
-        pull_data = self.docker_conn.pull(repository=image)
-
-        if 'error' in pull_data:
+        try:
+            with self.docker_pool.client() as conn:
+                status, self.pull_metrics = stream_pull(
+                    conn, image, settings.PULL_STALL_TIMEOUT, self.logger)
+        except DockerPoolTimeout as e:
+            # docker clients are held up, pull is retried later
+            status, self.pull_metrics = False, {"error": str(e)}
+
+        if not status:
             self.logger.fatal("Error pulling requested image {}: {}".format(
-                image, pull_data
+                image, self.pull_metrics["error"]
             ))
             return False
 
         self.logger.info("Pulled image {}".format(image))
         return True
 
+    def inspect_image(self, image):
+        """
+        Returns ImageFacts of pulled image, None on failure
+        """
+        try:
+            with self.docker_pool.client() as conn:
+                return ImageFacts(conn.inspect_image(image))
+        except Exception as e:
+            self.logger.critical(
+                "Failed to inspect image {}. {}".format(image, e))
+            return None
+
+    def resolve_image_digest(self, image):
+        """
+        Returns digest of image at registry without pulling it,
+        None on failure
+        """
+        try:
+            out = run_cmd("skopeo inspect docker://{}".format(image))
+            return json.loads(out)["Digest"]
+        except Exception as e:
+            self.logger.warning(
+                "Failed to find digest of image {}. {}".format(image, e))
+            return None
+
+    def scanner_image_id(self, scanner):
+        """
+        Returns image ID of given atomic scanner, None on failure
+        """
+        if scanner not in self.scanner_image_ids:
+            conf = os.path.join(settings.ATOMIC_SCANNERS_CONF_DIR, scanner)
+            try:
+                with open(conf) as fin:
+                    scanner_image = yaml.safe_load(fin)["image_name"]
+                with self.docker_pool.client() as conn:
+                    image_id = conn.inspect_image(scanner_image)["Id"]
+            except Exception as e:
+                self.logger.warning(
+                    "Failed to find image of scanner {}. {}".format(
+                        scanner, e))
+                image_id = None
+            self.scanner_image_ids[scanner] = image_id
+        return self.scanner_image_ids[scanner]
+
+    def result_cache_key(self, scanner_obj):
+        """
+        Returns cache key for result of given scanner on image under test,
+        None if result of scanner can't be cached
+        """
+        if scanner_obj.scanner not in settings.RESULT_CACHE_TTL:
+            return None
+        if not self.image_digest:
+            return None
+        scanner_image_id = self.scanner_image_id(scanner_obj.scanner)
+        if not scanner_image_id:
+            return None
+        # scanners running a scan type give different results per type
+        scan_type = getattr(scanner_obj, "scan_type", None) or "default"
+        return self.result_cache.key(
+            self.image_digest, scanner_obj.scanner, scanner_image_id,
+            scan_type)
+
+    def lookup_cached_results(self, image):
+        """
+        Find cached results of registered scanners for image under test
+        """
+        self.image_digest = self.resolve_image_digest(image)
+        if not self.image_digest:
+            return
+
+        for scanner in self.scanners:
+            scanner_obj = scanner()
+            key = self.result_cache_key(scanner_obj)
+            if not key:
+                continue
+            result = self.result_cache.get(
+                key, settings.RESULT_CACHE_TTL[scanner_obj.scanner])
+            if result is None:
+                self.cache_stats["misses"] += 1
+                continue
+            self.cache_stats["hits"] += 1
+            # same digest could be scanned under other name
+            result["image_under_test"] = image
+            self.cached_results[scanner] = result
+            self.logger.info("Using cached {} result for {}".format(
+                scanner_obj.scanner, image))
+
+    def lookup_analytics_registration(self, image):
+        """
+        Use registration of git-url and git-sha of job at analytics server,
+        if registered in bulk or by register scan of another image, instead
+        of running register scan
+        """
+        server = self.job.get("analytics_server", None)
+        giturl = self.job.get("git-url", None)
+        gitsha = self.job.get("git-sha", None)
+        if not server or not giturl or not gitsha:
+            return
+
+        record = AnalyticsRegistry(server, self.logger).registered(
+            giturl, gitsha)
+        if not record:
+            return
+        self.cached_results[AnalyticsIntegration] = \
+            self.analytics_registration_result(image, record)
+        self.logger.info(
+            "Using earlier registration of {} at analytics server".format(
+                image))
+
+    def analytics_registration_result(self, image, record):
+        """
+        Result of analytics integration scanner for registration of image
+        made earlier, in bulk or by register scan of another image
+        """
+        return {
+            "image_under_test": image,
+            "scanner": AnalyticsIntegration().scanner,
+            "msg": ("Registered container for scanning at server earlier."
+                    " Report has registration related info, no data."),
+            "logs": record,
+            "alert": False
+        }
+
+    def cache_result(self, scanner_obj, result):
+        """
+        Cache result of scanner, unless the scanner failed
+        """
+        if scanner_obj.scan_failed:
+            return
+        key = self.result_cache_key(scanner_obj)
+        if key:
+            self.result_cache.put(key, result)
+
+    def image_needed(self):
+        """
+        Returns True if any scanner has to run on image for the job
+        """
+        if "gemini_report" in self.job:
+            return True
+        for scanner in self.scanners:
+            if scanner in self.cached_results:
+                continue
+            if scanner is AnalyticsIntegration and not all(
+                    self.job.get(key) for key in
+                    ("analytics_server", "git-url", "git-sha")):
+                continue
+            return True
+        return False
+
     def export_scanners_status(self, status, status_file_path):
         """
         Export status of scanners execution for build in process.
@@ -153,11 +346,144 @@ class ScannerRunner(Scanner):
                 "{}.".format(image))
             # the caller for loop will continue if return is None/{}
             return {}
-        else:
-            # execute analytics scanner and provide server url
-            result = self.run_a_scanner(
-                scanner_obj, image, server, giturl, gitsha, scan_type)
-            return result
+
+        # earlier registration is looked up once, before the scan, see
+        # lookup_analytics_registration
+        # execute analytics scanner and provide server url
+        result = self.run_a_scanner(
+            scanner_obj, image, server, giturl, gitsha, scan_type)
+        # scans of other images of the same pair need not register it again
+        if scan_type == "register" and result and \
+                result.get("logs", {}).get("Successful"):
+            AnalyticsRegistry(server, self.logger).record(
+                giturl, gitsha, result["logs"])
+        return result
+
+    def run_job_scanner(self, scanner, image):
+        """
+        Run given scanner class on image as part of normal scan.
+        Returns result of the scanner, {} if scanner is skipped.
+        """
+        if scanner in self.cached_results:
+            return self.cached_results[scanner]
+
+        # create object for the respective scanner class
+        scanner_obj = scanner(self.facts)
+        with self.scanners_lock:
+            self.scanners_started[scanner] = time.time()
+            self.scanner_objs[scanner] = scanner_obj
+
+        # if analytics_integration scanner, provide extra arg
+        if scanner_obj.__class__.__name__ == "AnalyticsIntegration":
+            # case where git-url, git-sha is not present in job gives {}
+            return self.handle_gemini_register(scanner_obj, image)
+
+        # or if its any other scanner, execute atomic scan and grab results
+        result = self.run_a_scanner(scanner_obj, image)
+        with self.scanners_lock:
+            # job reported the scanner timed out, result may be incomplete
+            if scanner in self.scanners_abandoned:
+                self.logger.warning(
+                    "Not caching result of {} scanner finished after "
+                    "timeout".format(scanner_obj.scanner))
+                return result
+        self.cache_result(scanner_obj, result)
+        return result
+
+    def wait_for_scanner(self, scanner, async_result):
+        """
+        Returns result of scanner run in pool, waiting for it up to
+        settings.SCANNER_TIMEOUT seconds from the start of the scanner.
+        Raises TimeoutError if scanner did not finish in time, its running
+        commands are killed.
+        """
+        while not async_result.ready():
+            with self.scanners_lock:
+                started = self.scanners_started.get(scanner)
+            if started is None:
+                # scanner is queued behind other scanners of the job
+                async_result.wait(1)
+                continue
+            remaining = started + settings.SCANNER_TIMEOUT - time.time()
+            if remaining <= 0:
+                with self.scanners_lock:
+                    self.scanners_abandoned.add(scanner)
+                    scanner_obj = self.scanner_objs[scanner]
+                scanner_obj.abort()
+                raise TimeoutError()
+            async_result.wait(remaining)
+        return async_result.get()
+
+    def run_job_scanners(self, image):
+        """
+        Run registered scanners on image, returns list of
+        (scanner class, result) in order of registered scanners.
+
+        Analytics integration scanner runs after the other scanners, by then
+        registration of image by weekly scan in background has usually
+        finished, and register scan is skipped.
+        """
+        first = [scanner for scanner in self.scanners
+                 if scanner is not AnalyticsIntegration]
+        last = [scanner for scanner in self.scanners
+                if scanner is AnalyticsIntegration]
+        results = dict(self.run_scanners(first, image))
+        results.update(self.run_scanners(last, image))
+        return [(scanner, results[scanner]) for scanner in self.scanners]
+
+    def run_scanners(self, scanners, image):
+        """
+        Run given scanners on image, returns list of (scanner class, result)
+        in order of given scanners.
+
+        Scanners run in a pool of settings.SCANNERS_CONCURRENCY threads, each
+        given settings.SCANNER_TIMEOUT seconds to finish, from its own start.
+        A value of 1 runs scanners one after another. Returns once every
+        scanner thread exited, scanners timed out are aborted, so image
+        rootfs is not unmounted under them.
+        """
+        if settings.SCANNERS_CONCURRENCY <= 1 or not scanners:
+            return [(scanner, self.run_job_scanner(scanner, image))
+                    for scanner in scanners]
+
+        pool = ThreadPool(min(settings.SCANNERS_CONCURRENCY, len(scanners)))
+        pending = [
+            (scanner,
+             pool.apply_async(self.run_job_scanner, (scanner, image)))
+            for scanner in scanners]
+        # no more scanners to run, threads exit once done
+        pool.close()
+
+        results = []
+        for scanner, async_result in pending:
+            try:
+                result = self.wait_for_scanner(scanner, async_result)
+            except TimeoutError:
+                self.logger.critical(
+                    "Timed out running {} scanner on {}".format(
+                        scanner.__name__, image))
+                result = self.scanner_timeout_result(scanner(), image)
+            except Exception as e:
+                self.logger.critical(
+                    "Failed running {} scanner on {}. {}".format(
+                        scanner.__name__, image, e), exc_info=True)
+                result = {}
+            results.append((scanner, result))
+        pool.join()
+        return results
+
+    def scanner_timeout_result(self, scanner_obj, image):
+        """
+        Result of scanner which did not finish in configured timeout
+        """
+        return {
+            "image_under_test": image,
+            "scanner": scanner_obj.scanner,
+            "msg": "Scanner {} timed out after {} seconds.".format(
+                scanner_obj.scanner, settings.SCANNER_TIMEOUT),
+            "logs": {},
+            "alert": False
+        }
 
     def handle_normal_scan(self, image):
         """
@@ -172,26 +498,16 @@ class ScannerRunner(Scanner):
         scanners_data["logs_file_path"] = {}
         scanners_data["alert"] = {}
 
-        # run the multiple scanners on image under test
-        for scanner in self.scanners:
-            # create object for the respective scanner class
-            scanner_obj = scanner()
-
-            # if analytics_integration scanner, provide extra arg
-            if scanner_obj.__class__.__name__ == "AnalyticsIntegration":
-                result = self.handle_gemini_register(scanner_obj, image)
-                if not result:
-                    # case where git-url, git-sha is not present in job
-                    continue
-
-            # or if its any other scanner, run with
-            else:
-                # execute atomic scan and grab the results
-                result = self.run_a_scanner(scanner_obj, image)
+        # run the multiple scanners on image under test, results are merged
+        # in order of registered scanners
+        for scanner, result in self.run_job_scanners(image):
+            if not result:
+                # case where git-url, git-sha is not present in job
+                continue
 
             # each scanner invoker class defines the output result file
             result_file = os.path.join(
-                self.job["logs_dir"], scanner_obj.result_file)
+                self.job["logs_dir"], scanner().result_file)
 
             # for only the cases where export/write operation could fail
             if not self.export_scanner_result(result, result_file):
@@ -258,7 +574,7 @@ class ScannerRunner(Scanner):
         scanners_data["logs_file_path"] = {}
 
         # create the specific scanner object
-        scanner_obj = AnalyticsIntegration()
+        scanner_obj = AnalyticsIntegration(self.facts)
         self.logger.debug(
             "Running integration-scanner after polling for {}".format(
                 self.job.get("image_under_test")))
@@ -322,12 +638,42 @@ class ScannerRunner(Scanner):
         # scanners_data["logs_URL"] = {}
         scanners_data["logs_file_path"] = {}
 
+        # results of scanners for unchanged image could be cached
+        if "gemini_report" not in self.job:
+            self.lookup_cached_results(image)
+            self.lookup_analytics_registration(image)
+
         # pull the image first, if failed move on to start_delivery
-        if not self.pull_image(image):
+        if self.image_needed():
+            # image is in use by this job, until clean up
+            if self.retention and not self.image_held:
+                self.retention.acquire(image)
+                self.image_held = True
+            pulled = self.pull_image(image)
+            scanners_data["pull_metrics"] = self.pull_metrics
+            if not pulled:
+                self.logger.info(
+                    "Image pulled failed, moving job to notify_admin tube.")
+                self.release_image(image)
+                scanners_data["action"] = "notify_admin"
+                self.failure = "pull"
+                return False, scanners_data
+            self.image_pulled = True
+            self.facts = self.inspect_image(image)
+            if not self.facts:
+                scanners_data["action"] = "notify_admin"
+                self.failure = "inspect"
+                self.clean_up(image)
+                return False, scanners_data
+            # scan after polling runs analytics integration scanner only,
+            # which needs no rootfs
+            if "gemini_report" not in self.job:
+                self.job_rootfs = RootfsMount.acquire(
+                    self.facts.id, self.logger)
+        else:
             self.logger.info(
-                "Image pulled failed, moving job to notify_admin tube.")
-            scanners_data["action"] = "notify_admin"
-            return False, scanners_data
+                "All scanners results are cached, not pulling {}".format(
+                    image))
 
         # case where this job is running after jenkins polling jobs
         # we need to run only one scanner; analytics-integration with
@@ -353,6 +699,9 @@ class ScannerRunner(Scanner):
         # TODO: Check here if at least one scanner ran successfully
         self.logger.info("Finished executing all scanners.")
 
+        # hits and misses of scanners results cache for the job
+        scanners_data["result_cache"] = self.cache_stats
+
         status_file_path = os.path.join(
             self.job["logs_dir"],
             settings.SCANNERS_STATUS_FILE)
@@ -370,6 +719,23 @@ class ScannerRunner(Scanner):
         """
         Clean up the system post scan
         """
+        if self.job_rootfs:
+            self.job_rootfs.release()
+            self.job_rootfs = None
+        # scanned image is retained for next images sharing its layers,
+        # retention manager removes it once docker storage fills up
+        if self.retention:
+            self.release_image(image)
+            return
+        if not self.image_pulled:
+            return
         # after all scanners are ran, remove the image
-        self.logger.info("Removing the image: {}".format(image))
-        self.docker_conn.remove_image(image=image, force=True)
+        self.remove_image(image)
+
+    def release_image(self, image):
+        """
+        Release hold of image under test, if held from garbage collection
+        """
+        if self.image_held:
+            self.retention.release(image)
+            self.image_held = False
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+"""
+This module keeps the local package index of pip, npm and gem packages up to
+date. Latest versions of packages already in index and of packages wanted by
+scans are looked up at the package registries, and index files are replaced
+atomically, see scanning.lib.packages.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+from scanning.lib import settings
+from scanning.lib.log import load_logger
+from scanning.lib.packages import INDEX_FILES, WANTED_SUFFIX
+
+# URL of latest version of a package, per package manager
+LATEST_URLS = {
+    "pip": "https://pypi.org/pypi/{}/json",
+    "npm": "https://registry.npmjs.org/-/package/{}/dist-tags",
+    "gem": "https://rubygems.org/api/v1/versions/{}/latest.json",
+}
+# packages looked up at once
+WORKERS = 8
+TIMEOUT = (10, 30)
+
+
+class LookupFailed(Exception):
+    """Raised when latest version of package could not be looked up"""
+    pass
+
+
+def latest_version(session, manager, name):
+    """
+    Returns latest version of package at registry of given package manager,
+    None if registry does not know the package
+    """
+    url = LATEST_URLS[manager].format(
+        requests.utils.quote(name, safe="@" if manager == "npm" else ""))
+    try:
+        r = session.get(url, timeout=TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        raise LookupFailed(str(e))
+    if r.status_code == 404:
+        return None
+    if r.status_code != requests.codes.ok:
+        raise LookupFailed("{} returned {}".format(url, r.status_code))
+    try:
+        data = r.json()
+    except ValueError as e:
+        raise LookupFailed(str(e))
+
+    if manager == "pip":
+        return data.get("info", {}).get("version")
+    elif manager == "npm":
+        return data.get("latest")
+    # rubygems gives "unknown" for gems it does not have
+    version = data.get("version")
+    return None if version in (None, "unknown") else version
+
+
+class PackageIndexer(object):
+    """
+    Refreshes index files of package managers in given package index dir
+    """
+
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logger or logging.getLogger("console")
+        self.session = requests.Session()
+        self.session.mount("https://", requests.adapters.HTTPAdapter(
+            pool_connections=WORKERS, pool_maxsize=WORKERS))
+
+    def read_index(self, manager):
+        """
+        Returns current index of given package manager, {} if there is none
+        """
+        try:
+            with open(os.path.join(self.path, INDEX_FILES[manager])) as fin:
+                return json.load(fin)
+        except (IOError, ValueError):
+            return {}
+
+    def take_wanted(self, manager):
+        """
+        Returns names of packages wanted in index of given package manager,
+        and empties the list of wanted packages
+        """
+        path = os.path.join(self.path, INDEX_FILES[manager] + WANTED_SUFFIX)
+        try:
+            with open(path, "r+") as fin:
+                fcntl.flock(fin, fcntl.LOCK_EX)
+                names = set(line.strip() for line in fin if line.strip())
+                fin.seek(0)
+                fin.truncate()
+        except IOError:
+            return set()
+        return names
+
+    def write_index(self, manager, index):
+        """
+        Replace index file of given package manager
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w") as fout:
+            json.dump(index, fout, sort_keys=True)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, os.path.join(self.path, INDEX_FILES[manager]))
+
+    def refresh(self, manager):
+        """
+        Look up latest versions of packages of given package manager and
+        write its index. Packages whose lookup fails keep their previous
+        version, wanted packages failing are wanted again on next refresh.
+        """
+        index = self.read_index(manager)
+        wanted = self.take_wanted(manager)
+        names = sorted(set(index) | wanted)
+        self.logger.info("Looking up {} {} packages".format(
+            len(names), manager))
+
+        def lookup(name):
+            try:
+                return name, latest_version(self.session, manager, name)
+            except LookupFailed as e:
+                self.logger.warning(
+                    "Failed to look up {} package {}. {}".format(
+                        manager, name, e))
+                return name, LookupFailed
+
+        pool = ThreadPool(WORKERS)
+        try:
+            results = pool.map(lookup, names)
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = []
+        for name, version in results:
+            if version is LookupFailed:
+                if name not in index:
+                    failed.append(name)
+                continue
+            index[name] = version
+        self.write_index(manager, index)
+        if failed:
+            with open(os.path.join(
+                    self.path, INDEX_FILES[manager] + WANTED_SUFFIX),
+                    "a") as fout:
+                fcntl.flock(fout, fcntl.LOCK_EX)
+                fout.write("".join(name + "\n" for name in failed))
+        self.logger.info("Indexed {} {} packages, {} failed".format(
+            len(index), manager, len(failed)))
+
+    def run(self):
+        """
+        Refresh index of every package manager
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for manager in sorted(INDEX_FILES):
+            try:
+                self.refresh(manager)
+            except (IOError, OSError) as e:
+                self.logger.critical(
+                    "Failed to refresh {} package index. {}".format(
+                        manager, e))
+
+
+if __name__ == "__main__":
+    load_logger()
+    PackageIndexer(settings.PACKAGE_INDEX_DIR).run()
@@ -12,7 +12,10 @@ import os
 import random
 import string
 import sys
+import threading
+import time
 
+from scanning.lib.analytics import AnalyticsRegistry
 from scanning.lib.queue import JobQueue
 from scanning.lib.log import load_logger
 from scanning.lib import settings
@@ -33,6 +36,11 @@ class WeeklyScan(object):
                               port=settings.BEANSTALKD_PORT,
                               sub=sub, pub=pub, logger=self.logger)
         self.gitrepo = GITREPO
+        # (git-url, git-sha) pairs submitted for registration at analytics
+        # server => time of submission
+        self.preregistered = {}
+        # threads registering submitted pairs in background
+        self.registrations = []
 
     def random_string(self, size=3):
         """
@@ -125,6 +133,10 @@ class WeeklyScan(object):
                 "Aborting weekly scan.")
             return None
 
+        # register unique git-url, git-sha of images at analytics server
+        # in background, server analyses them while images are scanned
+        self.preregister([(image[0], image[1]) for image in images])
+
         # create weekly scan dir in configured git repo
         scan_gitpath = self.create_weekly_scan_dir_in_git_repo()
         if not scan_gitpath:
@@ -148,8 +160,62 @@ class WeeklyScan(object):
             self.put_image_for_scanning(
                 image[2], resultdir, image[0], image[1], scan_gitpath)
             self.logger.info("Queued weekly scanning for {}.".format(image))
+
+        self.wait_for_registrations()
         return "Queued containers for weekly scan."
 
+    def preregister(self, pairs):
+        """
+        Register given git-url, git-sha pairs at analytics server in
+        background, pairs submitted before are skipped
+        """
+        if not settings.ANALYTICS_SERVER:
+            return
+        submitted = time.time()
+        pending = []
+        for pair in pairs:
+            pair = tuple(pair)
+            if pair in self.preregistered:
+                continue
+            self.preregistered[pair] = submitted
+            pending.append(pair)
+        if not pending:
+            return
+
+        thread = threading.Thread(
+            target=self.register_analytics, args=(pending,))
+        thread.start()
+        self.registrations.append(thread)
+
+    def wait_for_registrations(self):
+        """
+        Wait for registrations running in background to finish
+        """
+        if [thread for thread in self.registrations if thread.is_alive()]:
+            self.logger.info(
+                "Waiting for registration at analytics server to finish..")
+        for thread in self.registrations:
+            thread.join()
+        self.registrations = []
+
+    def register_analytics(self, pairs):
+        """
+        Register given git-url, git-sha pairs at analytics server in bulk
+        """
+        registry = AnalyticsRegistry(settings.ANALYTICS_SERVER, self.logger)
+        try:
+            result = registry.register(pairs)
+        except Exception as e:
+            self.logger.warning(
+                "Failed to register images at analytics server in bulk, "
+                "images will be registered while scanned. {}".format(e))
+            return None
+        if result:
+            self.logger.info(
+                "Registered {} pairs at analytics server, {} failed".format(
+                    *result))
+        return result
+
     def create_weekly_scan_dir_in_git_repo(self):
         """
         Creates weekly scan dir in configured git repo
@@ -181,6 +247,10 @@ class WeeklyScan(object):
             "git-sha": gitsha,
             "scan_gitpath": scan_gitpath,
         }
+        # image is registered at analytics server in background, unless
+        # registered with batch of images already. Scan of image uses the
+        # registration instead of running register scan.
+        self.preregister([(giturl, gitsha)])
         self.logger.info("Putting {} for scan..".format(image))
         # now put image for scan
         self.queue.put(json.dumps(job), "master_tube")
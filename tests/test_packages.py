@@ -0,0 +1,79 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from scanning.lib.packages import PackageIndex, newer, version_key
+
+
+class VersionOrderTest(unittest.TestCase):
+
+    def assertOrdered(self, versions, manager=None):
+        keys = [version_key(version, manager) for version in versions]
+        self.assertEqual(keys, sorted(keys), versions)
+        self.assertEqual(len(set(keys)), len(keys), versions)
+
+    def test_pip_phases(self):
+        self.assertOrdered(
+            ["1.0.dev1", "1.0a1", "1.0b1", "1.0rc1", "1.0", "1.0.post1",
+             "1.1"], "pip")
+
+    def test_post_release_is_newer(self):
+        self.assertTrue(newer("1.0.post1", "1.0", "pip"))
+        self.assertFalse(newer("1.0", "1.0.post1", "pip"))
+
+    def test_pip_bare_number_is_post_release(self):
+        self.assertTrue(newer("1.0-1", "1.0", "pip"))
+
+    def test_npm_suffixes_are_pre_releases(self):
+        self.assertOrdered(
+            ["1.0.0-1", "1.0.0-alpha", "1.0.0-alpha.1", "1.0.0-beta",
+             "1.0.0-rc.1", "1.0.0"], "npm")
+
+    def test_gem_pre_release(self):
+        self.assertTrue(newer("1.0.0", "1.0.0.pre", "gem"))
+        self.assertTrue(newer("1.0.0.pre", "0.9", "gem"))
+
+    def test_trailing_zeros_and_build_metadata(self):
+        self.assertEqual(version_key("1.0.0"), version_key("1"))
+        self.assertEqual(version_key("1.0+build.5", "npm"),
+                         version_key("1.0", "npm"))
+
+    def test_release_numbers(self):
+        self.assertTrue(newer("1.10", "1.9"))
+        self.assertTrue(newer("v2.0", "1.99"))
+
+
+class PackageIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index = PackageIndex(self.path)
+        with open(self.index.index_path("pip"), "w") as fout:
+            json.dump({"requests": "2.20.0", "gone": None}, fout)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_outdated(self):
+        self.assertEqual(
+            self.index.outdated(
+                "pip", {"Requests": "2.19.1", "gone": "1.0"}),
+            ["Requests"])
+        self.assertFalse(os.path.exists(self.index.wanted_path("pip")))
+
+    def test_missing_packages_are_wanted(self):
+        self.assertIsNone(self.index.outdated(
+            "pip", {"requests": "2.19.1", "Foo_Bar": "1.0"}))
+        with open(self.index.wanted_path("pip")) as fin:
+            self.assertEqual(fin.read(), "foo-bar\n")
+
+    def test_no_index(self):
+        self.assertIsNone(self.index.outdated("npm", {"left-pad": "1.0.0"}))
+        with open(self.index.wanted_path("npm")) as fin:
+            self.assertEqual(fin.read(), "left-pad\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
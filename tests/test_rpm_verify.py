@@ -0,0 +1,84 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from scanning.lib import settings
+from scanning.scanners.base import ImageFacts
+from scanning.scanners.rpm_verify import ScannerRPMVerify
+
+
+class LayerCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.settings = (settings.DOCKER_ROOT_DIR, settings.LAYER_CACHE_DIR)
+        settings.DOCKER_ROOT_DIR = os.path.join(self.tmp, "docker")
+        settings.LAYER_CACHE_DIR = os.path.join(self.tmp, "cache")
+        self.mountpath = os.path.join(self.tmp, "rootfs")
+        os.makedirs(self.mountpath)
+        os.symlink("usr/bin", os.path.join(self.mountpath, "bin"))
+
+    def tearDown(self):
+        settings.DOCKER_ROOT_DIR, settings.LAYER_CACHE_DIR = self.settings
+        shutil.rmtree(self.tmp)
+
+    def scanner(self, diff_ids, layer_files):
+        facts = ImageFacts({
+            "Id": "sha256:1234",
+            "RootFS": {"Layers": diff_ids},
+            "GraphDriver": {"Name": "devicemapper"}})
+        for chain_id, names in zip(facts.chain_ids(), layer_files):
+            layer_dir = os.path.join(
+                settings.DOCKER_ROOT_DIR, "image", "devicemapper",
+                "layerdb", "sha256", chain_id.split(":")[-1])
+            if os.path.isdir(layer_dir):
+                continue
+            os.makedirs(layer_dir)
+            with gzip.open(
+                    os.path.join(layer_dir, "tar-split.json.gz"), "w") as f:
+                for name in names:
+                    f.write(json.dumps({"type": 1, "name": name}) + "\n")
+        scanner_obj = ScannerRPMVerify(facts)
+        scanner_obj.image_mountpath = self.mountpath
+        return scanner_obj
+
+    def test_top_changed_layers(self):
+        scanner_obj = self.scanner(
+            ["sha256:a", "sha256:b"],
+            [["usr/bin/ls", "usr/lib/libc.so", "etc/foo"],
+             ["usr/lib/.wh.libc.so", "var/lib/rpm/Packages"]])
+        top = scanner_obj.top_changed_layers({
+            "coreutils": ["/bin/ls"],
+            "glibc": ["/usr/lib/libc.so"],
+            "rpm": ["/var/lib/rpm/Packages"],
+            "filesystem": ["/srv"]})
+        self.assertEqual(
+            top, {"coreutils": 0, "glibc": 1, "rpm": -1, "filesystem": -1})
+
+    def test_reuse_findings_of_shared_layers(self):
+        finding = {"issue": "S", "filename": "/usr/bin/ls",
+                   "rpm": {"RPM": "coreutils"}}
+        scanner_obj = self.scanner(
+            ["sha256:a", "sha256:b"],
+            [["usr/bin/ls", "etc/foo"], ["opt/app"]])
+        packages = {"coreutils": ["/bin/ls"], "foo": ["/etc/foo"],
+                    "app": ["/opt/app"]}
+        scanner_obj.cache_layers(
+            {"logs": {"Scan Results": {"rpmVa_issues": [finding]}}},
+            packages, scanner_obj.top_changed_layers(packages))
+
+        # image built on the same base layer, changing files of foo
+        scanner_obj = self.scanner(
+            ["sha256:a", "sha256:c"],
+            [[], ["etc/.wh..wh..opq", "etc/bar"]])
+        top = scanner_obj.top_changed_layers(
+            {"coreutils": ["/bin/ls"], "foo": ["/etc/foo"]})
+        self.assertEqual(
+            scanner_obj.cached_findings(top), {"coreutils": [finding]})
+
+
+if __name__ == "__main__":
+    unittest.main()
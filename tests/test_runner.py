@@ -0,0 +1,47 @@
+import unittest
+
+from scanning.lib import settings
+from scanning.scanners.misc_package_updates import MiscPackageUpdates
+from scanning.scanners.runner import ScannerRunner
+
+
+class ResultCacheKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = ScannerRunner({"image_under_test": "test:latest"})
+        self.runner.image_digest = "sha256:1234"
+        self.runner.scanner_image_ids = {
+            "misc-package-updates": "sha256:abcd"}
+
+    def key(self, scanner_obj):
+        return self.runner.result_cache_key(scanner_obj)
+
+    def test_key_of_scan_type(self):
+        scanner_obj = MiscPackageUpdates()
+        key = self.key(scanner_obj)
+        self.assertEqual(key, self.runner.result_cache.key(
+            "sha256:1234", "misc-package-updates", "sha256:abcd",
+            "all-updates"))
+        scanner_obj.scan_type = "pip-updates"
+        self.assertNotEqual(self.key(scanner_obj), key)
+
+    def test_key_of_default_scan_type(self):
+        scanner_obj = MiscPackageUpdates()
+        scanner_obj.scan_type = None
+        self.assertEqual(self.key(scanner_obj), self.runner.result_cache.key(
+            "sha256:1234", "misc-package-updates", "sha256:abcd",
+            "default"))
+
+    def test_no_key_without_digest(self):
+        self.runner.image_digest = None
+        self.assertIsNone(self.key(MiscPackageUpdates()))
+
+    def test_no_key_of_uncached_scanner(self):
+        scanner_obj = MiscPackageUpdates()
+        scanner_obj.scanner = "not-cached"
+        self.assertNotIn(scanner_obj.scanner, settings.RESULT_CACHE_TTL)
+        self.assertIsNone(self.key(scanner_obj))
+
+
+if __name__ == "__main__":
+    unittest.main()
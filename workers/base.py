@@ -1,11 +1,47 @@
+import errno
 import json
 import logging
+import os
+import random
+import signal
+import threading
 import time
 
-from scanning.lib.queue import JobQueue
+from scanning.lib.queue import JobQueue, record_job_duration
 from scanning.lib import settings
 
 
+class Heartbeat(threading.Thread):
+    """
+    Touches a reserved job at regular interval, so beanstalkd does not
+    release it to another worker while it is being processed.
+    """
+
+    def __init__(self, queue, job_obj, interval, logger):
+        super(Heartbeat, self).__init__(name='heartbeat')
+        self.daemon = True
+        self.queue = queue
+        self.job_obj = job_obj
+        self.interval = interval
+        self.logger = logger
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.queue.touch(self.job_obj)
+            except Exception as e:
+                self.logger.warning(
+                    'Failed to touch job {}, stopping heartbeat. {}'.format(
+                        self.job_obj.jid, e))
+                return
+
+    def stop(self):
+        """Stop touching the job"""
+        self._stopped.set()
+        self.join()
+
+
 class BaseWorker(object):
     """Base class for pipeline workers"""
     NAME = ''
@@ -15,6 +51,8 @@ class BaseWorker(object):
         self.build = None
         self.build_phase_name = None
         self.build_phase = None
+        # worker keeps taking jobs until stopped
+        self.running = True
         self.logger = logger or logging.getLogger('console')
         self.queue = JobQueue(host=settings.BEANSTALKD_HOST,
                               port=settings.BEANSTALKD_PORT,
@@ -22,6 +60,30 @@ class BaseWorker(object):
         if not self.NAME:
             raise Exception('Define name for your worker class!')
 
+    def stop(self, *args):
+        """
+        Stop taking new jobs, job under process is finished first.
+        Can be used as signal handler.
+        """
+        self.logger.info('{} stopping...'.format(self.NAME))
+        self.running = False
+
+    def stop_on_sigterm(self):
+        """
+        Stop worker gracefully on SIGTERM. System calls are not interrupted by
+        the signal, a blocking wait for job returns at the end of its long-poll
+        window and the worker exits then.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.siginterrupt(signal.SIGTERM, False)
+
+    def reserve_job(self):
+        """
+        Returns next job to process, None if no job arrived in long-poll
+        window. Customize as needed.
+        """
+        return self.queue.get(timeout=settings.BEANSTALKD_RESERVE_TIMEOUT)
+
     def handle_job(self, job):
         """
         This method is called to process job data from task queue.
@@ -35,26 +97,77 @@ class BaseWorker(object):
         """
         self.queue.put(json.dumps(data), 'master_tube')
 
+    def retry_wait(self, job):
+        """
+        Returns seconds left before a job marked for retry is due, 0 if the
+        job is not a retry or is due already.
+        """
+        if job.get('retry') is not True:
+            return 0
+        due = job.get('last_run_timestamp', 0) + job.get('retry_delay', 0)
+        return max(0, due - time.time())
+
+    def schedule_retry(self, job, failure='default'):
+        """
+        Schedule given job for a retry in the subscribed tube.
+
+        The delay grows exponentially with the number of attempts made for
+        the job, with jitter, as per settings.RETRY_POLICY for the failure
+        class. The job is parked at beanstalkd with a delay, so the worker
+        does not wait for it. Returns False if retries are exhausted.
+        """
+        policy = settings.RETRY_POLICY.get(
+            failure, settings.RETRY_POLICY['default'])
+        attempt = job.get('retry_count', 0)
+        if attempt >= policy['max_retries']:
+            self.logger.warning(
+                'Giving up on job after {} retries for {} failure: {}'.format(
+                    attempt, failure, job))
+            return False
+
+        delay = min(policy['max_delay'], policy['base_delay'] * 2 ** attempt)
+        # full jitter over the upper half keeps retries of jobs failed
+        # together from hitting the services at the same time
+        delay = random.uniform(delay / 2.0, delay)
+
+        job['retry'] = True
+        job['retry_count'] = attempt + 1
+        job['retry_failure'] = failure
+        job['retry_delay'] = delay
+        job['last_run_timestamp'] = time.time()
+        self.queue.put(json.dumps(job), self.queue.sub, delay=delay)
+        self.logger.info('Scheduled retry {} of job in {} seconds'.format(
+            attempt + 1, int(delay)))
+        return True
+
     def run(self):
         """Run worker"""
         self.logger.info('{} running...'.format(self.NAME))
 
-        while True:
+        while self.running:
             job_obj = None
             try:
-                job_obj = self.queue.get()
+                job_obj = self.reserve_job()
+                if not job_obj:
+                    # long-poll window elapsed without a job, wait again
+                    continue
                 job = json.loads(job_obj.body)
 
-                # Skip retrying a job if it's too early and push it back to
-                # queue. This will allow us to introduce some delays between
-                # job retries
-                if job.get('retry') is True and (
-                        time.time() - job.get('last_run_timestamp', 0) <
-                        job.get('retry_delay', 0)):
-                    time.sleep(10)
-                    self.queue.put(json.dumps(job), 'master_tube')
+                # Skip retrying a job if it's too early and release it back
+                # with the remaining delay, beanstalkd will hold the job
+                # until it is due without blocking this worker
+                wait = self.retry_wait(job)
+                if wait > 0:
+                    self.queue.release(job_obj, delay=wait)
+                    # released job must not be deleted
+                    job_obj = None
                 else:
                     self.logger.info('Got job: {}'.format(job))
+                    heartbeat = Heartbeat(
+                        self.queue, job_obj, settings.HEARTBEAT_INTERVAL,
+                        self.logger)
+                    heartbeat.start()
+                    started = time.time()
                     try:
                         self.handle_job(job)
                     except Exception as e:
@@ -62,6 +175,10 @@ class BaseWorker(object):
                             'Error in handling job: {}\nJob details: {}'
                             .format(e, job), extra={'locals': locals()},
                             exc_info=True)
+                    finally:
+                        heartbeat.stop()
+                    record_job_duration(
+                        self.queue.sub, time.time() - started)
             except Exception as e:
                 self.logger.critical(
                     'Unexpected error when processing job: {}'.format(e),
@@ -69,3 +186,87 @@ class BaseWorker(object):
             finally:
                 if job_obj:
                     self.queue.delete(job_obj)
+
+
+class WorkerPool(object):
+    """
+    Prefork supervisor for workers.
+
+    Forks given number of worker processes, each with its own queue
+    connection, all subscribed to the same tube. Crashed workers are restarted
+    and SIGTERM drains the pool, each worker finishes its job under process
+    and exits.
+    """
+
+    def __init__(self, worker_factory, concurrency, logger=None):
+        # callable returning a new worker, called in the forked process
+        self.worker_factory = worker_factory
+        self.concurrency = concurrency
+        self.logger = logger or logging.getLogger('console')
+        # pid => start timestamp of worker processes
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self):
+        """Fork a worker process"""
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            self.logger.info('Started worker process {}'.format(pid))
+            return pid
+
+        # in worker process, handlers of the pool must not run here, its
+        # copy of children is stale
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            worker = self.worker_factory()
+            worker.stop_on_sigterm()
+            worker.run()
+        except Exception as e:
+            self.logger.critical(
+                'Worker process {} failed: {}'.format(os.getpid(), e),
+                exc_info=True)
+            os._exit(1)
+        os._exit(0)
+
+    def stop(self, *args):
+        """Drain the pool, signal handler for SIGTERM and SIGINT"""
+        self.logger.info('Stopping {} worker processes...'.format(
+            len(self.children)))
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        """Run workers and supervise them until the pool is drained"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for _ in range(self.concurrency):
+            self.spawn()
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                # interrupted by signal
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+
+            self.logger.warning(
+                'Worker process {} exited with status {}, restarting.'.format(
+                    pid, status))
+            # do not crash loop workers failing at start
+            if time.time() - started < 10:
+                time.sleep(10)
+            if not self.stopping:
+                self.spawn()
+        self.logger.info('All worker processes stopped.')
@@ -2,6 +2,7 @@
 import json
 import logging
 
+from scanning.lib import settings
 from scanning.lib.log import load_logger
 from base import BaseWorker
 
@@ -24,8 +25,12 @@ class DispatcherWorker(BaseWorker):
 
     def run(self):
         """Run worker"""
-        while True:
-            job_obj = self.queue.get()
+        while self.running:
+            job_obj = self.queue.get(
+                timeout=settings.BEANSTALKD_RESERVE_TIMEOUT)
+            if not job_obj:
+                # long-poll window elapsed without a job, wait again
+                continue
             job = json.loads(job_obj.body)
             self.logger.info('Got job: {}'.format(job))
             try:
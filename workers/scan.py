@@ -3,13 +3,89 @@
 """
 This module contains the worker that handles the scanning.
 """
+import argparse
 import json
 import logging
+import os
+import threading
+from collections import deque
 
 from scanning.lib import log
-from scanning.lib.command import run_cmd
+from scanning.lib import settings
+from scanning.lib.docker_pool import DockerClientPool, stream_pull
+from scanning.lib.retention import ImageRetention
 from scanning.scanners.runner import ScannerRunner
-from base import BaseWorker
+from base import BaseWorker, Heartbeat, WorkerPool
+
+
+class PrefetchedJob(object):
+    """
+    Job reserved ahead of time by scan worker. The job is touched while it
+    waits and its image is pulled in background.
+    """
+
+    def __init__(self, worker, job_obj):
+        self.worker = worker
+        self.job_obj = job_obj
+        # size of the pulled image, counted against disk budget
+        self.size = 0
+        # image marked in use with retention manager
+        self.image = None
+        self.heartbeat = Heartbeat(
+            worker.queue, job_obj, settings.HEARTBEAT_INTERVAL, worker.logger)
+        self.puller = threading.Thread(target=self.pull, name='prefetch')
+        self.puller.daemon = True
+
+    def start(self):
+        """Start keeping the job reserved and pulling its image"""
+        self.heartbeat.start()
+        self.puller.start()
+
+    def pull(self):
+        """Pull image of the job, failures are left to the scan to handle"""
+        try:
+            job = json.loads(self.job_obj.body)
+            # retry jobs not due yet are released by worker, no pull needed
+            if self.worker.retry_wait(job) > 0:
+                return
+            image = job["image_under_test"]
+            self.worker.logger.info("Prefetching image {}".format(image))
+            # keep prefetched image from garbage collection till scanned
+            self.worker.retention.acquire(image)
+            self.image = image
+            with self.worker.docker_pool.client() as conn:
+                pulled, _ = stream_pull(
+                    conn, image, settings.PULL_STALL_TIMEOUT,
+                    self.worker.logger)
+                if pulled:
+                    self.size = conn.inspect_image(image).get("Size", 0)
+        except Exception as e:
+            self.worker.logger.warning(
+                "Failed to prefetch image for job {}. {}".format(
+                    self.job_obj.jid, e))
+
+    def release_image(self):
+        """Image is not in use by prefetch anymore"""
+        if self.image:
+            self.worker.retention.release(self.image)
+            self.image = None
+
+    def hand_off(self):
+        """
+        Returns the job once its image pull is finished, along with the image
+        held from garbage collection, if any. The scan takes over the hold.
+        """
+        self.puller.join()
+        self.heartbeat.stop()
+        image, self.image = self.image, None
+        return self.job_obj, image
+
+    def release(self):
+        """Release the job back to queue for other workers"""
+        self.heartbeat.stop()
+        self.puller.join()
+        self.release_image()
+        self.worker.queue.release(self.job_obj)
 
 
 class ScanWorker(BaseWorker):
@@ -18,6 +94,76 @@ class ScanWorker(BaseWorker):
 
     def __init__(self, logger=None, sub=None, pub=None):
         super(ScanWorker, self).__init__(logger=logger, sub=sub, pub=pub)
+        # docker clients shared by runner, prefetch and cleanup across jobs
+        self.docker_pool = DockerClientPool(
+            size=settings.PREFETCH_JOBS + 2, logger=self.logger)
+        # jobs reserved ahead of the job under scan, in order of reservation
+        self.prefetched = deque()
+        # image of reserved job held from garbage collection by prefetch,
+        # until the scan of the job takes over the hold
+        self.held_image = None
+        # scanned images are kept and garbage collected in background
+        self.retention = ImageRetention(
+            self.docker_pool, settings.IMAGE_RETENTION_FILE,
+            settings.DOCKER_ROOT_DIR, settings.IMAGE_DISK_HIGH_WATERMARK,
+            settings.IMAGE_DISK_LOW_WATERMARK, self.logger)
+        self.retention.start_collector(settings.IMAGE_GC_INTERVAL)
+
+    def prefetch_allowed(self):
+        """
+        Returns True if images of more jobs can be prefetched within disk
+        budget
+        """
+        if len(self.prefetched) >= settings.PREFETCH_JOBS:
+            return False
+        if sum(p.size for p in self.prefetched) >= \
+                settings.PREFETCH_DISK_BUDGET:
+            return False
+        try:
+            stat = os.statvfs(settings.DOCKER_ROOT_DIR)
+        except OSError:
+            return False
+        return stat.f_bavail * stat.f_frsize >= \
+            settings.PREFETCH_MIN_FREE_BYTES
+
+    def prefetch(self):
+        """
+        Reserve next jobs, if any are ready, and pull their images in
+        background
+        """
+        while self.prefetch_allowed():
+            job_obj = self.queue.get(timeout=0)
+            if not job_obj:
+                return
+            prefetched = PrefetchedJob(self, job_obj)
+            prefetched.start()
+            self.prefetched.append(prefetched)
+
+    def reserve_job(self):
+        """
+        Returns the oldest prefetched job, if any, else waits for next job
+        """
+        # previous job was not scanned, e.g. its retry was not due
+        self.release_held_image()
+        if self.prefetched:
+            job_obj, self.held_image = self.prefetched.popleft().hand_off()
+            return job_obj
+        return super(ScanWorker, self).reserve_job()
+
+    def release_held_image(self):
+        """Release hold of prefetched image not taken over by a scan"""
+        if self.held_image:
+            self.retention.release(self.held_image)
+            self.held_image = None
+
+    def run(self):
+        """Run worker, prefetched jobs are released when it stops"""
+        try:
+            super(ScanWorker, self).run()
+        finally:
+            self.release_held_image()
+            while self.prefetched:
+                self.prefetched.popleft().release()
 
     def handle_job(self, job):
         """
@@ -26,15 +172,31 @@ class ScanWorker(BaseWorker):
         This scans the images for the job requests in start_scan tube.
         this calls the ScannerRunner for performing the scan work
         """
-        scan_runner_obj = ScannerRunner(job)
+        # pull images of next jobs while this one is scanned
+        self.prefetch()
+
+        # runner adds scan results to job, keep original for a retry
+        retry_job = job.copy()
+        # runner takes over the hold of image taken by prefetch, if any, so
+        # image is not collected in between
+        image_held = False
+        if self.held_image and \
+                self.held_image == job.get("image_under_test"):
+            image_held, self.held_image = True, None
+        self.release_held_image()
+        scan_runner_obj = ScannerRunner(
+            job, self.docker_pool, self.retention, image_held)
         status, scanners_data = scan_runner_obj.scan()
         if not status:
             self.logger.warning(
                 "Failed to run scanners on image under test, moving on!")
             self.logger.warning("Job data %s", str(job))
             self.logger.warning("Not sending job to poll_server tube.")
-            # run the image and volume cleanup
-            self.clean_up()
+            # only transient failures, such as image pull, are retried,
+            # others would fail the same way again
+            if scan_runner_obj.failure in settings.RETRY_POLICY:
+                self.schedule_retry(
+                    retry_job, failure=scan_runner_obj.failure)
             return
         else:
             self.logger.debug("Scan is completed. Result {}".format(
@@ -60,9 +222,6 @@ class ScanWorker(BaseWorker):
         scanners_data["action"] = "notify"
         self.queue.put(json.dumps(scanners_data), 'master_tube')
 
-        # remove the image and volume cleanup
-        self.clean_up()
-
     def put_job_for_polling(self, job):
         """
         Put job on polling tube
@@ -71,35 +230,22 @@ class ScanWorker(BaseWorker):
         self.queue.put(json.dumps(job), tube=poll_tube)
         self.logger.info("Queued job at {} tube.".format(poll_tube))
 
-    def clean_up(self):
-        """
-        Clean up the system after scan is done.
-        This cleans up any unused/dangling images and volumes.
-        This is using `docker image prune -f` and `docker volume prune -f`
-        commands under the hood. The `-f` option will help avoid the prompt
-        for confirmation.
-        """
-        command = "docker rmi -f `docker images -f dangling=true -q`"
-        self.logger.debug("Removing unused/dangling images..")
-        try:
-            run_cmd(command, shell=True)
-        except Exception:
-            pass
-        else:
-            self.logger.debug("Cleaned unsued images post scan.")
-
-        command = "docker volume rm `docker volume ls -f dangling=true -q`"
-        self.logger.debug("Removing unused/dangling volumes..")
-        try:
-            run_cmd(command, shell=True)
-        except Exception:
-            pass
-        else:
-            self.logger.debug("Cleaned unsued volumes post scan.")
-
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scan worker")
+    parser.add_argument(
+        "--concurrency", type=int, default=1,
+        help="Number of worker processes scanning images in parallel")
+    args = parser.parse_args()
 
     log.load_logger()
     logger = logging.getLogger("scan-worker")
-    ScanWorker(logger, sub='start_scan', pub='failed_scan').run()
+
+    if args.concurrency > 1:
+        WorkerPool(
+            lambda: ScanWorker(logger, sub='start_scan', pub='failed_scan'),
+            args.concurrency, logger).run()
+    else:
+        worker = ScanWorker(logger, sub='start_scan', pub='failed_scan')
+        worker.stop_on_sigterm()
+        worker.run()